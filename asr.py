@@ -0,0 +1,212 @@
+import threading
+import logging
+import traceback
+import json
+import time
+import wave
+import io
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import registry
+from singleton import Singleton
+
+
+def build_wav(pcm: np.ndarray, sample_rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframesraw(pcm)
+    return buffer.getvalue()
+
+
+class ASRSender(Singleton):
+    """
+    Delivers finished recordings to the ASR service off the fragment worker thread.
+
+    Uploads go through a pooled keep-alive session, several at a time. Uploads that fail with a connection
+    error or a 5xx response are spooled to disk and retried with exponential backoff, the spool keeps at most
+    `spool_limit` recordings and drops the oldest ones when full. Fragment worker processes share the spool,
+    an entry is claimed for a retry by renaming its meta file, so only one of them posts it. Recordings the
+    service rejects with a 4xx response won't be taken on a retry either, they are kept in the `rejected`
+    directory of the spool, up to `spool_limit` of them as well.
+    """
+    _instance = None
+
+    RETRY_BASE = 2
+    RETRY_MAX = 300
+    # Claims older than this were left by a process that died during the retry
+    CLAIM_TIMEOUT = 600
+    REJECTED_DIR = "rejected"
+
+    def __init__(self, config):
+        if getattr(self, "url", None) is not None:
+            return
+        self.url = config.sr_url
+        self.timeout = config.asr_timeout
+        self.spool_dir = config.asr_spool_dir
+        self.spool_limit = config.asr_spool_limit
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.asr_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=config.asr_concurrency, thread_name_prefix="asr")
+        self._spool_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        self.rejected_dir = os.path.join(self.spool_dir, self.REJECTED_DIR)
+        os.makedirs(self.rejected_dir, exist_ok=True)
+        self._retry_thread = threading.Thread(target=self._retry_loop, name="asr-retry", daemon=True)
+        self._retry_thread.start()
+
+    def send(self, badge_id: str, start_time: int, pcm: np.ndarray, sample_rate: int):
+        # WAV is built here, so the caller is free to reuse its recording buffer right away
+        wav_bytes = build_wav(pcm, sample_rate)
+        self._executor.submit(self._deliver, badge_id, start_time, wav_bytes)
+
+    def close(self):
+        # Stops the retry thread, uploads already submitted are finished
+        self._closed.set()
+        self._retry_thread.join()
+        self._executor.shutdown()
+
+    def _post(self, badge_id, start_time, wav_bytes) -> int:
+        files = {
+            'file': (f"{badge_id}.wav", wav_bytes, "audio/wav")
+        }
+        with registry.time("vad_scanner_stage_seconds", "asr_post"):
+            response = self.session.post(self.url, files=files, data={"badge_id": badge_id, "time": start_time},
+                                         timeout=self.timeout)
+        if 400 <= response.status_code < 500:
+            logging.error(f"ASR rejected the audiofragment of badge {badge_id} with status {response.status_code}: "
+                          f"{response.text[:200]}")
+        else:
+            logging.info(f"Sent audiofragment, got status: {response.status_code}")
+        return response.status_code
+
+    def _deliver(self, badge_id, start_time, wav_bytes):
+        try:
+            status = self._post(badge_id, start_time, wav_bytes)
+            if status < 400:
+                return
+            if status < 500:
+                self._keep(self.rejected_dir, f"{time.time_ns()}-{badge_id}", wav_bytes,
+                           {"badge_id": badge_id, "time": start_time, "status": status})
+                return
+        except requests.RequestException as e:
+            logging.error(f"Can't send audiofragment to ASR with following exception: {e}")
+        except Exception:
+            logging.error("Can't send audiofragment to ASR, traceback:")
+            logging.error(traceback.format_exc())
+        self._spool(badge_id, start_time, wav_bytes)
+
+    def _spool(self, badge_id, start_time, wav_bytes):
+        self._keep(self.spool_dir, f"{time.time_ns()}-{badge_id}", wav_bytes,
+                   {"badge_id": badge_id, "time": start_time, "attempts": 0,
+                    "next_attempt": time.time() + self.RETRY_BASE})
+        logging.info(f"Spooled recording of badge {badge_id} for retry")
+
+    def _keep(self, directory, name, wav_bytes, meta):
+        with self._spool_lock:
+            entries = self._spool_entries(directory)
+            while len(entries) >= self.spool_limit:
+                oldest = entries.pop(0)
+                logging.warning(f"ASR spool {directory} is full, dropping recording {oldest}")
+                self._remove(oldest, directory)
+
+            with open(os.path.join(directory, f"{name}.wav"), "wb") as f:
+                f.write(wav_bytes)
+            self._write_meta(name, meta, directory)
+
+    def _spool_entries(self, directory=None):
+        return sorted(f[:-5] for f in os.listdir(directory or self.spool_dir) if f.endswith(".json"))
+
+    def _write_meta(self, name, meta, directory=None):
+        # Meta file is what marks the entry as complete, so it is written atomically
+        directory = directory or self.spool_dir
+        tmp_path = os.path.join(directory, f"{name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(directory, f"{name}.json"))
+
+    def _remove(self, name, directory=None):
+        for ext in (".json", ".wav"):
+            try:
+                os.remove(os.path.join(directory or self.spool_dir, name + ext))
+            except FileNotFoundError:
+                pass
+
+    def _recover_claims(self):
+        now = time.time()
+        for filename in os.listdir(self.spool_dir):
+            if not filename.endswith(".claim"):
+                continue
+            name, claimed, _ = filename.rsplit(".", 2)
+            if int(claimed) < now - self.CLAIM_TIMEOUT:
+                try:
+                    os.rename(os.path.join(self.spool_dir, filename), os.path.join(self.spool_dir, f"{name}.json"))
+                except FileNotFoundError:
+                    pass
+
+    def _retry_loop(self):
+        while not self._closed.wait(1):
+            try:
+                self._recover_claims()
+                with self._spool_lock:
+                    entries = self._spool_entries()
+                now = time.time()
+                for name in entries:
+                    path = os.path.join(self.spool_dir, f"{name}.json")
+                    try:
+                        with open(path) as f:
+                            meta = json.load(f)
+                    except FileNotFoundError:
+                        continue
+                    if meta["next_attempt"] > now:
+                        continue
+                    claim = os.path.join(self.spool_dir, f"{name}.{int(now)}.claim")
+                    try:
+                        os.rename(path, claim)
+                    except FileNotFoundError:
+                        continue
+                    self._executor.submit(self._retry, name, meta, claim)
+            except Exception:
+                logging.error("Can't scan ASR retry spool, traceback:")
+                logging.error(traceback.format_exc())
+
+    def _retry(self, name, meta, claim):
+        try:
+            with open(os.path.join(self.spool_dir, f"{name}.wav"), "rb") as f:
+                wav_bytes = f.read()
+            try:
+                status = self._post(meta["badge_id"], meta["time"], wav_bytes)
+            except requests.RequestException as e:
+                logging.error(f"Retry of spooled recording {name} failed: {e}")
+                status = None
+
+            if status is not None and 400 <= status < 500:
+                self._keep(self.rejected_dir, name, wav_bytes,
+                           {"badge_id": meta["badge_id"], "time": meta["time"], "status": status})
+            with self._spool_lock:
+                if status is not None and status < 500:
+                    self._remove(name)
+                elif os.path.exists(os.path.join(self.spool_dir, f"{name}.wav")):
+                    meta["attempts"] += 1
+                    meta["next_attempt"] = time.time() + min(self.RETRY_BASE * 2 ** meta["attempts"], self.RETRY_MAX)
+                    self._write_meta(name, meta)
+        except FileNotFoundError:
+            pass
+        finally:
+            try:
+                os.remove(claim)
+            except FileNotFoundError:
+                pass
@@ -1,34 +1,34 @@
-import wave
-
-import urllib3.exceptions
-
 from database import BadgesDB,Wakeword
-from vad import OnnxVADRuntime
-from model import BCResNet
+from vad import OnnxVADRuntime, EnergyGate
+from scheduler import InferenceScheduler
+from model import make_stream
+from features import IncrementalLogMel, shared_spectrogrammer, window_features
+from buffers import RingWindow, PCMArena
+from asr import ASRSender
+from metrics import registry
 
 import numpy as np
-import torchaudio
 import torch
-import requests
 
-import tempfile
 import logging
 import traceback
-import os
 
 from datetime import datetime
 
 class BadgeAudioHandler:
-    def __init__(self, db: BadgesDB, badge_id: str, config, model: BCResNet, device: torch.device):
+    def __init__(self, db: BadgesDB, badge_id: str, config, scheduler: InferenceScheduler):
         self.db = db
         self.id = badge_id
         self.config = config
-        self.chunk_size = int((config.sample_rate * config.window_duration) // 7)
+        self.chunk_size = self.chunk_samples(config)
 
-        self.detect_count = 0
+        # Certainty state of every wake-word, in the order of the scheduler model heads
+        self.wakewords = [(Wakeword[settings["name"]], settings) for settings in config.wakeword_settings()]
+        self.detect_counts = [0] * len(self.wakewords)
+        self.neg_samples_since_detect = [0] * len(self.wakewords)
         self.samples_since_vad = 0
         self.samples_since_activation = 0
-        self.neg_samples_since_detect = 0
+        self.wakeword = None
 
 
         self.vad_release_samples = config.sample_rate * config.vad_release
@@ -36,179 +36,358 @@ class BadgeAudioHandler:
 
         self.recording = False
 
-        self.window = np.zeros(int(config.window_duration*config.sample_rate),dtype=np.int16)
+        self._window = RingWindow(int(config.window_duration*config.sample_rate))
 
-        self.recording_buffer = b""
+        self.recording_buffer = PCMArena(int(config.sample_rate * (config.window_duration + config.vad_release)))
 
 
-        self.model = model
-        self.device = device
+        self.scheduler = scheduler
+        self._stream_model = scheduler.model
+        self.stream = make_stream(scheduler.model) if config.model_streaming else None
+        self._samples_since_features = None
+        self._features_shift = None
 
-        self.vad = OnnxVADRuntime(config.vad_model_path)
+        self._fragment = None
+        self._fragment_pos = 0
+        self._fragment_start_time = None
+        self._vad_only = False
+
+        self.vad = OnnxVADRuntime.from_config(config)
+        self.asr = ASRSender(config) if config.sr_url != "debug" else None
+        self.gate = EnergyGate(config.sample_rate, config.vad_gate_margin_db, config.vad_gate_zcr) \
+            if config.vad_gate else None
 
         self._reset_vad_state()
 
-        self.spectrogrammer = torch.nn.Sequential(
-            torchaudio.transforms.MelSpectrogram(
-                sample_rate=config.sample_rate,
-                n_fft=config.n_fft,
-                win_length=config.win_length,
-                hop_length=config.hop_length,
-                center=True,
-                pad_mode="reflect",
-                power=2.0,
-                norm='slaney',
-                onesided=True,
-                n_mels=config.n_mels,
-                mel_scale="htk",
-            )
-
-        )
+        self.spectrogrammer = shared_spectrogrammer(config)
+        self.frontend = IncrementalLogMel(self.spectrogrammer[0], self.window.size) \
+            if config.frontend_incremental else None
 
     def process_audiofragment(self, fragment: np.ndarray,filename:str):
+        self.start_fragment(fragment, filename)
+        while self.fragment_in_progress():
+            features = self.advance_chunk()
+            if features is not None:
+                try:
+                    future = self.submit_features(features)
+                    self.scheduler.flush()
+                    result = future.result()
+                except Exception:
+                    self.abort_fragment()
+                    continue
+                self.apply_score(result)
+
+    def start_fragment(self, fragment: np.ndarray, filename: str, vad_only: bool = False):
+        # vad_only fragments only keep the VAD state and running recordings going, the model isn't inferred on them
         logging.info(f"Starting processing fragment {filename} on badge {self.id}, duration {round(fragment.size/self.config.sample_rate,2)}")
 
-        vad_log_dirty = True
-        vad_log_start = -1
-
-        fragment_start_time = self.parse_time(filename)
-
+        self._fragment = fragment[0]
+        self._vad_only = vad_only
+        self._fragment_pos = 0
+        self._fragment_start_time = self.parse_time(filename)
+
+        self._vad_log_dirty = True
+        self._vad_log_start = -1
+
+    def fragment_in_progress(self):
+        return self._fragment is not None
+
+    def fragment_time(self) -> int:
+        # Recording time of the current position, by the fragment file name
+        return self._fragment_start_time + self._fragment_pos // self.config.sample_rate
+
+    def flush_recording(self):
+        # Finishes a recording still waiting for the VAD release, when no more audio will come
+        if self.recording:
+            self._finish_recording(self.fragment_time())
+
+    def snapshot(self, window: bool = True) -> dict:
+        # Detection state to resume the badge from in another handler, after eviction or a restart.
+        # Arrays are views of the handler buffers
+        return {"h": self._h, "c": self._c, "gate": self.gate.state() if self.gate is not None else None,
+                "detect_count": list(self.detect_counts), "samples_since_vad": self.samples_since_vad,
+                "samples_since_activation": self.samples_since_activation,
+                "neg_samples_since_detect": list(self.neg_samples_since_detect), "recording": self.recording,
+                "wakeword": self.wakeword.name if self.wakeword is not None else None,
+                "fragment_start_time": self._fragment_start_time, "fragment_pos": self._fragment_pos,
+                "window": self.window if window else None,
+                "recording_buffer": self.recording_buffer.view() if any(self.detect_counts) else None}
+
+    def park(self) -> dict:
+        # Compact state kept for an evicted handler, without the analysis window, a resumed handler starts
+        # with a silent window. The recording goes on in the resumed handler, not finished by this one
+        state = self.snapshot(window=False)
+        if state["recording_buffer"] is not None:
+            state["recording_buffer"] = state["recording_buffer"].copy()
+        self._reset_recording()
+        return state
+
+    def resume(self, state: dict):
+        self._h, self._c = np.array(state["h"]), np.array(state["c"])
+        if self.gate is not None and state["gate"] is not None:
+            self.gate.restore(state["gate"])
+        self.detect_counts = self._per_wakeword(state["detect_count"])
+        self.samples_since_vad = state["samples_since_vad"]
+        self.samples_since_activation = state["samples_since_activation"]
+        self.neg_samples_since_detect = self._per_wakeword(state["neg_samples_since_detect"])
+        self.recording = state["recording"]
+        wakeword = state.get("wakeword")
+        if wakeword in Wakeword.__members__:
+            self.wakeword = Wakeword[wakeword]
+        elif self.recording:
+            self.wakeword = self.wakewords[0][0]
+        self._fragment_start_time, self._fragment_pos = state["fragment_start_time"], state["fragment_pos"]
+        if state["window"] is not None:
+            self._window.push(state["window"])
+        if state["recording_buffer"] is not None:
+            self.recording_buffer.append(state["recording_buffer"])
+
+    def _per_wakeword(self, values) -> list:
+        # States written before several wake-words hold a single counter
+        if not isinstance(values, list):
+            values = [values]
+        return (values + [0] * len(self.wakewords))[:len(self.wakewords)]
+
+    def nbytes(self) -> int:
+        # Memory of the per-badge buffers
+        size = self._window.nbytes + self.recording_buffer.nbytes
+        if self.frontend is not None:
+            size += self.frontend.nbytes
+        if self.stream is not None:
+            size += self.stream.nbytes
+        return size
+
+    def advance_chunk(self):
+        # Runs one chunk of the current fragment up to the model call,
+        # returns window features when the model has to be inferred or None otherwise
+        chunk = self.next_chunk()
+        if chunk is None:
+            return None
         try:
-            i = 0
-            fragment = fragment[0]
-
-            while i < fragment.size:
-                chunk = fragment[i:i + self.chunk_size]
+            with registry.time("vad_scanner_stage_seconds", "vad"):
+                vad_res, h, c = self.vad(chunk, self._h, self._c)
+        except Exception:
+            self.abort_fragment()
+            return None
+        return self.apply_vad(vad_res, h, c)
+
+    def next_chunk(self):
+        # Moves to the next chunk of the current fragment and returns it as VAD input,
+        # None if the chunk was handled without VAD
+        try:
+            chunk = self._next_chunk().astype("float32")
+            if self.gate is not None:
+                if self.gate.is_silent(chunk):
+                    # Handled as unvoiced without the VAD call, the LSTM state stays as it was before the chunk
+                    registry.inc("vad_scanner_chunks_total", "gated")
+                    self._apply_vad(0.0)
+                    return None
+                registry.inc("vad_scanner_chunks_total", "vad")
+            return chunk
+        except Exception:
+            self.abort_fragment()
+            return None
+
+    def vad_state(self):
+        return self._h, self._c
+
+    def apply_vad(self, vad_res: float, h: np.ndarray, c: np.ndarray):
+        try:
+            self._h, self._c = h, c
+            return self._apply_vad(vad_res)
+        except Exception:
+            self.abort_fragment()
+            return None
+
+    def apply_score(self, result):
+        # result: score of the window, a list of scores with one per wake-word for WakewordHeads
+        try:
+            chunk = self._chunk
+            i = self._chunk_pos
+            scores = result if isinstance(result, list) else [result]
+
+            # logging.info(f"Inferred to {scores}")
+            detected = [index for index, (_, settings) in enumerate(self.wakewords)
+                        if scores[index] > settings["certainty_thresh"]]
+            if detected and not self.recording:
+                first = not any(self.detect_counts)
+                for index in detected:
+                    wakeword = self.wakewords[index][0]
+                    logging.info(f"Probable {wakeword.name}? result {scores[index]} on time {i/self.config.sample_rate}")
+                    self.detect_counts[index] += 1
+                    registry.inc("vad_scanner_detections_total", self.id, wakeword.name)
+                certain = [index for index in detected
+                           if self.detect_counts[index] >= self.wakewords[index][1]["certainty_detects"]]
+
+                if first:
+                    self.recording_buffer.clear()
+                    self.recording_buffer.append(self.window)
+                if certain:
+                    # Wake-words certain on the same window go to the most probable one
+                    self._start_recording(self.wakewords[max(certain, key=lambda index: scores[index])][0])
+                elif not first:
+                    self._append_rec_buffer(chunk)
 
-                self._roll_window(chunk)
+            for index, (_, settings) in enumerate(self.wakewords):
+                if self.detect_counts[index] > 0 and index not in detected:
+                    if self.neg_samples_since_detect[index] > settings["certainty_window"]:
+                        self.neg_samples_since_detect[index] += 1
+                    else:
+                        self.neg_samples_since_detect[index] = 0
+            self._end_chunk()
+        except Exception:
+            self.abort_fragment()
 
-                chunk_len = len(chunk)
+    def abort_fragment(self):
+        logging.error(f"Can't process audiofragment on badge {self.id}, exception:")
+        logging.error(traceback.format_exc())
+        self._fragment = None
 
-                self.samples_since_vad += chunk_len
-                self.samples_since_activation += chunk_len
+    def _next_chunk(self):
+        i = self._fragment_pos
+        chunk = self._fragment[i:i + self.chunk_size]
 
-                if self.recording:
-                    self._append_rec_buffer(chunk)
-                    if self.samples_since_vad > self.vad_release_samples:
-                        self._finish_recording(fragment_start_time + (i//self.config.sample_rate))
+        self._roll_window(chunk)
 
-                vad_res, self._h,self._c = self.vad(chunk.astype("float32"),self._h,self._c)
+        chunk_len = len(chunk)
 
-                #logging.debug(f"Checking fragment at {i}, samples since VAD: {self.samples_since_vad}, release: {self.vad_release_samples}, recording: {self.recording}")
-                if vad_res > self.config.vad_threshold:
+        self.samples_since_vad += chunk_len
+        self.samples_since_activation += chunk_len
 
-                    if vad_log_dirty:
-                        #logging.info(f"Found voice on time {i/self.config.sample_rate}")
-                        vad_log_start = i/self.config.sample_rate
-                        vad_log_dirty = False
+        if self.recording:
+            self._append_rec_buffer(chunk)
+            if self.samples_since_vad > self.vad_release_samples:
+                self._finish_recording(self.fragment_time())
 
-                    self.samples_since_vad = 0
+        self._chunk = chunk
+        self._chunk_pos = i
+        return chunk
 
-                    result = self._infer_window()
-                    # logging.info(f"Inferred to {result}")
-                    if result > self.config.certainty_thresh:
-                        if not self.recording:
+    def _apply_vad(self, vad_res: float):
+        i = self._chunk_pos
 
-                            logging.info(f"Probable greeting? result {result} on time {i/self.config.sample_rate}")
-                            # if self.recording:
-                            #     if self.samples_since_activation > self.activation_release_samples:
-                            #         self._finish_recording()
+        #logging.debug(f"Checking fragment at {i}, samples since VAD: {self.samples_since_vad}, release: {self.vad_release_samples}, recording: {self.recording}")
+        if vad_res > self.config.vad_threshold:
 
-                            self.detect_count += 1
+            if self._vad_log_dirty:
+                #logging.info(f"Found voice on time {i/self.config.sample_rate}")
+                self._vad_log_start = i/self.config.sample_rate
+                self._vad_log_dirty = False
 
-                            if self.detect_count == 1:
-                                self.recording_buffer = self.window.copy().tobytes()
-                            elif self.detect_count == self.config.certainty_detects:
-                                self._start_recording()
-                            else:
-                                self._append_rec_buffer(chunk)
+            self.samples_since_vad = 0
 
-                    else:
-                        if self.detect_count > 0:
-                            if self.neg_samples_since_detect > self.config.certainty_window:
-                                self.neg_samples_since_detect += 1
-                            else:
-                                self.neg_samples_since_detect = 0
-                else:
-                    if not vad_log_dirty:
-                        logging.info(f"Voice fragment from {vad_log_start} to {i/self.config.sample_rate}")
-                    vad_log_dirty = True
-                i += self.chunk_size
+            if self._vad_only:
+                self._end_chunk()
+                return None
+            return self._window_features()
+        else:
+            if not self._vad_log_dirty:
+                logging.info(f"Voice fragment from {self._vad_log_start} to {i/self.config.sample_rate}")
+            self._vad_log_dirty = True
+            self._end_chunk()
+            return None
+
+    def _end_chunk(self):
+        self._fragment_pos += self.chunk_size
+        if self._fragment_pos >= self._fragment.size:
+            self._fragment = None
             logging.info(f"Processed fragment on badge {self.id}")
-        except Exception as e:
-            logging.error(f"Can't process audiofragment on badge {self.id}, exception:")
-            logging.error(traceback.format_exc())
-
 
     def _reset_vad_state(self):
         self._h = np.zeros((2, 1, 64)).astype('float32')
         self._c = np.zeros((2, 1, 64)).astype('float32')
 
+    @property
+    def window(self) -> np.ndarray:
+        return self._window.view()
+
     def _roll_window(self, chunk):
         chunk_len = len(chunk)
-        self.window = np.roll(self.window, -chunk_len, 0)
-        self.window[-chunk_len:] = chunk
+        if self._samples_since_features is not None:
+            self._samples_since_features += chunk_len
+        self._window.push(chunk)
 
     def _append_rec_buffer(self,arr_slice):
-        self.recording_buffer += arr_slice.tobytes()
+        self.recording_buffer.append(arr_slice)
+
+    def _window_features(self):
+        with registry.time("vad_scanner_stage_seconds", "features"):
+            return self._compute_features()
 
-    def _infer_window(self):
+    def _compute_features(self):
+        self._features_shift = self._samples_since_features
+        self._samples_since_features = 0
+
+        if self.frontend is not None:
+            spec, spec_max = self.frontend(self.window, self._features_shift)
+            if self.stream is None:
+                return spec - spec_max
+            return spec.clone()
+
+        if self.stream is None:
+            return window_features(self.spectrogrammer, self.window)
         torchdata = torch.from_numpy(self.window).float()
-        spec = torch.log(self.spectrogrammer(torchdata) + 1e-8)
-        spec -= spec.max()
-        spec = spec.reshape(1, 1, *tuple(spec.shape))
+        return torch.log(self.spectrogrammer(torchdata) + 1e-8)
+
+    def submit_features(self, features: torch.Tensor):
+        if self.stream is None:
+            return self.scheduler.submit(features)
+
+        if self._stream_model is not self.scheduler.model:
+            # The model was swapped, cached layer outputs of the previous one are of no use
+            self._stream_model = self.scheduler.model
+            self.stream = make_stream(self._stream_model)
 
-        return torch.sigmoid(self.model(spec.to(self.device)))[0].item()
+        shift = None
+        if self._features_shift is not None and self._features_shift % self.config.hop_length == 0:
+            shift = self._features_shift // self.config.hop_length
+        return self.scheduler.submit_stream(self.stream, features, shift)
 
-    def _start_recording(self):
+    def _start_recording(self, wakeword: Wakeword):
         self.recording = True
+        self.wakeword = wakeword
         self.samples_since_activation = 0
-        logging.info(f"Found a keyword on badge {self.id}, started recording...")
+        logging.info(f"Found keyword {wakeword.name} on badge {self.id}, started recording...")
 
     def _finish_recording(self,start_time):
-        duration = (len(self.recording_buffer)/2)/16000
-        self.db.register_activation(self.id, Wakeword.Здравствуйте, duration)
+        duration = len(self.recording_buffer)/16000
+        self.db.register_activation(self.id, self.wakeword, duration)
+        registry.inc("vad_scanner_activations_total", self.id, self.wakeword.name)
         logging.info(
-            f"Finished a recording on badge {self.id}, wakeword: {0}, duration of speech: {duration}, timestamp: {start_time}")
+            f"Finished a recording on badge {self.id}, wakeword: {self.wakeword.name}, duration of speech: {duration}, timestamp: {start_time}")
 
 
-        with wave.open(f"/wav/{self.id}.wav","wb") as temp_wav_file:
-            temp_wav_file.setnchannels(1)
-            temp_wav_file.setsampwidth(2)
-            temp_wav_file.setframerate(16000)
-            temp_wav_file.writeframesraw(self.recording_buffer)
-        if self.config.sr_url != "debug":
-            with open(f"/wav/{self.id}.wav","rb") as fp:
-                try:
-                    files = {
-                        'file': fp
-                    }
-                    response = requests.post(self.config.sr_url, files=files,data={"badge_id":self.id,"time":start_time})
-                    logging.info(f"Sent audiofragment, got status: {response.status_code}")
-                except urllib3.exceptions.HTTPError as e:
-                    logging.error(f"Can't send audiofragment to ASR with following exception: {e}")
-                    logging.error(f"Traceback:")
-                    logging.error(traceback.format_exc())
+        if self.asr is not None:
+            self.asr.send(self.id, start_time, self.recording_buffer.view(), self.config.sample_rate)
         else:
             logging.info("DEBUG MODE, skipping fragment transmission")
 
         self._reset_recording()
 
-        os.remove(f"/wav/{self.id}.wav")
-
     def _reset_recording(self):
-        self.recording_buffer = b""
+        self.recording_buffer.clear()
         self.recording = False
-        self.detect_count = 0
+        self.wakeword = None
+        self.detect_counts = [0] * len(self.wakewords)
 
-    def __del__(self):
-        if len(self.recording_buffer) > 0:
-            self._finish_recording(datetime.now().timestamp())
+    @staticmethod
+    def chunk_samples(config) -> int:
+        chunk_size = int((config.sample_rate * config.window_duration) // 7)
+        if config.model_streaming or config.frontend_incremental:
+            # Spectrogram frames can be reused only when the window moves by whole hops
+            chunk_size -= chunk_size % config.hop_length
+        return chunk_size
 
     @staticmethod
-    def parse_time(recording_name: str):
+    def recording_start(recording_name: str):
+        # Start of the recording encoded in the fragment file name, None if the name isn't a timestamp
         datetime_str = recording_name.replace(".WAV","")
         try:
             return int(datetime.strptime(datetime_str, '%Y%m%d%H%M%S').timestamp())
         except ValueError:
-            return int(datetime.now().timestamp())
+            return None
+
+    @staticmethod
+    def parse_time(recording_name: str):
+        start = BadgeAudioHandler.recording_start(recording_name)
+        return start if start is not None else int(datetime.now().timestamp())
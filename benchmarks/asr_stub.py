@@ -0,0 +1,57 @@
+# Local stand-in for the ASR service, accepts the same multipart uploads as sr_url
+# and can inject latency and failures.
+#
+#   python -m benchmarks.asr_stub [--port 3030] [--latency_ms 50] [--fail_rate 0.2]
+
+import argparse
+import asyncio
+import logging
+import random
+import wave
+import io
+
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+import uvicorn
+
+
+def create_app(latency_ms: float = 0, fail_rate: float = 0):
+    app = FastAPI()
+    stats = {"received": 0, "failed": 0, "audio_seconds": 0.0, "badges": {}}
+
+    @app.post("/asrupload")
+    async def asr_upload(badge_id: str = Form(...), time: int = Form(...), file: UploadFile = File(...)):
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        if random.random() < fail_rate:
+            stats["failed"] += 1
+            raise HTTPException(status_code=503, detail="Injected failure")
+
+        data = await file.read()
+        with wave.open(io.BytesIO(data), "rb") as wav_file:
+            duration = wav_file.getnframes() / wav_file.getframerate()
+        stats["received"] += 1
+        stats["audio_seconds"] += duration
+        stats["badges"][badge_id] = stats["badges"].get(badge_id, 0) + 1
+        logging.info(f"Got recording of badge {badge_id}, time: {time}, duration: {round(duration, 2)}")
+        return {"status": "success"}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3030)
+    parser.add_argument("--latency_ms", type=float, default=0)
+    parser.add_argument("--fail_rate", type=float, default=0)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.latency_ms, args.fail_rate), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Per-chunk cost of the analysis window and recording buffers of BadgeAudioHandler
+# over a long voiced fragment, old np.roll/bytes implementation against RingWindow/PCMArena.
+#
+#   python -m benchmarks.buffers [--seconds 60]
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from buffers import RingWindow, PCMArena
+
+
+class RollBuffers:
+    def __init__(self, window_size, capacity):
+        self.window = np.zeros(window_size, dtype=np.int16)
+        self.recording_buffer = b""
+
+    def step(self, chunk):
+        self.window = np.roll(self.window, -len(chunk), 0)
+        self.window[-len(chunk):] = chunk
+        self.recording_buffer += chunk.tobytes()
+
+
+class ArenaBuffers:
+    def __init__(self, window_size, capacity):
+        self.window = RingWindow(window_size)
+        self.recording_buffer = PCMArena(capacity)
+
+    def step(self, chunk):
+        self.window.push(chunk)
+        self.recording_buffer.append(chunk)
+
+
+def run(buffers_class, fragment, window_size, chunk_size, capacity):
+    buffers = buffers_class(window_size, capacity)
+    chunks = [fragment[i:i + chunk_size] for i in range(0, fragment.size, chunk_size)]
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    allocated = 0
+    for chunk in chunks:
+        snapshot_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        buffers.step(chunk)
+        allocated += tracemalloc.get_traced_memory()[1] - snapshot_size
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+
+    return elapsed / len(chunks), allocated / len(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=60)
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    parser.add_argument("--window_duration", type=float, default=1.7)
+    parser.add_argument("--vad_release", type=float, default=7)
+    args = parser.parse_args()
+
+    window_size = int(args.window_duration * args.sample_rate)
+    chunk_size = window_size // 7
+    capacity = int(args.sample_rate * (args.window_duration + args.vad_release))
+    fragment = np.random.default_rng(0).integers(-3000, 3000, args.seconds * args.sample_rate, dtype=np.int16)
+
+    print(f"Fragment: {args.seconds} s, chunk: {chunk_size} samples, window: {window_size} samples")
+    for name, buffers_class in (("np.roll + bytes", RollBuffers), ("RingWindow + PCMArena", ArenaBuffers)):
+        # Timing and allocation tracing in separate runs, tracemalloc slows allocations down
+        per_chunk, _ = run(buffers_class, fragment, window_size, chunk_size, capacity)
+        _, allocated = run(buffers_class, fragment, window_size, chunk_size, capacity)
+        print(f"{name}: {1e6 * per_chunk:.1f} us per chunk, {allocated / 1024:.1f} KB allocated per chunk")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Bandwidth of badge fragments as 16-bit PCM WAV, FLAC and Opus against the CPU the server spends decoding them,
+# scaled to a fleet of badges uploading continuously. Decoded audio is compared with the original by SNR and by
+# the VAD decisions of its chunks. Needs soundfile (libsndfile >= 1.0.29 for Opus) to encode the fragments.
+#
+#   python -m benchmarks.codecs [--badges 1000] [--opus_levels 0.5 0.9] [--workers 2]
+
+import argparse
+import io
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import soundfile
+
+import decoding
+from benchmarks.fleet import SAMPLE_RATE, make_fragments
+from config import Config
+from vad import OnnxVADRuntime
+
+
+def encode(audio, codec, level):
+    f = io.BytesIO()
+    if codec == "flac":
+        soundfile.write(f, audio, SAMPLE_RATE, format="FLAC", subtype="PCM_16", compression_level=level)
+    else:
+        soundfile.write(f, audio, SAMPLE_RATE, format="OGG", subtype="OPUS", compression_level=level)
+    return f.getvalue()
+
+
+def decode(data):
+    # What /upload does with the fragment, without the event loop
+    parsed = decoding.parse_pcm_wav(data)
+    if parsed is not None:
+        return parsed
+    return decoding.decode_compressed(data)
+
+
+def vad_decisions(config, vad, audio):
+    chunk_size = int((config.sample_rate * config.window_duration) // 7)
+    h = c = np.zeros((2, 1, 64), dtype="float32")
+    decisions = []
+    for start in range(0, len(audio) - chunk_size + 1, chunk_size):
+        out, h, c = vad(audio[start:start + chunk_size].astype("float32"), h, c)
+        decisions.append(out > config.vad_threshold)
+    return np.array(decisions)
+
+
+def snr_db(reference, decoded):
+    reference, decoded = reference.astype(np.float64), decoded[:len(reference)].astype(np.float64)
+    noise = np.sum((reference - decoded) ** 2)
+    return float("inf") if noise == 0 else 10 * np.log10(np.sum(reference ** 2) / noise)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--badges", type=int, default=1000, help="Badges uploading continuously")
+    parser.add_argument("--fragment_seconds", type=float, default=10)
+    parser.add_argument("--per_kind", type=int, default=8, help="Fragments of each kind of audio")
+    parser.add_argument("--flac_levels", type=float, nargs="*", default=[0.5])
+    parser.add_argument("--opus_levels", type=float, nargs="*", default=[0.5, 0.9],
+                        help="libsndfile compression levels, lower is a higher bitrate")
+    parser.add_argument("--workers", type=int, help="Decoding threads, decode_workers by default")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    workers = args.workers or config.decode_workers
+    vad = OnnxVADRuntime(config.vad_model_path, config.vad_max_batch)
+    wavs = [wav for kind in make_fragments({"speech": 1, "silence": 1, "wakeword": 1}, args.fragment_seconds,
+                                           args.per_kind).values() for wav in kind]
+    originals = [decoding.parse_pcm_wav(wav)[0][0] for wav in wavs]
+    audio_seconds = sum(len(audio) for audio in originals) / SAMPLE_RATE
+    reference = [vad_decisions(config, vad, audio) for audio in originals]
+
+    variants = [("wav", None, wavs)]
+    variants += [("flac", level, [encode(audio, "flac", level) for audio in originals]) for level in args.flac_levels]
+    variants += [("opus", level, [encode(audio, "opus", level) for audio in originals]) for level in args.opus_levels]
+
+    print(f"{len(wavs)} fragments of {args.fragment_seconds} s, {args.badges} badges, {workers} decoding threads")
+    print(f"{'codec':12s} {'kbit/s':>8s} {'fleet Mbit/s':>13s} {'decode ms/s':>12s} {'fleet cores':>12s} "
+          f"{'pool x RT':>10s} {'SNR dB':>8s} {'VAD agree':>10s}")
+    for codec, level, fragments in variants:
+        rate = sum(len(data) for data in fragments) / audio_seconds
+        started = time.process_time()
+        decoded = [decode(data)[0][0] for data in fragments]
+        cpu = (time.process_time() - started) / audio_seconds
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            started = time.perf_counter()
+            list(pool.map(decode, fragments))
+            realtime = audio_seconds / (time.perf_counter() - started)
+        snr = np.mean([snr_db(original, audio) for original, audio in zip(originals, decoded)])
+        agree = np.mean(np.concatenate([decisions == vad_decisions(config, vad, audio)[:len(decisions)]
+                                        for decisions, audio in zip(reference, decoded)]))
+        name = codec if level is None else f"{codec}@{level}"
+        print(f"{name:12s} {8 * rate / 1000:8.1f} {args.badges * 8 * rate / 1e6:13.1f} {1000 * cpu:12.3f} "
+              f"{args.badges * cpu:12.2f} {realtime:10.0f} {snr:8.1f} {100 * agree:9.1f}%")
+
+
+if __name__ == "__main__":
+    main()
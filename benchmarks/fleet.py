@@ -0,0 +1,362 @@
+# End-to-end load test: N simulated badges post WAV fragments (speech-like, silence and wake-word-like audio)
+# to /upload of a vadserver at real-time pace. Reports how far the server keeps up: processed audio against
+# the offered load, real-time factor, backlog of fragments, fragment-to-decision latency and CPU per badge.
+#
+#   python -m benchmarks.fleet [--badges 32] [--duration 60] [--fragment_seconds 10] [--set workers=2 ...]
+#
+# By default the server is started locally from config.yml with an in-memory SQLite stand-in for Postgres
+# and benchmarks/asr_stub.py as the ASR endpoint, --url points the load at an already running server instead
+# (its badges badge0..badgeN-1 have to be registered and enabled).
+
+import argparse
+import datetime
+import os
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import requests
+import yaml
+
+from asr import build_wav
+import database
+from fragment_queue import FragmentQueue
+from handler_cache import HandlerCache
+
+SAMPLE_RATE = 16000
+
+
+def _noise(seconds, rng, level=30.0):
+    return rng.normal(0, level, int(seconds * SAMPLE_RATE))
+
+
+def _syllable(seconds, f0, rng):
+    # Voiced syllable: harmonics of a gliding f0 under a smooth envelope
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    glide = f0 * (1 + rng.uniform(-0.15, 0.15) * t / max(seconds, 1e-3))
+    phase = 2 * np.pi * np.cumsum(glide) / SAMPLE_RATE
+    wave = sum(np.sin(k * phase) / k for k in range(1, 7))
+    return wave * np.hanning(len(t)) * rng.uniform(2000, 6000)
+
+
+def _place(audio, start, part):
+    if start >= len(audio):
+        return
+    end = min(start + len(part), len(audio))
+    audio[start:end] += part[:end - start]
+
+
+def speech_like(seconds, rng):
+    audio = _noise(seconds, rng)
+    pos = int(rng.uniform(0, 0.5) * SAMPLE_RATE)
+    f0 = rng.uniform(90, 250)
+    while pos < len(audio):
+        syllable = _syllable(rng.uniform(0.12, 0.3), f0 * rng.uniform(0.85, 1.15), rng)
+        _place(audio, pos, syllable)
+        pos += len(syllable) + int(rng.uniform(0.04, 0.15) * SAMPLE_RATE)
+        if rng.random() < 0.15:
+            pos += int(rng.uniform(0.3, 1.0) * SAMPLE_RATE)
+    return audio
+
+
+def silence(seconds, rng):
+    return _noise(seconds, rng)
+
+
+def wakeword_like(seconds, rng):
+    # Short greeting-like words of four syllables separated by silence
+    audio = _noise(seconds, rng)
+    pos = int(rng.uniform(0.5, 2) * SAMPLE_RATE)
+    while pos < len(audio):
+        f0 = rng.uniform(100, 220)
+        for contour in (1.0, 1.1, 1.2, 0.9):
+            syllable = _syllable(rng.uniform(0.15, 0.25), f0 * contour, rng)
+            _place(audio, pos, syllable)
+            pos += len(syllable) + int(0.03 * SAMPLE_RATE)
+        pos += int(rng.uniform(2, 5) * SAMPLE_RATE)
+    return audio
+
+
+GENERATORS = {"speech": speech_like, "silence": silence, "wakeword": wakeword_like}
+
+
+def make_fragments(mix: dict, seconds: float, per_kind: int, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    fragments = {}
+    for kind in mix:
+        fragments[kind] = [build_wav(np.clip(GENERATORS[kind](seconds, rng), -32768, 32767).astype(np.int16),
+                                     SAMPLE_RATE) for _ in range(per_kind)]
+    return fragments
+
+
+class SQLiteBadgesDB:
+    """
+    Stand-in for BadgesDB on an in-memory SQLite database, badges badge0..badgeN-1 are registered and enabled
+    """
+
+    def __init__(self, badges: int):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        with open("create_queries.sql") as f:
+            self.conn.executescript(f.read())
+        self._enabled = {f"badge{index}": True for index in range(badges)}
+        self.conn.executemany("INSERT INTO Badges VALUES (?,?,0,1)",
+                              [(badge_id, datetime.datetime.now().isoformat()) for badge_id in self._enabled])
+        self.conn.commit()
+
+    def register_activation(self, badge_id, wakeword, duration):
+        with self._lock:
+            self.conn.execute("INSERT INTO Activations VALUES (?,?,?,?)",
+                              (badge_id, datetime.datetime.now().isoformat(), wakeword.value, duration))
+            self.conn.execute("UPDATE Badges SET Activations = Activations + 1 WHERE BadgeID = ?", (badge_id,))
+            self.conn.commit()
+
+    @property
+    def activations(self):
+        # Activations are written at once, there is no write-behind sink to flush
+        return self
+
+    def flush(self, timeout=None):
+        return True
+
+    def badge_exists(self, badge_id):
+        return badge_id in self._enabled
+
+    def badge_enabled(self, badge_id):
+        if badge_id not in self._enabled:
+            raise database.BadgeNotFoundException(f"Badge {badge_id} does not exist")
+        return self._enabled[badge_id]
+
+    def _set_enabled(self, badge_id, enabled, exception):
+        if self.badge_enabled(badge_id) == enabled:
+            raise exception(f"Badge {badge_id} already {'enabled' if enabled else 'disabled'}!")
+        self._enabled[badge_id] = enabled
+
+    def enable_badge(self, badge_id):
+        self._set_enabled(badge_id, True, database.BadgeAlreadyEnabled)
+
+    def disable_badge(self, badge_id):
+        self._set_enabled(badge_id, False, database.BadgeAlreadyDisabled)
+
+    def get_active_badges(self):
+        return [badge_id for badge_id, enabled in self._enabled.items() if enabled]
+
+
+def serve(args):
+    # Runs the service like launcher.py does, with the SQLite stand-in instead of Postgres
+    import logging
+    import fast_api
+    import snapshots
+    import worker
+
+    logging.basicConfig(level=logging.WARNING)
+    database.init_db = lambda config: SQLiteBadgesDB(args.badges)
+    config = fast_api.init_config()
+    fragments_queue = FragmentQueue.from_config(config)
+    active_badges = HandlerCache.from_config(config)
+    consumer = threading.Thread(target=worker.process_badge_fragment, daemon=True,
+                                args=(fragments_queue, active_badges, config, snapshots.snapshot_path(config)))
+    if config.workers == 0:
+        consumer.start()
+    fast_api.main(config, fragments_queue, active_badges)
+    if config.workers == 0:
+        consumer.join()
+
+
+def _cpu_seconds(pid: int) -> float:
+    # CPU time of the process and its children (fragment workers), Linux only
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            total += (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+
+def _start_local(args, tmp):
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    config.update({"sr_url": f"http://127.0.0.1:{args.port + 1}/asrupload", "api_port": args.port,
+                   "asr_spool_dir": os.path.join(tmp, "asr_spool"),
+                   "activation_spool_dir": os.path.join(tmp, "activations")})
+    for item in args.set:
+        key, value = item.split("=", 1)
+        config[key] = yaml.safe_load(value)
+    path = os.path.join(tmp, "config.yml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+
+    log = open(os.path.join(tmp, "server.log"), "w")
+    stub = subprocess.Popen([sys.executable, "-m", "benchmarks.asr_stub", "--port", str(args.port + 1)],
+                            stdout=log, stderr=log)
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.fleet", "--serve", "--badges", str(args.badges)],
+                              env={**os.environ, "CONFIG": path}, stdout=log, stderr=log)
+    return stub, server
+
+
+def _wait_ready(url, process, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise SystemExit("Server exited during startup, see server.log")
+        try:
+            requests.get(f"{url}/ping", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.5)
+    raise SystemExit("Server didn't start in time")
+
+
+def _badge_loop(url, badge_id, fragments, kinds, weights, args, start, results, rng):
+    session = requests.Session()
+    interval = args.fragment_seconds / args.realtime
+    # Badges are spread evenly over the upload interval
+    next_upload = start + interval * int(badge_id[5:]) / args.badges
+    while next_upload < start + args.duration:
+        time.sleep(max(next_upload - time.monotonic(), 0))
+        kind = kinds[rng.choice(len(kinds), p=weights)]
+        data = fragments[kind][rng.integers(len(fragments[kind]))]
+        # Named by the start of the recording, as the badges do, the fragment has just been recorded
+        recorded = datetime.datetime.now() - datetime.timedelta(seconds=args.fragment_seconds)
+        filename = recorded.strftime("%Y%m%d%H%M%S") + ".WAV"
+        sent = time.monotonic()
+        try:
+            response = session.post(f"{url}/upload", data={"BadgeID": badge_id},
+                                    files={"upload_file": (filename, data, "audio/wav")}, timeout=30)
+            status = response.status_code
+        except requests.RequestException:
+            status = "error"
+        results.append((status, time.monotonic() - sent))
+        next_upload += interval
+
+
+def _stats(url):
+    stats = requests.get(f"{url}/stats", timeout=10).json()
+    return stats.get("fragments") or stats.get("workers")
+
+
+def _shed(url):
+    # Shed fragment counters by action from /metrics
+    shed = {}
+    for line in requests.get(f"{url}/metrics", timeout=10).text.splitlines():
+        if line.startswith("vad_scanner_shed_fragments_total{"):
+            labels, value = line.rsplit(" ", 1)
+            shed[labels.split('"')[1]] = float(value)
+    return shed
+
+
+def run(args):
+    mix = dict((kind, float(weight)) for kind, weight in (item.split("=") for item in args.mix.split(",")))
+    kinds = list(mix)
+    weights = np.array([mix[kind] for kind in kinds])
+    weights /= weights.sum()
+    fragments = make_fragments(mix, args.fragment_seconds, args.variants)
+
+    tmp = tempfile.mkdtemp(prefix="fleet-")
+    stub = server = None
+    url = args.url
+    if url is None:
+        stub, server = _start_local(args, tmp)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        _wait_ready(url, server)
+        before = _stats(url)
+        shed_before = _shed(url)
+        cpu_before = _cpu_seconds(server.pid) if server else None
+
+        results = []
+        start = time.monotonic()
+        threads = [threading.Thread(target=_badge_loop, daemon=True,
+                                    args=(url, f"badge{index}", fragments, kinds, weights, args, start, results,
+                                          np.random.default_rng(index)))
+                   for index in range(args.badges)]
+        for thread in threads:
+            thread.start()
+
+        backlog = []
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+            backlog.append(_stats(url)["backlog"])
+        loaded = time.monotonic() - start
+
+        accepted = sum(1 for status, _ in results if status == 202)
+        drain_deadline = time.monotonic() + args.drain_timeout
+        stats = _stats(url)
+        shed = _shed(url)
+        # Accepted fragments are done once processed or dropped from the queue
+        while (stats["fragments"] - before["fragments"] + shed.get("dropped", 0) - shed_before.get("dropped", 0)
+               < accepted and time.monotonic() < drain_deadline):
+            time.sleep(1)
+            stats = _stats(url)
+            shed = _shed(url)
+        elapsed = time.monotonic() - start
+        cpu = _cpu_seconds(server.pid) - cpu_before if server else None
+    finally:
+        for process in (server, stub):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    upload_ms = 1000 * np.array([latency for _, latency in results]) if results else np.zeros(1)
+    processed = stats["fragments"] - before["fragments"]
+    audio = stats["audio_seconds"] - before["audio_seconds"]
+
+    print(f"Badges: {args.badges}, fragments of {args.fragment_seconds} s at {args.realtime}x real time "
+          f"for {args.duration} s, mix: {args.mix}")
+    print(f"Uploads: {len(results)} {statuses}, upload latency p50 {np.percentile(upload_ms, 50):.1f} ms, "
+          f"p99 {np.percentile(upload_ms, 99):.1f} ms")
+    print(f"Processed: {processed} of {accepted} fragments, {audio:.0f} s of audio in {elapsed:.1f} s, "
+          f"{audio / elapsed:.1f}x real time against {args.badges * args.realtime:.1f}x offered")
+    shed = {action: int(count - shed_before.get(action, 0)) for action, count in shed.items()}
+    if any(shed.values()):
+        print(f"Shed under overload: {shed}")
+    if backlog:
+        print(f"Backlog during load: mean {np.mean(backlog):.1f}, max {max(backlog)} fragments, "
+              f"after load: {stats['backlog']} after {elapsed - loaded:.1f} s of draining")
+    if stats["latency_p50_ms"] is not None:
+        print(f"Fragment-to-decision latency (recent fragments): p50 {stats['latency_p50_ms']:.0f} ms, "
+              f"p99 {stats['latency_p99_ms']:.0f} ms")
+    if cpu is not None and audio:
+        print(f"Server CPU: {cpu:.1f} s, real-time factor {cpu / audio:.4f} CPU s per audio s, "
+              f"{cpu / elapsed / args.badges:.4f} cores per badge")
+    print(f"Server log: {os.path.join(tmp, 'server.log')}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--url", help="Load an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8120, help="Port of the local server, the ASR stub uses port + 1")
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides of the local server, key=value")
+    parser.add_argument("--badges", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of load")
+    parser.add_argument("--fragment_seconds", type=float, default=10)
+    parser.add_argument("--realtime", type=float, default=1.0, help="Upload pace relative to real time")
+    parser.add_argument("--mix", default="speech=0.5,silence=0.3,wakeword=0.2")
+    parser.add_argument("--variants", type=int, default=4, help="Pregenerated fragments per kind of audio")
+    parser.add_argument("--drain_timeout", type=float, default=60)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Compares time per detection step of IncrementalLogMel and the full-window MelSpectrogram front-end of
+# BadgeAudioHandler, the tolerance between them is asserted in tests/test_frontend.py.
+#
+#   python -m benchmarks.frontend [--config config.yml] [--steps 500]
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from config import Config
+from features import IncrementalLogMel, make_spectrogrammer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--steps", type=int, default=500)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    config = Config(args.config)
+    spectrogrammer = make_spectrogrammer(config)[0]
+
+    window_size = int(config.window_duration * config.sample_rate)
+    chunk = window_size // 7
+    chunk -= chunk % config.hop_length
+
+    rng = np.random.default_rng(0)
+    gains = np.repeat(rng.uniform(0.01, 2, args.steps + 8), chunk)
+    audio = (rng.standard_normal(gains.size) * 3000 * gains).astype(np.int16)
+
+    frontend = IncrementalLogMel(spectrogrammer, window_size)
+    window = np.zeros(window_size, dtype=np.int16)
+    full_time = incremental_time = 0.0
+    max_diff = max_max_diff = 0.0
+
+    for step in range(args.steps):
+        window = np.roll(window, -chunk)
+        window[-chunk:] = audio[step * chunk:(step + 1) * chunk]
+
+        started = time.perf_counter()
+        spec = torch.log(spectrogrammer(torch.from_numpy(window).float()) + 1e-8)
+        spec_max = spec.max()
+        full_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        view, view_max = frontend(window, chunk if step else None)
+        incremental_time += time.perf_counter() - started
+
+        max_diff = max(max_diff, (spec - view).abs().max().item())
+        max_max_diff = max(max_max_diff, abs(spec_max.item() - view_max))
+
+    print(f"Steps: {args.steps}, chunk: {chunk} samples, window: {frontend.frames} frames")
+    print(f"Max log-mel difference: {max_diff:.3g}, max window max difference: {max_max_diff:.3g}")
+    print(f"Time per step: full {1000 * full_time / args.steps:.3f} ms, "
+          f"incremental {1000 * incremental_time / args.steps:.3f} ms, ratio {full_time / incremental_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Checks BCResNet.fuse_for_inference() against the original model and breaks the latency of both
+# down by top-level layer.
+#
+#   python -m benchmarks.fused_model [--checkpoints ...] [--batch_size 1] [--repeats 200]
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.onnx_backend import load_model, make_inputs
+
+TOLERANCE = 1e-4
+
+
+def logits(model, x):
+    # Output of conv4 before the sigmoid, which saturates for confident windows
+    captured = {}
+    handle = model.conv4.register_forward_hook(lambda module, inputs, output: captured.setdefault("out", output))
+    with torch.inference_mode():
+        model(x)
+    handle.remove()
+    return captured["out"]
+
+
+def layer_times(model, x, repeats):
+    # Mean milliseconds per forward spent in every top-level layer, measured with forward hooks
+    totals = {}
+    started = {}
+    handles = []
+    for name, module in model.named_children():
+        def pre(module, inputs, name=name):
+            started[name] = time.perf_counter()
+
+        def post(module, inputs, output, name=name):
+            totals[name] = totals.get(name, 0.0) + time.perf_counter() - started[name]
+
+        handles.append(module.register_forward_pre_hook(pre))
+        handles.append(module.register_forward_hook(post))
+
+    with torch.inference_mode():
+        model(x)
+        totals.clear()
+        begin = time.perf_counter()
+        for _ in range(repeats):
+            model(x)
+        total = time.perf_counter() - begin
+    for handle in handles:
+        handle.remove()
+    return {name: 1000 * t / repeats for name, t in totals.items()}, 1000 * total / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", nargs="+",
+                        default=["weights/model_greeting100/model.pt", "weights/happy98/model.pt"])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    inputs = make_inputs(max(args.batch_size, 16))
+    inputs = inputs - inputs.amax((2, 3), keepdim=True)
+    failed = False
+
+    for path in args.checkpoints:
+        model = load_model(path)
+        fused = model.fuse_for_inference()
+
+        diff = (logits(model, inputs) - logits(fused, inputs)).abs().max().item()
+        failed |= diff > TOLERANCE
+        print(f"{path}: max logit difference {diff:.2e}")
+
+        x = inputs[:args.batch_size]
+        original_layers, original_total = layer_times(model, x, args.repeats)
+        fused_layers, fused_total = layer_times(fused, x, args.repeats)
+        print(f"  {'layer':10s} {'original ms':>12s} {'fused ms':>10s}")
+        for name in original_layers:
+            print(f"  {name:10s} {original_layers[name]:12.3f} {fused_layers[name]:10.3f}")
+        print(f"  {'forward':10s} {original_total:12.3f} {fused_total:10.3f}   speedup {original_total / fused_total:.2f}x")
+
+    if failed:
+        raise SystemExit(f"Fused model logits differ by more than {TOLERANCE}")
+
+
+if __name__ == "__main__":
+    main()
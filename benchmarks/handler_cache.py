@@ -0,0 +1,104 @@
+# Memory and startup time of badge handlers created eagerly, as before HandlerCache, against lazily created
+# ones under a memory budget, and activations of a replay where every handler is evicted between its fragments
+# against one that keeps them all.
+#
+#   python -m benchmarks.handler_cache [--badges 2000] [--active 200] [--set frontend_incremental=true ...]
+
+import argparse
+import os
+import tempfile
+import time
+
+from collections import deque
+
+import yaml
+
+import fast_api
+import reprocess
+import worker
+from audio_handler import BadgeAudioHandler
+from benchmarks.vad_gate import matched, synthetic_archive
+from config import Config
+from decoding import load_audio
+from handler_cache import HandlerCache
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096 / 2 ** 20
+
+
+def startup(config, scheduler, badges, active, budget):
+    make_handler = lambda badge_id: BadgeAudioHandler(None, badge_id, config, scheduler)
+    # Lazy first, so it doesn't get the memory the eager handlers freed
+    before, started = rss_mb(), time.perf_counter()
+    cache = HandlerCache(make_handler, budget)
+    for index in range(badges):
+        cache.enable(f"badge{index}")
+    lazy_time = time.perf_counter() - started
+    for index in range(active):
+        cache[f"badge{index}"]
+    lazy_mb = rss_mb() - before
+
+    before, started = rss_mb(), time.perf_counter()
+    eager = {f"badge{index}": make_handler(f"badge{index}") for index in range(badges)}
+    eager_time, eager_mb = time.perf_counter() - started, rss_mb() - before
+    return eager_time, eager_mb, lazy_time, lazy_mb
+
+
+def replay(config, scheduler, files, budget):
+    # Badges take turns with one fragment each, so a tight budget evicts every handler between its fragments
+    log = reprocess.ActivationLog()
+    cache = HandlerCache(lambda badge_id: BadgeAudioHandler(log, badge_id, config, scheduler), budget)
+    log.handlers = cache
+    pending = {badge_id: deque(paths) for badge_id, paths in files.items()}
+    for badge_id in pending:
+        cache.enable(badge_id)
+    while any(pending.values()):
+        for badge_id, paths in pending.items():
+            if paths:
+                path = paths.popleft()
+                handler = cache[badge_id]
+                handler.start_fragment(load_audio(path, config.sample_rate).reshape(1, -1), os.path.basename(path))
+                while handler.fragment_in_progress():
+                    worker.advance([handler])
+    for badge_id in files:
+        cache[badge_id].flush_recording()
+    return {(badge_id, activated, duration) for badge_id, activated, _, duration in log.rows}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--badges", type=int, default=2000, help="Enabled badges")
+    parser.add_argument("--active", type=int, default=200, help="Badges that send audio")
+    parser.add_argument("--replay_badges", type=int, default=8)
+    parser.add_argument("--fragments", type=int, default=20, help="10 s fragments per badge of the replay")
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides, key=value")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    for item in args.set:
+        key, value = item.split("=", 1)
+        setattr(config, key, yaml.safe_load(value))
+    config.sr_url = "debug"
+    scheduler = fast_api.init_scheduler(config, *fast_api.init_model(config))
+    BadgeAudioHandler(None, "warmup", config, scheduler)
+
+    budget = int(config.handler_memory_mb * 2 ** 20)
+    eager_time, eager_mb, lazy_time, lazy_mb = startup(config, scheduler, args.badges, args.active, budget)
+    print(f"{args.badges} enabled badges, eager handlers: {eager_time:.2f} s, {eager_mb:.0f} MB resident; "
+          f"lazy: {lazy_time * 1000:.1f} ms, {lazy_mb:.0f} MB once {args.active} badges sent audio")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic_archive(tmp, args.replay_badges, args.fragments)
+        files = reprocess.archive_files(tmp)
+        reference = replay(config, scheduler, files, 0)
+        evicted = replay(config, scheduler, files, 1)
+    print(f"Replay of {args.replay_badges} badges: {len(reference)} activations keeping every handler, "
+          f"{len(evicted)} evicting them between fragments, {len(reference - matched(reference, evicted))} lost, "
+          f"{len(evicted - matched(evicted, reference))} gained")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# Swaps the wake-word model and the VAD through ModelRegistry while badges are being processed and reports the
+# load, warm-up and validation timings, the fragment worker ticks during the swap against the ones before it,
+# and the first batch of a model without warm-up against one after it.
+#
+#   python -m benchmarks.model_swap [--model weights/happy98/model.pt] [--badges 16] [--set model_golden_dir=...]
+#
+# Without model_golden_dir a synthetic golden set is written and the accuracy is only reported
+# (model_golden_min_accuracy=0), the synthetic wake-word is not one the models know.
+
+import argparse
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+import yaml
+
+import fast_api
+import worker
+from asr import build_wav
+from audio_handler import BadgeAudioHandler
+from benchmarks.fleet import GENERATORS, SAMPLE_RATE
+from config import Config
+from model_registry import ModelRegistry, init_model, window_frames
+
+
+def golden_set(path, config, clips=8, seed=0):
+    rng = np.random.default_rng(seed)
+    for label, kind in ((config.wakeword_settings()[0]["name"], "wakeword"), ("negative", "silence")):
+        os.makedirs(os.path.join(path, label))
+        for index in range(clips):
+            audio = np.clip(GENERATORS[kind](2, rng), -32768, 32767).astype(np.int16)
+            with open(os.path.join(path, label, f"{index}.wav"), "wb") as f:
+                f.write(build_wav(audio, SAMPLE_RATE))
+
+
+def first_batch(config, warm):
+    # Time of the first batch of a freshly loaded model
+    model, _ = init_model(config)
+    if warm:
+        scheduler = fast_api.init_scheduler(config, model, torch.device("cpu"))
+        ModelRegistry.from_config(config, scheduler).warm_up()
+    spec = torch.randn(config.infer_max_batch, 1, config.n_mels, window_frames(config))
+    started = time.perf_counter()
+    with torch.inference_mode():
+        model(spec)
+    return time.perf_counter() - started
+
+
+def process(config, scheduler, badges, stop, ticks):
+    # Badges send fragments back to back, every tick is timed
+    rng = np.random.default_rng(1)
+    handlers = [BadgeAudioHandler(None, f"badge{index}", config, scheduler) for index in range(badges)]
+    start = datetime.datetime(2022, 3, 1, 9, 0, 0)
+    fragment = 0
+    while not stop.is_set():
+        name = (start + datetime.timedelta(seconds=10 * fragment)).strftime("%Y%m%d%H%M%S") + ".WAV"
+        for handler in handlers:
+            audio = np.clip(GENERATORS["speech"](10, rng), -32768, 32767).astype(np.int16)
+            handler.start_fragment(audio.reshape(1, -1), name)
+        while not stop.is_set() and any(handler.fragment_in_progress() for handler in handlers):
+            started = time.perf_counter()
+            worker.advance([handler for handler in handlers if handler.fragment_in_progress()])
+            ticks.append((started, time.perf_counter() - started))
+        fragment += 1
+
+
+def describe(durations):
+    durations = 1000 * np.array(durations)
+    return f"{len(durations)} ticks, p50 {np.percentile(durations, 50):.1f} ms, max {durations.max():.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--model", default="weights/happy98/model.pt", help="Checkpoint to swap in")
+    parser.add_argument("--vad_model", help="VAD model to swap in, the configured one again by default")
+    parser.add_argument("--badges", type=int, default=16)
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides, key=value")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    for item in args.set:
+        key, value = item.split("=", 1)
+        setattr(config, key, yaml.safe_load(value))
+    config.sr_url = "debug"
+
+    cold = first_batch(config, False)
+    warm = first_batch(config, True)
+    print(f"First batch of {config.infer_max_batch} windows: {1000 * cold:.1f} ms cold, {1000 * warm:.1f} ms warmed up")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not config.model_golden_dir:
+            config.model_golden_dir = os.path.join(tmp, "golden")
+            config.model_golden_min_accuracy = 0
+            golden_set(config.model_golden_dir, config)
+        scheduler = fast_api.init_scheduler(config, *init_model(config))
+        models = ModelRegistry.from_config(config, scheduler)
+        models.warm_up()
+
+        stop = threading.Event()
+        ticks = []
+        processing = threading.Thread(target=process, args=(config, scheduler, args.badges, stop, ticks))
+        processing.start()
+        time.sleep(5)
+        swap_started = time.perf_counter()
+        models.swap(args.model, vad_model_path=args.vad_model or config.vad_model_path)
+        while models.status()["state"] not in ("ready", "failed"):
+            time.sleep(0.01)
+        swap_finished = time.perf_counter()
+        time.sleep(2)
+        stop.set()
+        processing.join()
+
+    status = models.status()
+    print(f"Swap {status['state']} in {swap_finished - swap_started:.2f} s, timings {status['timings']}, "
+          f"golden set {status['golden']}" + (f", error: {status['error']}" if status["error"] else ""))
+    print(f"Models now: {status['models']}, VAD {status['vad_model_path']}")
+    during = [duration for started, duration in ticks if swap_started <= started <= swap_finished]
+    other = [duration for started, duration in ticks if not swap_started <= started <= swap_finished]
+    print(f"{args.badges} badges, ticks outside of the swap: {describe(other)}")
+    if during:
+        print(f"ticks during the swap: {describe(during)}")
+
+
+if __name__ == "__main__":
+    main()
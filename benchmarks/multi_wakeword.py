@@ -0,0 +1,92 @@
+# Replays badge recordings through one pipeline detecting two wake-words on shared VAD and features and through
+# a separate single wake-word pipeline per word, and compares their activations per wake-word and replay time.
+#
+#   python -m benchmarks.multi_wakeword [--archive /wav/archive] [--happy weights/happy98/model.pt] [--set ...]
+
+import argparse
+import os
+import tempfile
+import time
+
+from collections import Counter
+
+import yaml
+
+import fast_api
+import reprocess
+import worker
+from audio_handler import BadgeAudioHandler
+from benchmarks.vad_gate import matched, synthetic_archive
+from config import Config
+from decoding import load_audio
+
+
+def replay(config, files):
+    # Badges advance together one chunk per tick, like process_badge_fragment runs them
+    scheduler = fast_api.init_scheduler(config, *fast_api.init_model(config))
+    log = reprocess.ActivationLog()
+    log.handlers = {badge_id: BadgeAudioHandler(log, badge_id, config, scheduler) for badge_id in files}
+    started = time.perf_counter()
+    for position in range(max(len(paths) for paths in files.values())):
+        handlers = []
+        for badge_id, paths in files.items():
+            if position < len(paths):
+                handler = log.handlers[badge_id]
+                handler.start_fragment(load_audio(paths[position], config.sample_rate).reshape(1, -1),
+                                       os.path.basename(paths[position]))
+                handlers.append(handler)
+        while any(handler.fragment_in_progress() for handler in handlers):
+            worker.advance([handler for handler in handlers if handler.fragment_in_progress()])
+    for handler in log.handlers.values():
+        handler.flush_recording()
+    return set(log.rows), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--archive")
+    parser.add_argument("--badges", type=int, default=8, help="Badges of the synthetic archive")
+    parser.add_argument("--fragments", type=int, default=20, help="10 s fragments per badge of the synthetic archive")
+    parser.add_argument("--happy", default="weights/happy98/model.pt", help="Model of the second wake-word")
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides, key=value")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    for item in args.set:
+        key, value = item.split("=", 1)
+        setattr(config, key, yaml.safe_load(value))
+    config.sr_url = "debug"
+    greeting, = config.wakeword_settings()
+    happy = {"name": "Happy", "model_path": args.happy}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = args.archive
+        if archive is None:
+            archive = os.path.join(tmp, "archive")
+            synthetic_archive(archive, args.badges, args.fragments)
+        files = reprocess.archive_files(archive)
+        separate, separate_time = set(), 0.0
+        for wakeword in (greeting, happy):
+            config.wakewords = [wakeword]
+            found, elapsed = replay(config, files)
+            separate |= found
+            separate_time += elapsed
+        config.wakewords = [greeting, happy]
+        shared, shared_time = replay(config, files)
+
+    key = lambda rows: {(badge_id, activated, duration) for badge_id, activated, _, duration in rows}
+    print(f"{len(files)} badges, {sum(len(paths) for paths in files.values())} fragments")
+    print(f"Separate pipelines: {separate_time:.1f} s, shared features with 2 heads: {shared_time:.1f} s")
+    separate_words, shared_words = Counter(row[2] for row in separate), Counter(row[2] for row in shared)
+    # A recording started by one wake-word ignores detections of the other until it is finished,
+    # so activations of a word can be missing from the shared run where the other one was recording
+    for name in (greeting["name"], happy["name"]):
+        ours = {row for row in separate if row[2] == name}
+        theirs = {row for row in shared if row[2] == name}
+        print(f"{name}: {separate_words[name]} activations separately, {shared_words[name]} shared, "
+              f"{len(key(ours) - matched(key(ours), key(theirs)))} missing from the shared run")
+
+
+if __name__ == "__main__":
+    main()
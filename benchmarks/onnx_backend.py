@@ -0,0 +1,75 @@
+# Compares the latency per batch of the ONNX Runtime backend and the torch model on the shipped checkpoints,
+# their score parity is asserted in tests/test_onnx_backend.py.
+#
+#   python -m benchmarks.onnx_backend [--checkpoints weights/model_greeting100/model.pt weights/happy98/model.pt]
+
+import argparse
+import time
+
+import torch
+import torchaudio
+
+from model import BCResNet
+from onnx_backend import OnnxBCResNet
+
+def load_model(path):
+    model = BCResNet(2)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    model.eval()
+    return model
+
+
+def make_inputs(count, n_mels=40, sample_rate=16000, duration=1.7):
+    # Log-mel windows of noise with tones, close to what the handlers feed to the model
+    spectrogrammer = torchaudio.transforms.MelSpectrogram(sample_rate=sample_rate, n_fft=480, win_length=480,
+                                                          hop_length=160, n_mels=n_mels)
+    generator = torch.Generator().manual_seed(0)
+    t = torch.arange(int(sample_rate * duration)) / sample_rate
+    windows = []
+    for _ in range(count):
+        freq = 100 + 3000 * torch.rand(1, generator=generator)
+        audio = 3000 * torch.sin(2 * torch.pi * freq * t) + 500 * torch.randn(t.shape, generator=generator)
+        windows.append(torch.log(spectrogrammer(audio) + 1e-8))
+    return torch.stack(windows).unsqueeze(1)
+
+
+def timed(fn, x, repeats):
+    fn(x)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        fn(x)
+    return 1000 * (time.perf_counter() - started) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", nargs="+",
+                        default=["weights/model_greeting100/model.pt", "weights/happy98/model.pt"])
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 8, 64])
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    inputs = make_inputs(max(args.batch_sizes))
+
+    for path in args.checkpoints:
+        model = load_model(path)
+        onnx_model = OnnxBCResNet.from_torch(model, inputs.shape[2], inputs.shape[3], intra_threads=args.threads)
+
+        def torch_infer(x):
+            with torch.inference_mode():
+                return model(x)
+
+        print(path)
+        for batch_size in args.batch_sizes:
+            x = inputs[:batch_size]
+            diff = (torch.sigmoid(torch_infer(x)) - torch.sigmoid(onnx_model(x))).abs().max().item()
+            torch_ms = timed(torch_infer, x, args.repeats)
+            onnx_ms = timed(onnx_model, x, args.repeats)
+            print(f"  batch {batch_size:3d}: max score diff {diff:.2e}, "
+                  f"torch {torch_ms:7.2f} ms, onnx {onnx_ms:7.2f} ms, speedup {torch_ms / onnx_ms:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Evaluates the int8 model against the float model before rolling it out: both run through BadgeAudioHandler
+# on the same audio, the script reports score drift, windows whose decision at certainty_thresh flips,
+# changed recordings and latency. Exits with an error if the int8 model doesn't pass the gate.
+#
+#   python -m benchmarks.quantized_model --audio eval_wavs/ [--calibration calibration_wavs/] [--max_drift 0.02]
+#
+# Without --calibration the model from model_int8_path is evaluated, without --audio synthetic audio is used,
+# which only checks the pipeline, not accuracy.
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+import decoding
+import fast_api
+import quantization
+from audio_handler import BadgeAudioHandler
+from benchmarks.streaming_model import synthetic_audio
+from config import Config
+from onnx_backend import OnnxBCResNet
+from scheduler import InferenceScheduler
+
+
+class _NullDB:
+    def register_activation(self, *args):
+        pass
+
+
+def run_handler(config, scheduler, audio, name):
+    # Scores of every inferred window and chunk positions where recordings started
+    handler = BadgeAudioHandler(_NullDB(), "eval", config, scheduler)
+    scores, recordings = [], []
+    apply_score, start_recording = handler.apply_score, handler._start_recording
+
+    def record_score(result):
+        scores.append(result)
+        apply_score(result)
+
+    def record_start(wakeword):
+        recordings.append(handler._chunk_pos)
+        start_recording(wakeword)
+
+    handler.apply_score = record_score
+    handler._start_recording = record_start
+    handler.process_audiofragment(audio.reshape(1, -1), name)
+    return np.array(scores), recordings
+
+
+def latency(model, x, repeats=30):
+    with torch.inference_mode():
+        model(x)
+        started = time.perf_counter()
+        for _ in range(repeats):
+            model(x)
+    return 1000 * (time.perf_counter() - started) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--audio", nargs="+", help="Evaluation WAV files or directories")
+    parser.add_argument("--calibration", nargs="+", help="Quantize with these WAV files instead of model_int8_path")
+    parser.add_argument("--vad_threshold", type=float, help="Override of the config VAD threshold")
+    parser.add_argument("--max_drift", type=float, default=0.02, help="Max allowed absolute score difference")
+    parser.add_argument("--max_flips", type=int, default=0, help="Max allowed windows with flipped decision")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    config = Config(args.config)
+    config.sr_url = "debug"
+    config.model_streaming = False
+    config.model_backend = "torch"
+    if args.vad_threshold is not None:
+        config.vad_threshold = args.vad_threshold
+
+    float_model, device = fast_api.init_model(config)
+    if args.calibration:
+        files = quantization.audio_paths(args.calibration)
+        windows = quantization.calibration_windows(
+            config, [decoding.load_audio(path, config.sample_rate) for path in files])
+        int8_model = OnnxBCResNet(quantization.quantize_bcresnet(float_model, windows))
+    else:
+        with open(config.model_int8_path, "rb") as f:
+            int8_model = OnnxBCResNet(f.read())
+
+    if args.audio:
+        files = quantization.audio_paths(args.audio)
+        audios = [(path, decoding.load_audio(path, config.sample_rate)) for path in files]
+    else:
+        audios = [(f"synthetic-{seed}", synthetic_audio(30, config.sample_rate, seed).clamp(-32768, 32767)
+                   .numpy().astype(np.int16)) for seed in range(3)]
+
+    float_scheduler = InferenceScheduler(float_model, device)
+    int8_scheduler = InferenceScheduler(int8_model, device)
+
+    all_float, all_int8 = [], []
+    float_recordings = int8_recordings = changed_recordings = 0
+    for name, audio in audios:
+        float_scores, float_starts = run_handler(config, float_scheduler, audio, name)
+        int8_scores, int8_starts = run_handler(config, int8_scheduler, audio, name)
+        if len(float_scores) != len(int8_scores):
+            # Recording changes which windows get inferred, scores are only comparable up to the first difference
+            n = min(len(float_scores), len(int8_scores))
+            float_scores, int8_scores = float_scores[:n], int8_scores[:n]
+        all_float.append(float_scores)
+        all_int8.append(int8_scores)
+        float_recordings += len(float_starts)
+        int8_recordings += len(int8_starts)
+        changed_recordings += len(set(float_starts) ^ set(int8_starts))
+
+    float_scores, int8_scores = np.concatenate(all_float), np.concatenate(all_int8)
+    drift = np.abs(float_scores - int8_scores)
+    thresh = config.certainty_thresh
+    lost = int(np.sum((float_scores > thresh) & (int8_scores <= thresh)))
+    gained = int(np.sum((float_scores <= thresh) & (int8_scores > thresh)))
+
+    print(f"Files: {len(audios)}, inferred windows: {len(drift)}")
+    if len(drift):
+        print(f"Score drift: mean {drift.mean():.2e}, p99 {np.percentile(drift, 99):.2e}, max {drift.max():.2e}")
+    print(f"Windows above certainty_thresh {thresh}: float {int(np.sum(float_scores > thresh))}, "
+          f"int8 {int(np.sum(int8_scores > thresh))}, lost {lost}, gained {gained}")
+    print(f"Recordings started: float {float_recordings}, int8 {int8_recordings}, "
+          f"not started at the same chunk: {changed_recordings}")
+
+    frames = int(config.window_duration * config.sample_rate) // config.hop_length + 1
+    float_onnx = OnnxBCResNet.from_torch(float_model, config.n_mels, frames)
+    for batch_size in (1, 64):
+        x = torch.randn(batch_size, 1, config.n_mels, frames)
+        print(f"Latency at batch {batch_size}: float torch {latency(float_model, x):.2f} ms, "
+              f"float onnx {latency(float_onnx, x):.2f} ms, int8 onnx {latency(int8_model, x):.2f} ms")
+
+    max_drift = drift.max() if len(drift) else 0.0
+    if max_drift > args.max_drift or lost + gained > args.max_flips or changed_recordings:
+        raise SystemExit("int8 model doesn't pass the accuracy gate")
+    print("int8 model passes the accuracy gate")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Microbenchmarks of the pipeline stages: VAD, mel front-end and the wake-word model on every backend.
+# Times are medians over repeats on one thread. Save a run and compare later runs against it to catch regressions:
+#
+#   python -m benchmarks.stages --save stages.json
+#   python -m benchmarks.stages --compare stages.json [--tolerance 1.5]
+
+import argparse
+import json
+import statistics
+import time
+
+import numpy as np
+import torch
+
+import fast_api
+from benchmarks.fleet import speech_like
+from config import Config
+from features import IncrementalLogMel, make_spectrogrammer, window_features
+from model import StreamingBCResNet
+from onnx_backend import OnnxBCResNet
+from vad import OnnxVADRuntime
+
+
+def median_ms(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return 1000 * statistics.median(times)
+
+
+def stage_times(config: Config, repeats: int) -> dict:
+    rng = np.random.default_rng(0)
+    window_size = int(config.window_duration * config.sample_rate)
+    chunk_size = int((config.sample_rate * config.window_duration) // 7)
+    chunk_size -= chunk_size % config.hop_length
+    audio = np.clip(speech_like(window_size * 3 / config.sample_rate, rng), -32768, 32767).astype(np.int16)
+    window = audio[:window_size]
+    times = {}
+
+    vad = OnnxVADRuntime(config.vad_model_path, config.vad_max_batch)
+    chunk = audio[:chunk_size].astype("float32")
+    state = np.zeros((2, 1, 64), dtype="float32")
+    times["vad_chunk"] = median_ms(lambda: vad(chunk, state, state), repeats)
+    times["vad_batch64"] = median_ms(lambda: vad.run_batch([chunk] * 64, [state] * 64, [state] * 64), repeats)
+
+    spectrogrammer = make_spectrogrammer(config)
+    times["mel_window"] = median_ms(lambda: window_features(spectrogrammer, window), repeats)
+    frontend = IncrementalLogMel(spectrogrammer[0], window_size)
+    windows = [audio[i:i + window_size] for i in range(0, len(audio) - window_size + 1, chunk_size)]
+    step = iter(range(10 ** 9))
+
+    def incremental():
+        frontend(windows[1 + next(step) % (len(windows) - 1)], chunk_size)
+    frontend(windows[0])
+    times["mel_incremental"] = median_ms(incremental, repeats)
+
+    config.model_fuse = False
+    model, _ = fast_api.init_model(config)
+    fused = model.fuse_for_inference()
+    features = window_features(spectrogrammer, window)
+    frames = features.shape[-1]
+    onnx_model = OnnxBCResNet.from_torch(fused, config.n_mels, frames)
+    for batch_size in (1, 64):
+        x = features.expand(batch_size, 1, *features.shape).contiguous()
+        with torch.inference_mode():
+            times[f"model_torch_b{batch_size}"] = median_ms(lambda: model(x), repeats)
+            times[f"model_fused_b{batch_size}"] = median_ms(lambda: fused(x), repeats)
+        times[f"model_onnx_b{batch_size}"] = median_ms(lambda: onnx_model(x), repeats)
+
+    stream = StreamingBCResNet(fused)
+    raw = [torch.log(spectrogrammer(torch.from_numpy(w).float()) + 1e-8).reshape(1, 1, config.n_mels, frames)
+           for w in windows]
+    stream(raw[0])
+    stream_step = iter(range(10 ** 9))
+    times["model_streaming_step"] = median_ms(
+        lambda: stream(raw[1 + next(stream_step) % (len(raw) - 1)], chunk_size // config.hop_length), repeats)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument("--save", help="Write the stage times to this JSON file")
+    parser.add_argument("--compare", help="Compare against stage times saved earlier")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    times = stage_times(Config(args.config), args.repeats)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    for stage, ms in times.items():
+        line = f"{stage:22s} {ms:9.3f} ms"
+        if stage in baseline:
+            ratio = ms / baseline[stage]
+            line += f"   baseline {baseline[stage]:9.3f} ms, {ratio:.2f}x"
+            if ratio > args.tolerance:
+                line += "  REGRESSION"
+                regressions.append(stage)
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(times, f, indent=2)
+    if regressions:
+        raise SystemExit(f"Slower than baseline by more than {args.tolerance}x: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
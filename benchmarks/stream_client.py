@@ -0,0 +1,200 @@
+# Streams badge audio to /stream/{BadgeID} over WebSocket (or chunked HTTP with --http) at real-time pace
+# while the same audio goes to /upload as fragments from another badge, and compares the two paths:
+# activations, ingestion lag and fragment-to-decision latency. --drop_every closes the stream connection
+# every so many seconds of audio, the client resumes from the sample offset the server reports.
+#
+#   python -m benchmarks.stream_client [--seconds 60] [--drop_every 7] [--http] [--set stream_segment_ms=500 ...]
+#
+# The server is started locally like benchmarks/fleet.py does, --url points at a running one instead
+# (badges badge0 and badge1 have to be registered and enabled).
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+import requests
+import websockets
+
+from asr import build_wav
+from benchmarks.fleet import GENERATORS, SAMPLE_RATE, _start_local, _wait_ready
+
+
+def badge_audio(seconds, seed=0):
+    # Alternating speech-like, silent and wake-word-like stretches of 10 s
+    rng = np.random.default_rng(seed)
+    parts = [GENERATORS[("speech", "silence", "wakeword")[index % 3]](10, rng)
+             for index in range(int(np.ceil(seconds / 10)))]
+    audio = np.concatenate(parts)[:int(seconds * SAMPLE_RATE)]
+    return np.clip(audio, -32768, 32767).astype(np.int16)
+
+
+async def stream_websocket(url, badge_id, audio, args):
+    pcm = audio.astype("<i2").tobytes()
+    frame = 2 * int(args.frame_ms * SAMPLE_RATE / 1000)
+    stream_id = uuid.uuid4().hex
+    start = time.time()
+    paced = time.monotonic()
+    offset = None
+    reconnects = 0
+    while offset is None or 2 * offset < len(pcm):
+        async with websockets.connect(f"{url.replace('http', 'ws', 1)}/stream/{badge_id}") as ws:
+            await ws.send(json.dumps({"stream_id": stream_id, "start": start, "offset": offset}))
+            hello = json.loads(await ws.recv())
+            offset, committed, window = hello["offset"], hello["committed"], hello["window"]
+            acked = asyncio.Event()
+            state = {"committed": committed}
+
+            async def receive():
+                async for message in ws:
+                    state["committed"] = json.loads(message)["committed"]
+                    acked.set()
+
+            receiver = asyncio.create_task(receive())
+            drop_at = 2 * offset + 2 * int(args.drop_every * SAMPLE_RATE) if args.drop_every else len(pcm)
+            position = 2 * offset
+            while position < min(drop_at, len(pcm)):
+                await asyncio.sleep(max(paced + position / 2 / SAMPLE_RATE / args.realtime - time.monotonic(), 0))
+                while position // 2 - state["committed"] >= window:
+                    acked.clear()
+                    await acked.wait()
+                await ws.send(pcm[position:position + frame])
+                position += frame
+            if position >= len(pcm):
+                await ws.send(json.dumps({"end": True}))
+                await receiver
+                return reconnects
+            receiver.cancel()
+        # Dropped, the server tells where to resume
+        offset = None
+        reconnects += 1
+    return reconnects
+
+
+def stream_http(url, badge_id, audio, args):
+    pcm = audio.astype("<i2").tobytes()
+    frame = 2 * int(args.frame_ms * SAMPLE_RATE / 1000)
+    stream_id = uuid.uuid4().hex
+    start = time.time()
+    paced = time.monotonic()
+    offset = 0
+    reconnects = -1
+    while 2 * offset < len(pcm) or reconnects < 0:
+        end = min(2 * offset + 2 * int((args.drop_every or args.seconds) * SAMPLE_RATE), len(pcm))
+
+        def body(position=2 * offset, end=end):
+            while position < end:
+                time.sleep(max(paced + position / 2 / SAMPLE_RATE / args.realtime - time.monotonic(), 0))
+                yield pcm[position:min(position + frame, end)]
+                position += frame
+
+        response = requests.post(f"{url}/stream/{badge_id}", data=body(), timeout=60,
+                                 params={"stream_id": stream_id, "offset": offset, "start": start,
+                                         "end": end == len(pcm)})
+        response.raise_for_status()
+        offset = response.json()["offset"]
+        reconnects += 1
+    return reconnects
+
+
+def upload(url, badge_id, audio, args):
+    # The same audio as fragments, each uploaded once recorded
+    size = int(args.fragment_seconds * SAMPLE_RATE)
+    start = datetime.datetime.now()
+    paced = time.monotonic()
+    for position in range(0, len(audio), size):
+        fragment = audio[position:position + size]
+        time.sleep(max(paced + (position + len(fragment)) / SAMPLE_RATE / args.realtime - time.monotonic(), 0))
+        filename = (start + datetime.timedelta(seconds=position / SAMPLE_RATE)).strftime("%Y%m%d%H%M%S") + ".WAV"
+        requests.post(f"{url}/upload", data={"BadgeID": badge_id}, timeout=30,
+                      files={"upload_file": (filename, build_wav(fragment, SAMPLE_RATE), "audio/wav")})
+
+
+def scrape(url):
+    # {(name, labels): value} of counters and gauges, (sum, count) of histograms from /metrics
+    values = {}
+    for line in requests.get(f"{url}/metrics", timeout=10).text.splitlines():
+        if line.startswith("#"):
+            continue
+        key, value = line.rsplit(" ", 1)
+        values[key] = float(value)
+    return values
+
+
+def histogram_mean(values, name):
+    count = values.get(f"{name}_count", 0)
+    return values.get(f"{name}_sum", 0) / count if count else float("nan")
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix="stream-")
+    stub = server = None
+    url = args.url
+    if url is None:
+        args.badges = 2
+        stub, server = _start_local(args, tmp)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        _wait_ready(url, server)
+        audio = badge_audio(args.seconds)
+        started = time.monotonic()
+        uploader = threading.Thread(target=upload, args=(url, "badge1", audio, args))
+        uploader.start()
+        if args.http:
+            reconnects = stream_http(url, "badge0", audio, args)
+        else:
+            reconnects = asyncio.run(stream_websocket(url, "badge0", audio, args))
+        uploader.join()
+        sent = time.monotonic() - started
+        expected = 2 * args.seconds
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline:
+            values = scrape(url)
+            if values.get("vad_scanner_audio_seconds_total", 0) >= expected - 1e-3:
+                break
+            time.sleep(0.5)
+        values = scrape(url)
+    finally:
+        for process in (server, stub):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    print(f"{args.seconds} s of audio at {args.realtime}x real time, streamed over "
+          f"{'chunked HTTP' if args.http else 'WebSocket'} with {reconnects} reconnects in {sent:.1f} s")
+    print(f"Processed {values.get('vad_scanner_audio_seconds_total', 0):.1f} of {expected} s of audio, "
+          f"{values.get('vad_scanner_fragments_total', 0):.0f} fragments and segments")
+    for badge_id, path in (("badge0", "stream"), ("badge1", "upload")):
+        prefix = 'vad_scanner_activations_total{badge_id="' + badge_id + '"'
+        found = sum(value for key, value in values.items() if key.startswith(prefix))
+        print(f"{path:6s} activations: {found:.0f}")
+    print(f"Ingestion lag mean {histogram_mean(values, 'vad_scanner_ingestion_lag_seconds'):.2f} s, "
+          f"fragment-to-decision latency mean "
+          f"{1000 * histogram_mean(values, 'vad_scanner_fragment_latency_seconds'):.0f} ms, over both paths")
+    print(f"Server log: {os.path.join(tmp, 'server.log')}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--url", help="Stream to an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8120, help="Port of the local server, the ASR stub uses port + 1")
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides of the local server, key=value")
+    parser.add_argument("--seconds", type=float, default=60, help="Seconds of audio per badge")
+    parser.add_argument("--realtime", type=float, default=1.0, help="Sending pace relative to real time")
+    parser.add_argument("--frame_ms", type=float, default=100, help="Audio per WebSocket message or body chunk")
+    parser.add_argument("--fragment_seconds", type=float, default=10, help="Fragments of the upload badge")
+    parser.add_argument("--drop_every", type=float, help="Seconds of audio after which the stream reconnects")
+    parser.add_argument("--http", action="store_true", help="Stream a chunked HTTP body instead of a WebSocket")
+    parser.add_argument("--drain_timeout", type=float, default=60)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
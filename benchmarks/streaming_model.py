@@ -0,0 +1,120 @@
+# Checks StreamingBCResNet against the full-window BCResNet forward on a sliding window
+# and compares the work done per detection step.
+#
+#   python -m benchmarks.streaming_model [--model weights/model_greeting100/model.pt] [--steps 200] [--fuse]
+
+import argparse
+import time
+
+import torch
+import torchaudio
+
+from model import BCResNet, StreamingBCResNet
+
+
+def load_model(path):
+    model = BCResNet(2)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    model.eval()
+    return model
+
+
+def layer_macs(model, spec):
+    # MACs of every streaming layer over the full window, measured with hooks on the convs
+    macs = {}
+
+    def hook(name):
+        def count(module, inputs, output):
+            per_output = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+            macs[name] = macs.get(name, 0) + output.numel() * per_output
+        return count
+
+    handles = []
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Conv2d):
+            layer = name.split(".")[0]
+            handles.append(module.register_forward_hook(hook("conv1_raw" if layer == "conv1" else layer)))
+    with torch.no_grad():
+        model(spec)
+    for handle in handles:
+        handle.remove()
+    return macs
+
+
+def synthetic_audio(seconds, sample_rate, seed=0):
+    # Noise with syllable-like amplitude bursts, so that the window max changes from time to time
+    generator = torch.Generator().manual_seed(seed)
+    audio = torch.randn(seconds * sample_rate, generator=generator) * 500
+    syllable = int(0.25 * sample_rate)
+    for start in range(0, audio.numel() - syllable, syllable):
+        audio[start:start + syllable] *= 1 + 4 * torch.rand(1, generator=generator)
+    return audio
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="weights/model_greeting100/model.pt")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    parser.add_argument("--window_duration", type=float, default=1.7)
+    parser.add_argument("--hop_length", type=int, default=160)
+    parser.add_argument("--fuse", action="store_true", help="Run both paths on the fused inference model")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    model = load_model(args.model)
+    if args.fuse:
+        model = model.fuse_for_inference()
+    spectrogrammer = torchaudio.transforms.MelSpectrogram(
+        sample_rate=args.sample_rate, n_fft=480, win_length=480, hop_length=args.hop_length, center=True,
+        pad_mode="reflect", power=2.0, norm='slaney', n_mels=40, mel_scale="htk")
+
+    window = int(args.window_duration * args.sample_rate)
+    chunk = window // 7
+    chunk -= chunk % args.hop_length
+    shift = chunk // args.hop_length
+    audio = synthetic_audio(int((window + chunk * args.steps) / args.sample_rate) + 1, args.sample_rate)
+
+    stream = StreamingBCResNet(model)
+    full_time = stream_time = 0.0
+    max_diff = 0.0
+    full_macs = streaming_macs = 0.0
+    max_changes = 0
+    macs = None
+
+    for step in range(args.steps):
+        raw = torch.log(spectrogrammer(audio[step * chunk:step * chunk + window]) + 1e-8)
+        raw = raw.reshape(1, 1, *raw.shape)
+        if macs is None:
+            macs = layer_macs(model, raw - raw.max())
+            frames = raw.shape[-1]
+
+        started = time.perf_counter()
+        with torch.no_grad():
+            full = model(raw - raw.max())
+        full_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        out = stream(raw, shift if step else None)
+        stream_time += time.perf_counter() - started
+
+        max_diff = max(max_diff, (torch.logit(full) - torch.logit(out)).abs().max().item())
+        if step and stream.computed_frames["block1_1"] == frames:
+            max_changes += 1
+
+        full_macs += sum(macs.values())
+        streaming_macs += sum(macs.get(name, 0) * computed / frames
+                              for name, computed in stream.computed_frames.items())
+        streaming_macs += macs.get("conv4", 0)
+
+    print(f"Steps: {args.steps}, shift: {shift} frames, window: {frames} frames")
+    print(f"Max logit difference to full forward: {max_diff:.3g}")
+    print(f"Steps with changed window max: {max_changes}")
+    print(f"MACs per step: full {full_macs / args.steps / 1e6:.2f}M, streaming {streaming_macs / args.steps / 1e6:.2f}M, "
+          f"ratio {full_macs / streaming_macs:.2f}x")
+    print(f"Time per step: full {1000 * full_time / args.steps:.2f} ms, "
+          f"streaming {1000 * stream_time / args.steps:.2f} ms, ratio {full_time / stream_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Sweeps CPU thread settings of the fragment pipeline (VAD + model through the tick-based worker)
+# and reports throughput in real-time badge streams per core.
+#
+#   python -m benchmarks.thread_sweep [--threads 1 2 4] [--badges 16] [--seconds 20] [--backend torch onnx]
+#
+# Every setting runs in its own process restricted to `threads` cores, torch thread pools can only be sized once.
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+import resources
+import worker
+from config import Config
+from fragment_queue import FragmentQueue
+from handler_cache import HandlerCache
+
+
+class _NullDB:
+    def register_activation(self, *args):
+        pass
+
+
+def run(args):
+    import fast_api
+    from audio_handler import BadgeAudioHandler
+
+    config = Config(args.config)
+    config.sr_url = "debug"
+    config.model_backend = args.backend
+    config.model_streaming = False
+    config.torch_intra_threads = config.onnx_intra_threads = config.vad_intra_threads = args.threads
+    config.cpu_cores = sorted(os.sched_getaffinity(0))[:args.threads]
+    if args.vad_threshold is not None:
+        config.vad_threshold = args.vad_threshold
+    resources.configure_process(config)
+    cores = len(resources.available_cores(config))
+
+    model, device = fast_api.init_model(config)
+    scheduler = fast_api.init_scheduler(config, model, device)
+
+    rng = np.random.default_rng(0)
+    started = []
+    active_badges = HandlerCache()
+    for index in range(args.badges):
+        handler = BadgeAudioHandler(_NullDB(), f"badge{index}", config, scheduler)
+        start_fragment = handler.start_fragment
+        handler.start_fragment = lambda *a, start_fragment=start_fragment: (started.append(1), start_fragment(*a))
+        active_badges[f"badge{index}"] = handler
+
+    fragments_queue = FragmentQueue.from_config(config)
+    threading.Thread(target=worker.process_badge_fragment, args=(fragments_queue, active_badges, config),
+                     daemon=True).start()
+    time.sleep(1.5)
+
+    begin = time.perf_counter()
+    for badge_id in active_badges:
+        audio = (rng.standard_normal((1, args.seconds * config.sample_rate)) * 3000).astype(np.int16)
+        fragments_queue.put((badge_id, audio, "20220101000000.WAV", time.time()))
+    while len(started) < args.badges or any(active_badges[badge_id].fragment_in_progress() for badge_id in active_badges):
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - begin
+
+    streams = args.badges * args.seconds / elapsed
+    print(f"{args.backend:6s} {args.threads:7d} {cores:5d} {elapsed:9.2f} {streams:9.1f} {streams / cores:12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--backend", nargs="+", default=["torch", "onnx"])
+    parser.add_argument("--badges", type=int, default=16)
+    parser.add_argument("--seconds", type=int, default=20)
+    parser.add_argument("--vad_threshold", type=float, help="Override of the config VAD threshold, -1 infers every window")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        args.threads, args.backend = args.threads[0], args.backend[0]
+        run(args)
+        return
+
+    available = len(os.sched_getaffinity(0))
+    print(f"{available} cores available, {args.badges} badges x {args.seconds} s of audio")
+    print(f"{'backend':6s} {'threads':>7s} {'cores':>5s} {'wall s':>9s} {'streams':>9s} {'per core':>12s}")
+    for backend in args.backend:
+        for threads in args.threads:
+            if threads > available:
+                print(f"{backend:6s} {threads:7d}  skipped, only {available} cores")
+                continue
+            command = [sys.executable, "-m", "benchmarks.thread_sweep", "--run", "--config", args.config,
+                       "--threads", str(threads), "--backend", backend,
+                       "--badges", str(args.badges), "--seconds", str(args.seconds)]
+            if args.vad_threshold is not None:
+                command += ["--vad_threshold", str(args.vad_threshold)]
+            subprocess.run(command, check=True, stderr=subprocess.DEVNULL)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Replays badge recordings with and without the energy gate in front of the VAD and reports the fraction
+# of VAD calls skipped, voiced chunks the gate skipped and activations lost or gained. Lost activations
+# are split into merged ones, which fall inside a longer recording of the gated run, and missed ones.
+#
+#   python -m benchmarks.vad_gate --archive /wav/archive [--margins 3 6 10] [--set certainty_thresh=0.5 ...]
+#
+# The archive has the layout of reprocess.py, <archive>/<badge_id>/YYYYmmddHHMMSS.WAV.
+# Without --archive, a synthetic one of speech-like, silent and wake-word-like fragments is generated.
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+import fast_api
+import reprocess
+from asr import build_wav
+from benchmarks.fleet import GENERATORS, SAMPLE_RATE
+from config import Config
+from decoding import load_audio
+from vad import EnergyGate, OnnxVADRuntime
+
+
+def synthetic_archive(path, badges, fragments, seconds=10, seed=0):
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2022, 3, 1, 9, 0, 0)
+    for badge in range(badges):
+        directory = os.path.join(path, f"badge{badge}")
+        os.makedirs(directory)
+        for index in range(fragments):
+            kind = rng.choice(["speech", "silence", "wakeword"], p=[0.4, 0.3, 0.3])
+            audio = np.clip(GENERATORS[kind](seconds, rng), -32768, 32767).astype(np.int16)
+            name = (start + datetime.timedelta(seconds=seconds * index)).strftime("%Y%m%d%H%M%S") + ".WAV"
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(build_wav(audio, SAMPLE_RATE))
+
+
+def chunk_report(config, files, margin):
+    # VAD decisions of every chunk against the gate's, per badge stream as BadgeAudioHandler sees it
+    vad = OnnxVADRuntime(config.vad_model_path, config.vad_max_batch)
+    chunk_size = int((config.sample_rate * config.window_duration) // 7)
+    chunks = gated = voiced = voiced_gated = 0
+    for paths in files.values():
+        gate = EnergyGate(config.sample_rate, margin, config.vad_gate_zcr)
+        h = c = np.zeros((2, 1, 64), dtype="float32")
+        for path in paths:
+            audio = load_audio(path, config.sample_rate).astype("float32")
+            for start in range(0, len(audio), chunk_size):
+                chunk = audio[start:start + chunk_size]
+                out, h, c = vad(chunk, h, c)
+                silent = gate.is_silent(chunk)
+                chunks += 1
+                gated += silent
+                voiced += out > config.vad_threshold
+                voiced_gated += silent and out > config.vad_threshold
+    return chunks, gated, voiced, voiced_gated
+
+
+def activations(config, files):
+    reprocess._init_process(config, *fast_api.init_model(config))
+    started = time.perf_counter()
+    rows, _, seconds = reprocess.process_badges((0, list(files.items())))
+    return {(badge_id, activated, duration) for badge_id, activated, _, duration in rows}, \
+        seconds / (time.perf_counter() - started)
+
+
+def matched(found, reference, tolerance=2):
+    # Activations of found that are within tolerance seconds of one in reference of the same badge
+    return {(badge_id, activated, duration) for badge_id, activated, duration in found
+            if any(badge_id == other and abs((activated - at).total_seconds()) <= tolerance
+                   for other, at, _ in reference)}
+
+
+def covered(lost, found):
+    # Lost activations that end within a recording of found, activations are stamped at the end of the recording
+    return {(badge_id, activated, duration) for badge_id, activated, duration in lost
+            if any(badge_id == other and 0 <= (at - activated).total_seconds() <= span
+                   for other, at, span in found)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--archive")
+    parser.add_argument("--badges", type=int, default=4, help="Badges of the synthetic archive")
+    parser.add_argument("--fragments", type=int, default=30, help="10 s fragments per badge of the synthetic archive")
+    parser.add_argument("--margins", nargs="+", type=float, default=[3, 6, 10])
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides, key=value")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    for item in args.set:
+        key, value = item.split("=", 1)
+        setattr(config, key, yaml.safe_load(value))
+    config.sr_url = "debug"
+    config.workers = 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = args.archive
+        if archive is None:
+            archive = tmp
+            synthetic_archive(archive, args.badges, args.fragments)
+        files = reprocess.archive_files(archive)
+
+        config.vad_gate = False
+        reference, speed = activations(config, files)
+        print(f"{sum(len(paths) for paths in files.values())} files of {len(files)} badges, "
+              f"without gate: {len(reference)} activations, {speed:.0f}x real time")
+        print(f"{'margin dB':>9s} {'VAD skipped':>11s} {'voiced gated':>12s} {'activations':>11s} "
+              f"{'merged':>6s} {'missed':>6s} {'gained':>6s} {'x real time':>11s}")
+        for margin in args.margins:
+            chunks, gated, voiced, voiced_gated = chunk_report(config, files, margin)
+            config.vad_gate = True
+            config.vad_gate_margin_db = margin
+            found, speed = activations(config, files)
+            lost = reference - matched(reference, found)
+            merged = len(covered(lost, found))
+            gained = len(found - matched(found, reference))
+            print(f"{margin:9.1f} {gated / chunks:10.1%} {voiced_gated:5d} of {voiced:<5d} "
+                  f"{len(found):11d} {merged:6d} {len(lost) - merged:6d} {gained:6d} {speed:11.0f}")
+
+
+if __name__ == "__main__":
+    main()
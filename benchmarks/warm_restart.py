@@ -0,0 +1,110 @@
+# Replays badge recordings with a restart of the handlers every few fragments, warm from a snapshot file
+# and cold without one, and compares their activations with an uninterrupted replay. Also reports the size
+# of the snapshot and the time to write and load it. The synthetic archive scores below the production
+# certainty_thresh, so without --archive the benchmark runs at SYNTHETIC_THRESH.
+#
+#   python -m benchmarks.warm_restart [--archive /wav/archive] [--restart_every 3] [--set certainty_thresh=0.5 ...]
+
+import argparse
+import os
+import tempfile
+import time
+
+from collections import deque
+
+import yaml
+
+import fast_api
+import reprocess
+import snapshots
+import worker
+from audio_handler import BadgeAudioHandler
+from benchmarks.vad_gate import matched, synthetic_archive
+from config import Config
+from decoding import load_audio
+from handler_cache import HandlerCache
+
+SYNTHETIC_THRESH = 0.55
+
+
+def replay(config, scheduler, files, restart_every, path=None):
+    # Badges take turns with one fragment each, handlers are thrown away after every `restart_every` rounds
+    log = reprocess.ActivationLog()
+    pending = {badge_id: deque(paths) for badge_id, paths in files.items()}
+    timings = []
+
+    def start(states):
+        cache = HandlerCache(lambda badge_id: BadgeAudioHandler(log, badge_id, config, scheduler))
+        for badge_id in files:
+            cache.enable(badge_id)
+        cache.restore(states)
+        log.handlers = cache
+        return cache
+
+    cache = start({})
+    rounds = 0
+    while any(pending.values()):
+        for badge_id, paths in pending.items():
+            if paths:
+                fragment = paths.popleft()
+                handler = cache[badge_id]
+                handler.start_fragment(load_audio(fragment, config.sample_rate).reshape(1, -1),
+                                       os.path.basename(fragment))
+                while handler.fragment_in_progress():
+                    worker.advance([handler])
+        rounds += 1
+        if restart_every and rounds % restart_every == 0 and any(pending.values()):
+            states = {}
+            if path is not None:
+                started = time.perf_counter()
+                snapshots.save(path, cache.snapshot(), config)
+                saved = time.perf_counter()
+                states = snapshots.load(path, config)
+                timings.append((saved - started, time.perf_counter() - saved, os.path.getsize(path)))
+            cache = start(states)
+    cache.drain()
+    return {(badge_id, activated, duration) for badge_id, activated, _, duration in log.rows}, timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--archive")
+    parser.add_argument("--badges", type=int, default=8, help="Badges of the synthetic archive")
+    parser.add_argument("--fragments", type=int, default=20, help="10 s fragments per badge of the synthetic archive")
+    parser.add_argument("--restart_every", type=int, default=3, help="Fragments per badge between restarts")
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides, key=value")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    if args.archive is None:
+        config.certainty_thresh = SYNTHETIC_THRESH
+    for item in args.set:
+        key, value = item.split("=", 1)
+        setattr(config, key, yaml.safe_load(value))
+    config.sr_url = "debug"
+    scheduler = fast_api.init_scheduler(config, *fast_api.init_model(config))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = args.archive
+        if archive is None:
+            archive = os.path.join(tmp, "archive")
+            synthetic_archive(archive, args.badges, args.fragments)
+        files = reprocess.archive_files(archive)
+        reference, _ = replay(config, scheduler, files, 0)
+        warm, timings = replay(config, scheduler, files, args.restart_every, os.path.join(tmp, "handlers.snap"))
+        cold, _ = replay(config, scheduler, files, args.restart_every)
+
+    print(f"{len(files)} badges, restart every {args.restart_every} fragments, "
+          f"{len(reference)} activations without restarts")
+    for name, found in (("warm", warm), ("cold", cold)):
+        print(f"{name}: {len(found)} activations, {len(reference - matched(reference, found))} lost, "
+              f"{len(found - matched(found, reference))} gained")
+    if timings:
+        save, load, size = max(timings)
+        print(f"Snapshot of {len(files)} badges: {size / 1024:.0f} KB, written in {1000 * save:.1f} ms, "
+              f"mapped in {1000 * load:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
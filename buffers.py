@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class RingWindow:
+    """
+    Sliding window of the last `size` samples. Samples are written twice (slot and slot + size),
+    so the window is always available as a contiguous view and pushing a chunk costs O(chunk).
+    """
+
+    def __init__(self, size: int, dtype=np.int16):
+        self.size = size
+        self._buffer = np.zeros(2 * size, dtype=dtype)
+        self._start = 0
+
+    def push(self, chunk: np.ndarray):
+        n = len(chunk)
+        if n >= self.size:
+            self._buffer[:self.size] = chunk[n - self.size:]
+            self._buffer[self.size:] = chunk[n - self.size:]
+            self._start = 0
+            return
+
+        head = min(n, self.size - self._start)
+        self._write(self._start, chunk[:head])
+        if head < n:
+            self._write(0, chunk[head:])
+        self._start = (self._start + n) % self.size
+
+    def view(self) -> np.ndarray:
+        return self._buffer[self._start:self._start + self.size]
+
+    @property
+    def nbytes(self) -> int:
+        return self._buffer.nbytes
+
+    def _write(self, slot, samples):
+        self._buffer[slot:slot + len(samples)] = samples
+        self._buffer[slot + self.size:slot + self.size + len(samples)] = samples
+
+
+class PCMArena:
+    """
+    Growable buffer of PCM samples, capacity doubles when full, so appending is amortized O(chunk).
+    """
+
+    def __init__(self, capacity: int, dtype=np.int16):
+        self.initial_capacity = capacity
+        self._buffer = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def append(self, samples: np.ndarray):
+        end = self._size + len(samples)
+        if end > self._buffer.size:
+            capacity = self._buffer.size
+            while capacity < end:
+                capacity *= 2
+            buffer = np.empty(capacity, dtype=self._buffer.dtype)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+        self._buffer[self._size:end] = samples
+        self._size = end
+
+    def clear(self):
+        # Don't hold on to memory of an unusually long recording
+        if self._buffer.size > 4 * self.initial_capacity:
+            self._buffer = np.empty(self.initial_capacity, dtype=self._buffer.dtype)
+        self._size = 0
+
+    def view(self) -> np.ndarray:
+        return self._buffer[:self._size]
+
+    @property
+    def nbytes(self) -> int:
+        return self._buffer.nbytes
+
+    def __len__(self):
+        return self._size
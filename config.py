@@ -5,6 +5,21 @@ class Config():
     CONFIG_KEYS = ["window_duration", "sample_rate", "n_fft", "win_length", "hop_length", "n_mels", "certainty_thresh",
                    "certainty_detects", "certainty_window", "vad_release", "model_path", "db_host", "db_port", "sr_url",
                    "vad_model_path","vad_threshold"]
+    OPTIONAL_KEYS = {"infer_max_batch": 64, "infer_max_wait_ms": 5, "vad_max_batch": 64,
+                     "vad_gate": False, "vad_gate_margin_db": 6, "vad_gate_zcr": 0.4,
+                     "model_fuse": True, "model_backend": "torch", "onnx_intra_threads": 1, "onnx_inter_threads": 1,
+                     "model_int8_path": "weights/model_greeting100/model_int8.onnx",
+                     "model_streaming": False, "frontend_incremental": False, "wakewords": [],
+                     "model_warmup_batches": 3, "model_golden_dir": "", "model_golden_min_accuracy": 0.9,
+                     "api_port": 8020, "workers": 0, "decode_workers": 2, "decode_max_pending": 64,
+                     "queue_max_seconds": 1800, "queue_policy": "reject", "queue_vad_only_fraction": 0.5,
+                     "handler_memory_mb": 512, "snapshot_dir": "", "snapshot_interval": 60, "drain_timeout": 20,
+                     "stream_segment_ms": 1000, "stream_window_seconds": 10, "stream_resume_seconds": 300,
+                     "torch_intra_threads": 1, "torch_inter_threads": 1, "vad_intra_threads": 1, "vad_inter_threads": 1,
+                     "cpu_cores": [], "pin_workers": False,
+                     "db_pool_min": 1, "db_pool_max": 8, "db_registry_refresh": 60,
+                     "activation_batch": 500, "activation_flush_ms": 1000, "activation_spool_dir": "/wav/activations",
+                     "asr_concurrency": 4, "asr_timeout": 10, "asr_spool_dir": "/wav/spool", "asr_spool_limit": 1000}
 
     def __init__(self, path="config.yml"):
         self.path = path
@@ -16,6 +31,21 @@ class Config():
 
         for k in self.CONFIG_KEYS:
             setattr(self, k, config[k])
+        for k, default in self.OPTIONAL_KEYS.items():
+            setattr(self, k, config.get(k, default))
+
+    def wakeword_settings(self) -> list:
+        # Wake-words to detect, by default the single one of model_path. Every entry has the name of its
+        # database.Wakeword, its model and certainty parameters, the global ones unless it sets its own
+        wakewords = self.wakewords or [{"name": "Здравствуйте", "model_path": self.model_path,
+                                        "model_int8_path": self.model_int8_path}]
+        settings = []
+        for wakeword in wakewords:
+            entry = {"model_int8_path": None, "certainty_thresh": self.certainty_thresh,
+                     "certainty_detects": self.certainty_detects, "certainty_window": self.certainty_window}
+            entry.update(wakeword)
+            settings.append(entry)
+        return settings
 
     def __repr__(self):
         config_str = ""
@@ -1,17 +1,25 @@
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
+import threading
 import logging
 import traceback
 import datetime
+import time
+import json
 import os
 
+from contextlib import contextmanager
 from enum import Enum
 
 from config import Config
+from metrics import registry
 from singleton import Singleton
 
 
 class Wakeword(Enum):
     Здравствуйте = 0
+    Happy = 1
 
 
 class TableAlreadyExistsException(Exception):
@@ -43,13 +51,154 @@ db = None
 
 
 
+class ActivationSink:
+    """
+    Write-behind log of activations. register() only appends to an in-memory buffer, a background thread
+    writes the buffer every `flush_interval` seconds or as soon as it holds `batch_size` activations, as one
+    multi-row INSERT together with the Badges.Activations counters in the same transaction.
+
+    Batches that can't be written because the database is unreachable are saved to `spool_dir` and written
+    once it is back, so activations survive both a database outage and a restart of the service. Batches the
+    database rejects are kept aside in the spool as .failed files.
+    """
+    # Claims older than this were left by a process that died while writing the batch
+    CLAIM_TIMEOUT = 600
+
+    def __init__(self, db, batch_size: int = 500, flush_interval: float = 1, spool_dir: str = "/wav/activations"):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir
+
+        self._buffer = []
+        self._condition = threading.Condition()
+        self._flushed = 0
+        self._requested = 0
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._recover_claims()
+        self._thread = threading.Thread(target=self._run, name="activation-sink", daemon=True)
+        self._thread.start()
+
+    def register(self, badge_id: str, wakeword: Wakeword, duration: float, activated: datetime.datetime = None):
+        activated = activated or datetime.datetime.now()
+        with self._condition:
+            self._buffer.append((badge_id, activated, wakeword.value, duration))
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+
+    def flush(self, timeout=None):
+        # Blocks until everything registered before the call was handed to the database or the spool
+        with self._condition:
+            self._requested += 1
+            request = self._requested
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._flushed >= request, timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._buffer) >= self.batch_size
+                                         or self._requested > self._flushed, self.flush_interval)
+                batch, self._buffer = self._buffer, []
+                request = self._requested
+            try:
+                if batch:
+                    self._write_or_spool(batch)
+                self._recover_claims()
+                self._replay_spool()
+            except Exception:
+                logging.error("Can't write activations, traceback:")
+                logging.error(traceback.format_exc())
+            with self._condition:
+                self._flushed = request
+                self._condition.notify_all()
+
+    def _write(self, batch):
+        counts = {}
+        for badge_id, *_ in batch:
+            counts[badge_id] = counts.get(badge_id, 0) + 1
+        with registry.time("vad_scanner_stage_seconds", "db_write"), self.db._cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, "INSERT INTO Activations VALUES %s", batch, page_size=len(batch))
+            psycopg2.extras.execute_values(cursor, "UPDATE Badges SET Activations = Activations + v.n "
+                                                   "FROM (VALUES %s) AS v(BadgeID, n) WHERE Badges.BadgeID = v.BadgeID",
+                                           list(counts.items()), page_size=len(counts))
+
+    def _write_or_spool(self, batch):
+        try:
+            self._write(batch)
+            logging.debug(f"Wrote {len(batch)} activations to the database")
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError) as e:
+            logging.error(f"Database is unreachable, spooling {len(batch)} activations: {e}")
+            self._spool(batch)
+        except psycopg2.Error as e:
+            logging.error(f"Can't write {len(batch)} activations, keeping them aside: {e}")
+            self._spool(batch, ".failed")
+
+    def _spool(self, batch, extension=".json"):
+        name = os.path.join(self.spool_dir, f"{time.time_ns()}-{os.getpid()}")
+        with open(f"{name}.tmp", "w") as f:
+            json.dump([(b, t.isoformat(), w, d) for b, t, w, d in batch], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{name}.tmp", f"{name}{extension}")
+
+    def _recover_claims(self):
+        # Batches claimed by a process that died before writing them go back to the spool
+        now = time.time()
+        for filename in os.listdir(self.spool_dir):
+            if not filename.endswith(".replay"):
+                continue
+            name, claimed, _ = filename.rsplit(".", 2)
+            if int(claimed) >= now - self.CLAIM_TIMEOUT:
+                continue
+            try:
+                os.rename(os.path.join(self.spool_dir, filename), os.path.join(self.spool_dir, f"{name}.json"))
+            except FileNotFoundError:
+                pass
+
+    def _replay_spool(self):
+        for filename in sorted(f for f in os.listdir(self.spool_dir) if f.endswith(".json")):
+            path = os.path.join(self.spool_dir, filename)
+            # Renaming claims the batch, when several processes share the spool only one of them writes it
+            claimed = f"{path[:-5]}.{int(time.time())}.replay"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed) as f:
+                batch = [(b, datetime.datetime.fromisoformat(t), w, d) for b, t, w, d in json.load(f)]
+            try:
+                self._write(batch)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError):
+                os.rename(claimed, path)
+                return
+            except psycopg2.Error as e:
+                logging.error(f"Can't write spooled activations {filename}, keeping them aside: {e}")
+                os.rename(claimed, f"{path[:-5]}.failed")
+                continue
+            os.remove(claimed)
+            logging.info(f"Wrote {len(batch)} spooled activations to the database")
+
+
 class BadgesDB(Singleton):
+    """
+    Thread-safe access to the badges database. Every query takes its own connection from a pool and
+    commits or rolls back on its own, so the API handlers and the worker threads don't share a cursor.
+
+    Existence and enabled state of badges are answered from an in-memory registry, which is updated
+    together with every write made through this class and reloaded every `registry_refresh` seconds
+    to pick up badges registered by other clients.
+    """
     _instance = None
 
-    def __init__(self, user:str,password:str, host:str, port:int):
+    def __init__(self, user: str, password: str, host: str, port: int,
+                 pool_min: int = 1, pool_max: int = 8, registry_refresh: float = 60, activations: dict = None):
+        if getattr(self, "pool", None) is not None:
+            return
         try:
-            self.conn = psycopg2.connect(dbname="vad",user=user,password=password,host=host,port=port)
-            self.cursor = self.conn.cursor()
+            self.pool = psycopg2.pool.ThreadedConnectionPool(pool_min, pool_max, dbname="vad", user=user,
+                                                             password=password, host=host, port=port)
             logging.info("Successfully connected to the database!")
         except Exception as e:
             tb_str = traceback.format_exc()
@@ -58,6 +207,27 @@ class BadgesDB(Singleton):
             logging.critical("Terminating...")
             raise e
 
+        self._registry = {}
+        self._registry_version = 0
+        self._registry_lock = threading.Lock()
+        self.registry_refresh = registry_refresh
+        self._refresh_thread = None
+        self.activations = ActivationSink(self, **(activations or {}))
+
+
+    @contextmanager
+    def _cursor(self):
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
 
     def init_db(self,force_recreate=False):
         logging.info("Initializing tables...")
@@ -65,6 +235,10 @@ class BadgesDB(Singleton):
             logging.info("force flag is on, tables are gonna be recreated")
             self._drop_tables()
         self._create_tables()
+        self.load_registry()
+        if self._refresh_thread is None and self.registry_refresh > 0:
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, name="badge-registry", daemon=True)
+            self._refresh_thread.start()
         logging.info("Done")
 
 
@@ -73,89 +247,128 @@ class BadgesDB(Singleton):
             drop_queries_text = "".join(l[:-1] for l in f.readlines())
         drop_queries = drop_queries_text.split(";")
 
-        for drop_query in drop_queries:
-            self.cursor.execute(drop_query)
+        with self._cursor() as cursor:
+            for drop_query in drop_queries:
+                cursor.execute(drop_query)
 
 
     def _create_tables(self):
         with open("create_queries.sql", "r") as f:
             queries_text = "".join(l[:-1] for l in f.readlines())
         queries = queries_text.split(";")
-        for query in queries:
-            self.cursor.execute(query)
-        for w in Wakeword:
-            self.cursor.execute("INSERT INTO Wakewords VALUES (%s,%s) ON CONFLICT (ID) DO NOTHING", (w.value, w.name))
-            self.conn.commit()
-            logging.info(f"Added '{w.name}' wakeword to the table")
+        with self._cursor() as cursor:
+            for query in queries:
+                cursor.execute(query)
+            for w in Wakeword:
+                cursor.execute("INSERT INTO Wakewords VALUES (%s,%s) ON CONFLICT (ID) DO NOTHING", (w.value, w.name))
+                logging.info(f"Added '{w.name}' wakeword to the table")
+
+
+    def load_registry(self):
+        with self._registry_lock:
+            version = self._registry_version
+        with self._cursor() as cursor:
+            cursor.execute("SELECT BadgeID, Enabled FROM Badges")
+            registry = {badge_id: bool(enabled) for badge_id, enabled in cursor.fetchall()}
+        with self._registry_lock:
+            # A write made while loading is newer than the snapshot, the next refresh picks it up
+            if version != self._registry_version:
+                return
+            self._registry = registry
+        logging.debug(f"Loaded {len(registry)} badges to the registry")
+
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.registry_refresh)
+            try:
+                self.load_registry()
+            except Exception:
+                logging.error("Can't refresh badge registry, traceback:")
+                logging.error(traceback.format_exc())
+
+
+    def _set_registry(self, badge_id: str, enabled):
+        with self._registry_lock:
+            self._registry_version += 1
+            if enabled is None:
+                self._registry.pop(badge_id, None)
+            else:
+                self._registry[badge_id] = enabled
 
 
     def register_badge(self, badge_id: str):
-        self.cursor.execute("INSERT INTO Badges VALUES (%s,%s,0,FALSE)", (badge_id, datetime.datetime.now()))
-        self.conn.commit()
+        with self._cursor() as cursor:
+            cursor.execute("INSERT INTO Badges VALUES (%s,%s,0,FALSE)", (badge_id, datetime.datetime.now()))
+        self._set_registry(badge_id, False)
         logging.debug(f"Registered new badge '{badge_id}' to the database")
 
 
-    def register_activation(self, badge_id: str, wakeword: Wakeword, duration: float):
-        self.cursor.execute("INSERT INTO Activations VALUES (%s,%s,%s,%s)",
-                            (badge_id, datetime.datetime.now(), wakeword.value, duration))
-        self.conn.commit()
+    def register_activation(self, badge_id: str, wakeword: Wakeword, duration: float,
+                            activated: datetime.datetime = None):
+        self.activations.register(badge_id, wakeword, duration, activated)
+
 
+    def _set_enabled(self, badge_id: str, enabled: bool):
+        # Returns True if the state changed, False if the badge already was in it.
+        # The state is only checked when the conditional update didn't match, so the common case is one round trip
+        with self._cursor() as cursor:
+            cursor.execute("UPDATE Badges SET Enabled = %s WHERE BadgeID = %s AND Enabled IS DISTINCT FROM %s "
+                           "RETURNING BadgeID", (enabled, badge_id, enabled))
+            if cursor.fetchone() is not None:
+                changed = True
+            else:
+                cursor.execute("SELECT Enabled FROM Badges WHERE BadgeID = %s", (badge_id,))
+                res = cursor.fetchone()
+                if res is None:
+                    self._set_registry(badge_id, None)
+                    raise BadgeNotFoundException(f"Badge {badge_id} does not exist")
+                changed = False
+        self._set_registry(badge_id, enabled)
+        return changed
 
 
     def enable_badge(self, badge_id: str):
-        if self.badge_exists(badge_id):
-            if not self.badge_enabled(badge_id):
-                self.cursor.execute("UPDATE Badges SET Enabled = TRUE WHERE BadgeID = %s", (badge_id,))
-                self.conn.commit()
-            else:
-                raise BadgeAlreadyEnabled(f"Badge {badge_id} already enabled!")
-        else:
-            raise BadgeNotFoundException(f"Badge {badge_id} does not exist")
+        if not self._set_enabled(badge_id, True):
+            raise BadgeAlreadyEnabled(f"Badge {badge_id} already enabled!")
 
 
     def disable_badge(self, badge_id: str):
-        if self.badge_exists(badge_id):
-            if self.badge_enabled(badge_id):
-                self.cursor.execute("UPDATE Badges SET Enabled = FALSE WHERE BadgeID = %s", (badge_id,))
-                self.conn.commit()
-            else:
-                raise BadgeAlreadyDisabled(f"Badge {badge_id} already disabled!")
-        else:
-            raise BadgeNotFoundException(f"Badge {badge_id} does not exist")
+        if not self._set_enabled(badge_id, False):
+            raise BadgeAlreadyDisabled(f"Badge {badge_id} already disabled!")
 
 
     def badge_enabled(self,badge_id: str):
-        if self.badge_exists(badge_id):
-            self.cursor.execute("SELECT Enabled FROM Badges WHERE BadgeID = %s",(badge_id,))
-            res = self.cursor.fetchone()
-            return res[0]
-        else:
+        with self._registry_lock:
+            enabled = self._registry.get(badge_id)
+        if enabled is None:
             raise BadgeNotFoundException(f"Badge {badge_id} does not exist")
+        return enabled
 
 
     def badge_exists(self, badge_id: str):
-        self.cursor.execute("SELECT BadgeID FROM Badges WHERE BadgeID = %s",(badge_id,))
-        badge_exists = self.cursor.fetchall()
-        if badge_exists:
-            return True
-        else:
-            return False
+        with self._registry_lock:
+            return badge_id in self._registry
 
 
     def get_active_badges(self):
-        self.cursor.execute("SELECT BadgeID FROM Badges WHERE Enabled = TRUE")
-        res = self.cursor.fetchall()
-        return [x[0] for x in res]
+        with self._registry_lock:
+            return [badge_id for badge_id, enabled in self._registry.items() if enabled]
 
 
     def __del__(self):
-        self.conn.close()
+        if getattr(self, "pool", None) is not None:
+            self.activations.flush(timeout=10)
+            self.pool.closeall()
 
 def init_db(config: Config):
     user = os.environ.get("DB_USER")
     password = os.environ.get("DB_PASS")
     if user and password:
-        db = BadgesDB(user,password,config.db_host,config.db_port)
+        db = BadgesDB(user, password, config.db_host, config.db_port,
+                      config.db_pool_min, config.db_pool_max, config.db_registry_refresh,
+                      {"batch_size": config.activation_batch, "flush_interval": config.activation_flush_ms / 1000,
+                       "spool_dir": config.activation_spool_dir})
         db.init_db()
         return db
     raise ValueError("Something went wrong with loading database credentials...")
\ No newline at end of file
@@ -0,0 +1,194 @@
+import threading
+import logging
+import asyncio
+import struct
+import io
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torchaudio
+
+from metrics import registry
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class DecodingError(Exception):
+    pass
+
+
+class DecoderBusy(Exception):
+    pass
+
+
+class InvalidFragment(Exception):
+    pass
+
+
+def sniff(data: bytes) -> str:
+    # Codec of an uploaded fragment by its magic bytes: wav, flac, opus (in Ogg) or other
+    if data[:4] == b"fLaC":
+        return "flac"
+    if data[:4] == b"OggS" and data[28:36] == b"OpusHead":
+        return "opus"
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    return "other"
+
+
+def parse_pcm_wav(data: bytes):
+    # Fast path for 16-bit mono PCM WAV files the badges send, the samples are
+    # a view of the uploaded bytes. Returns None for anything else.
+    if len(data) < 12 or data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        size = int.from_bytes(data[pos + 4:pos + 8], "little")
+        body = pos + 8
+
+        if chunk_id == b"fmt ":
+            if size < 16 or body + 16 > len(data):
+                return None
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", data, body)
+            if audio_format == WAVE_FORMAT_EXTENSIBLE and size >= 26:
+                audio_format = struct.unpack_from("<H", data, body + 24)[0]
+            fmt = (audio_format, channels, sample_rate, bits)
+
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            audio_format, channels, sample_rate, bits = fmt
+            if audio_format != WAVE_FORMAT_PCM or channels != 1 or bits != 16:
+                return None
+            # Recorders that didn't finalize the header leave the data size at 0 or 0xFFFFFFFF
+            if size == 0 or body + size > len(data):
+                size = len(data) - body
+            count = size // 2
+            return np.frombuffer(data, dtype="<i2", count=count, offset=body).reshape(1, count), sample_rate
+
+        pos = body + size + (size & 1)
+
+    return None
+
+
+def check_fragment(wav: np.ndarray, sr: int, sample_rate: int, min_samples: int):
+    # Decoded fragments the handlers can't take, rejected at upload time
+    if sr != sample_rate:
+        raise InvalidFragment(f"Fragment sample rate is {sr}, expected {sample_rate}")
+    if wav.shape[-1] < min_samples:
+        raise InvalidFragment(f"Fragment has {wav.shape[-1]} samples, expected at least {min_samples}")
+
+
+def decode_general(data: bytes):
+    try:
+        wav, sr = torchaudio.load(io.BytesIO(data), normalize=False)
+    except Exception as e:
+        raise DecodingError(f"Can't decode audio: {e}")
+    return wav.numpy(), sr
+
+
+def decode_compressed(data: bytes):
+    # FLAC and Ogg Opus through libsndfile, which decodes straight to int16 and doesn't hold the GIL,
+    # through torchaudio when soundfile isn't installed
+    if soundfile is None:
+        wav, sr = decode_general(data)
+        if wav.dtype.kind == "f":
+            wav = np.clip(wav * 32768, -32768, 32767).astype(np.int16)
+        return wav, sr
+    try:
+        samples, sr = soundfile.read(io.BytesIO(data), dtype="int16", always_2d=True)
+    except Exception as e:
+        raise DecodingError(f"Can't decode audio: {e}")
+    return np.ascontiguousarray(samples.T), sr
+
+
+def load_audio(path: str, sample_rate: int) -> np.ndarray:
+    # First channel of an audio file as int16 samples
+    with open(path, "rb") as f:
+        data = f.read()
+    parsed = parse_pcm_wav(data)
+    wav, sr = parsed if parsed is not None else decode_general(data)
+    if sr != sample_rate:
+        raise ValueError(f"{path} has sample rate {sr}, expected {sample_rate}")
+    return np.asarray(wav[0], dtype=np.int16)
+
+
+class DecodePool:
+    """
+    Decoding of uploaded fragments. 16-bit mono PCM WAV is parsed in place on the event loop, anything else
+    is decoded on `workers` threads. At most `max_pending` fragments wait for or run decoding, more are refused
+    with DecoderBusy instead of piling up in the executor queue.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 64):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.decode_workers, config.decode_max_pending)
+
+    async def decode(self, data: bytes):
+        # Returns samples with shape {C, N}, sample rate and codec of the fragment
+        parsed = parse_pcm_wav(data)
+        if parsed is not None:
+            return parsed + ("wav",)
+        codec = sniff(data)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise DecoderBusy(f"{self._pending} fragments are waiting for decoding")
+            self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            decoder = decode_compressed if codec in ("flac", "opus") else decode_general
+            wav, sr = await loop.run_in_executor(self._executor, decoder, data)
+        finally:
+            with self._lock:
+                self._pending -= 1
+        return wav, sr, codec
+
+
+class BadgeCodecs:
+    # Codec of the last fragment of every badge, published as vad_scanner_badge_codec, and uploaded bytes per codec
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._codecs = {}
+
+    def record(self, badge_id: str, codec: str, size: int, seconds: float):
+        with self._lock:
+            previous = self._codecs.get(badge_id)
+            self._codecs[badge_id] = codec
+        if previous != codec:
+            if previous is not None:
+                registry.discard("vad_scanner_badge_codec", badge_id, previous)
+                logging.info(f"Badge {badge_id} switched from {previous} to {codec} fragments")
+            registry.set("vad_scanner_badge_codec", 1, badge_id, codec)
+        registry.inc("vad_scanner_upload_bytes_total", codec, amount=size)
+        registry.inc("vad_scanner_upload_audio_seconds_total", codec, amount=seconds)
+
+    def discard(self, badge_id: str):
+        with self._lock:
+            codec = self._codecs.pop(badge_id, None)
+        if codec is not None:
+            registry.discard("vad_scanner_badge_codec", badge_id, codec)
+
+    def counts(self) -> dict:
+        # Badges per codec
+        with self._lock:
+            counts = {}
+            for codec in self._codecs.values():
+                counts[codec] = counts.get(codec, 0) + 1
+            return counts
@@ -1,35 +1,46 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
-import torchaudio
 import torch
 
-from multiprocessing import Queue
 import logging
+import json
 import os
 import time
 
 import database
+import decoding
+import fragment_queue
+import metrics
+import resources
+import snapshots
+import streaming
+import worker
 from audio_handler import BadgeAudioHandler
+from handler_cache import HandlerCache
 from model import BCResNet
+from model_registry import ModelRegistry, check_swap, init_model
+from scheduler import InferenceScheduler
+from worker_pool import FragmentWorkerPool
 from config import Config
 from utils import convert_size
+from vad import OnnxVADRuntime
 
 
-def init_model(config: Config) -> (BCResNet, torch.device):
-    # device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    device = torch.device("cpu")
-    model = BCResNet(2).to(device)
-    model.eval()
-    state_dict = torch.load(config.model_path, map_location=device)
-    model.load_state_dict(state_dict)
-    return model, device
+def init_scheduler(config: Config, model: BCResNet, device: torch.device) -> InferenceScheduler:
+    return InferenceScheduler(model, device, config.infer_max_batch, config.infer_max_wait_ms / 1000)
 
 
-def fill_active_badges(active_badges: dict, config: Config, db: database.BadgesDB, model: BCResNet,
-                       device: torch.device):
+def fill_active_badges(active_badges: HandlerCache, config: Config, db: database.BadgesDB,
+                       scheduler: InferenceScheduler):
+    # Handlers are created on the first fragment of a badge
+    active_badges.factory = lambda badge_id: BadgeAudioHandler(db, badge_id, config, scheduler)
+    if config.snapshot_dir:
+        active_badges.restore(snapshots.load_dir(config.snapshot_dir, config))
     for badge_id in db.get_active_badges():
-        active_badges[badge_id] = BadgeAudioHandler(db, badge_id, config, model, device)
+        active_badges.enable(badge_id)
 
 
 def init_config():
@@ -43,11 +54,28 @@ def init_config():
     raise ValueError("No config environment variable!")
 
 
-def main(fragments_queue: Queue, active_badges: dict):
-    config = init_config()
-    db = database.init_db(config)
+def main(config: Config, fragments_queue: fragment_queue.FragmentQueue, active_badges: HandlerCache):
+    resources.configure_process(config)
+    resources.log_layout(config)
     model, device = init_model(config)
-    fill_active_badges(active_badges, config, db, model, device)
+    pool = None
+    if config.workers > 0:
+        # Fragments go to worker processes, which are forked before the database connection is made
+        pool = FragmentWorkerPool(config, model, device)
+        fragments_queue = pool
+    db = database.init_db(config)
+    if pool is None:
+        scheduler = init_scheduler(config, model, device)
+        models = ModelRegistry.from_config(config, scheduler)
+        logging.info(f"Warmed up the models in {round(models.warm_up(), 2)} s")
+        fill_active_badges(active_badges, config, db, scheduler)
+    else:
+        for badge_id in db.get_active_badges():
+            pool.enable(badge_id)
+
+    decode_pool = decoding.DecodePool.from_config(config)
+    codecs = decoding.BadgeCodecs()
+    streams = streaming.StreamIngest(config, fragments_queue)
 
     logging.debug(f"Active badges: {list(active_badges.keys())}")
     # FastAPI
@@ -66,12 +94,20 @@ def main(fragments_queue: Queue, active_badges: dict):
     class StationInfo(BaseModel):
         StationID: str = ""
 
+    class ModelSwap(BaseModel):
+        model_path: str = None
+        model_int8_path: str = None
+        vad_model_path: str = None
+        wakeword: str = None
+
     @app.post("/enable", status_code=201)
     async def enable_badge(badge: BadgeInfo):
         try:
-            db.enable_badge(badge.BadgeID)
-            if badge.BadgeID not in active_badges:
-                active_badges[badge.BadgeID] = BadgeAudioHandler(db, badge.BadgeID, config, model, device)
+            await run_in_threadpool(db.enable_badge, badge.BadgeID)
+            if pool is not None:
+                pool.enable(badge.BadgeID)
+            else:
+                active_badges.enable(badge.BadgeID)
             logging.debug(f"Registered enabled state on badge {badge.BadgeID} in the database")
             return {"status": "success"}
         except database.BadgeNotFoundException:
@@ -82,9 +118,14 @@ def main(fragments_queue: Queue, active_badges: dict):
     @app.post("/disable", status_code=201)
     async def disable_badge(badge: BadgeInfo):
         try:
-            db.disable_badge(badge.BadgeID)
-            if badge.BadgeID in active_badges:
+            await run_in_threadpool(db.disable_badge, badge.BadgeID)
+            if pool is not None:
+                pool.disable(badge.BadgeID)
+            elif badge.BadgeID in active_badges:
                 del active_badges[badge.BadgeID]
+                metrics.registry.discard("vad_scanner_badge_rtf", badge.BadgeID)
+            metrics.registry.discard("vad_scanner_badge_ingestion_lag_seconds", badge.BadgeID)
+            codecs.discard(badge.BadgeID)
             logging.debug(f"Registered disabled state on badge {badge.BadgeID} in the database")
             return {"status": "success"}
         except database.BadgeNotFoundException:
@@ -94,16 +135,135 @@ def main(fragments_queue: Queue, active_badges: dict):
 
     @app.post("/upload", status_code=202)
     async def fragment_upload(BadgeID: str = Form(...), upload_file: UploadFile = File(...)):
+        received = time.time()
         if db.badge_exists(BadgeID):
-            file = upload_file.file
-            wav, sr = torchaudio.load(file, normalize=False)
-            wav = wav.numpy()
-            assert sr == config.sample_rate
-            logging.info(f"Recieved fragment {upload_file.filename} from badge {BadgeID}, duration: {round(wav.size / sr, 2)} seconds")
-            fragments_queue.put((BadgeID, wav, upload_file.filename))
+            data = await upload_file.read()
+            try:
+                with metrics.registry.time("vad_scanner_stage_seconds", "decode"):
+                    wav, sr, codec = await decode_pool.decode(data)
+            except decoding.DecodingError as e:
+                raise HTTPException(status_code=415, detail=f'Can\'t decode fragment "{upload_file.filename}": {e}')
+            except decoding.DecoderBusy as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            try:
+                decoding.check_fragment(wav, sr, config.sample_rate, OnnxVADRuntime.MIN_CHUNK_SAMPLES)
+            except decoding.InvalidFragment as e:
+                raise HTTPException(status_code=422, detail=f'Invalid fragment "{upload_file.filename}": {e}')
+            codecs.record(BadgeID, codec, len(data), wav.shape[-1] / sr)
+            logging.info(f"Recieved fragment {upload_file.filename} from badge {BadgeID}, duration: {round(wav.shape[-1] / sr, 2)} seconds, codec: {codec}")
+            recording_start = BadgeAudioHandler.recording_start(upload_file.filename)
+            if recording_start is not None:
+                lag = received - recording_start - wav.shape[-1] / sr
+                metrics.registry.observe("vad_scanner_ingestion_lag_seconds", lag)
+                metrics.registry.set("vad_scanner_badge_ingestion_lag_seconds", lag, BadgeID)
+            try:
+                fragments_queue.put((BadgeID, wav, upload_file.filename, received))
+            except fragment_queue.BadgeOverShare as e:
+                raise HTTPException(status_code=429, detail=str(e))
+            except fragment_queue.QueueFull as e:
+                raise HTTPException(status_code=503, detail=str(e))
         else:
             raise HTTPException(status_code=404, detail=f'Badge "{BadgeID}" is not registered')
 
+    @app.websocket("/stream/{BadgeID}")
+    async def stream_websocket(websocket: WebSocket, BadgeID: str):
+        # Hello {"stream_id", "start", "offset"} as text, then little-endian int16 PCM as binary messages,
+        # every one acknowledged with the received and committed sample offsets. {"end": true} ends the stream
+        await websocket.accept()
+        if not db.badge_exists(BadgeID):
+            await websocket.close(code=4404, reason=f'Badge "{BadgeID}" is not registered')
+            return
+        hello = await websocket.receive_json()
+        try:
+            session = streams.open(BadgeID, str(hello.get("stream_id", "default")), hello.get("start"),
+                                   hello.get("offset"))
+        except streaming.StreamOffsetMismatch as e:
+            await websocket.send_json({"error": str(e), "offset": e.expected})
+            await websocket.close(code=4409)
+            return
+        connection = session.connection
+        await websocket.send_json({"offset": session.offset, "committed": session.committed,
+                                   "window": streams.window_samples})
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    await streams.push(session, message["bytes"], connection)
+                elif json.loads(message["text"]).get("end"):
+                    await streams.end(session, connection)
+                    await websocket.send_json({"offset": session.offset, "committed": session.committed})
+                    await websocket.close()
+                    break
+                await websocket.send_json({"offset": session.offset, "committed": session.committed})
+        except WebSocketDisconnect:
+            pass
+        except streaming.StreamTakenOver as e:
+            logging.warning(str(e))
+            await websocket.close(code=4409)
+        finally:
+            streams.close(session, connection)
+
+    @app.post("/stream/{BadgeID}")
+    async def stream_http(BadgeID: str, request: Request, stream_id: str = "default", offset: int = None,
+                          start: float = None, end: bool = False):
+        # Chunked request body of little-endian int16 PCM continuing the stream at `offset`
+        if not db.badge_exists(BadgeID):
+            raise HTTPException(status_code=404, detail=f'Badge "{BadgeID}" is not registered')
+        try:
+            session = streams.open(BadgeID, stream_id, start, offset)
+        except streaming.StreamOffsetMismatch as e:
+            raise HTTPException(status_code=409, detail={"error": str(e), "offset": e.expected})
+        connection = session.connection
+        try:
+            async for data in request.stream():
+                await streams.push(session, data, connection)
+            if end:
+                await streams.end(session, connection)
+        except streaming.StreamTakenOver as e:
+            raise HTTPException(status_code=409, detail={"error": str(e), "offset": session.offset})
+        finally:
+            streams.close(session, connection)
+        return {"offset": session.offset, "committed": session.committed}
+
+    @app.get("/stats")
+    async def get_stats():
+        if pool is not None:
+            snapshots = await run_in_threadpool(pool.stats)
+            return {"workers": worker.summarize(snapshots), "codecs": codecs.counts()}
+        return {"fragments": worker.summarize([worker.stats.snapshot()]), "scheduler": scheduler.stats(),
+                "codecs": codecs.counts()}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        snapshots = [metrics.registry.snapshot()]
+        if pool is not None:
+            snapshots += await run_in_threadpool(pool.metrics)
+        return PlainTextResponse(metrics.render(metrics.merge(snapshots)),
+                                 media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.post("/admin/models", status_code=202)
+    async def swap_models(swap: ModelSwap):
+        # Loads, warms up and validates the new models in the background, GET /admin/models reports how it went
+        try:
+            check_swap(config, **swap.dict())
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if pool is not None:
+            started = await run_in_threadpool(pool.swap_models, swap.dict())
+        else:
+            started = models.swap(**swap.dict())
+        if not started:
+            raise HTTPException(status_code=409, detail="Another model swap is still running")
+        return {"status": "loading"}
+
+    @app.get("/admin/models")
+    async def get_models():
+        if pool is not None:
+            return {"workers": await run_in_threadpool(pool.models)}
+        return models.status()
+
     @app.get("/ping")
     async def pong():
         return "pong"
@@ -129,8 +289,16 @@ def main(fragments_queue: Queue, active_badges: dict):
         else:
             raise HTTPException(status_code=404,detail=f"Station {StationID} is not found!")
 
+    def drain():
+        if pool is not None:
+            pool.close(config.drain_timeout)
+        elif not worker.stop(config.drain_timeout + 10):
+            logging.error("Fragments consumer didn't stop in time")
+        db.activations.flush(config.drain_timeout)
 
+    @app.on_event("shutdown")
+    async def shutdown():
+        # Queued fragments are processed for up to drain_timeout, then the handler state is saved
+        await run_in_threadpool(drain)
 
-
-
-    uvicorn.run(app, host="0.0.0.0", port=8020, log_level="info")
+    uvicorn.run(app, host="0.0.0.0", port=config.api_port, log_level="info")
@@ -0,0 +1,167 @@
+from collections import deque
+
+import numpy as np
+import torch
+import torchaudio
+
+
+def make_spectrogrammer(config) -> torch.nn.Sequential:
+    # Mel front-end of the wake-word model, the same for inference and for calibration/evaluation tools
+    return torch.nn.Sequential(
+        torchaudio.transforms.MelSpectrogram(
+            sample_rate=config.sample_rate,
+            n_fft=config.n_fft,
+            win_length=config.win_length,
+            hop_length=config.hop_length,
+            center=True,
+            pad_mode="reflect",
+            power=2.0,
+            norm='slaney',
+            onesided=True,
+            n_mels=config.n_mels,
+            mel_scale="htk",
+        )
+    )
+
+
+_spectrogrammers = {}
+
+
+def shared_spectrogrammer(config) -> torch.nn.Sequential:
+    # One mel front-end per set of parameters, shared by the handlers of a process, its filterbank
+    # and window are only read during inference
+    key = (config.sample_rate, config.n_fft, config.win_length, config.hop_length, config.n_mels)
+    spectrogrammer = _spectrogrammers.get(key)
+    if spectrogrammer is None:
+        spectrogrammer = _spectrogrammers[key] = make_spectrogrammer(config)
+    return spectrogrammer
+
+
+def window_features(spectrogrammer: torch.nn.Sequential, window: np.ndarray) -> torch.Tensor:
+    # Max normalised log-mel of an int16 analysis window, as the model gets it
+    spec = torch.log(spectrogrammer(torch.from_numpy(window).float()) + 1e-8)
+    spec -= spec.max()
+    return spec
+
+
+class IncrementalLogMel:
+    """
+    Log-mel front-end over a sliding analysis window that only computes the frames of new samples.
+
+    Frames are kept in a ring buffer written twice (slot and slot + T), so that the current window is
+    always a contiguous view of it. With center=True and reflect padding the first and last couple of
+    frames of a window depend on the padding, so these edge frames are recomputed for every window,
+    all other frames are computed once from the samples they cover. The running max of the window
+    is tracked with a monotonic deque over the frame maxima.
+
+    Frames go through the same STFT, mel and log ops as in the full-window MelSpectrogram and match
+    it exactly on the builds we run, the tolerance we hold it to is 1e-4 absolute log-mel difference
+    in case FFT summation order differs between builds (checked by tests/test_frontend.py).
+    """
+
+    def __init__(self, spectrogrammer: torchaudio.transforms.MelSpectrogram, window_size: int):
+        self.spectrogrammer = spectrogrammer
+        self.stft = spectrogrammer.spectrogram
+        self.mel_scale = spectrogrammer.mel_scale
+
+        self.window_size = window_size
+        self.hop = self.stft.hop_length
+        self.frames = window_size // self.hop + 1
+
+        half = self.stft.n_fft // 2
+        self.left_edge = -(-half // self.hop)
+        self.right_edge = self.frames - 1 - (window_size - half) // self.hop
+
+        self._buffer = torch.zeros(self.mel_scale.n_mels, 2 * self.frames)
+        self.reset()
+
+    @property
+    def nbytes(self) -> int:
+        return self._buffer.numel() * self._buffer.element_size()
+
+    def reset(self):
+        self._end = None  # absolute index of the frame following the window
+        self._maxima = deque()  # (absolute frame index, frame max) of interior frames, decreasing
+
+    def __call__(self, window: np.ndarray, shift=None):
+        # window: int16 analysis window, shift: number of samples it moved since the previous call, None if unknown
+        # Returns log-mel window with shape {F, T} (a view of the ring buffer) and its max as float
+        interior = self.frames - self.left_edge - self.right_edge
+        if (self._end is None or shift is None or shift % self.hop != 0 or interior <= 0
+                or shift // self.hop >= interior):
+            return self._full(window)
+
+        shift //= self.hop
+        self._end += shift
+        first = self._end - self.frames
+        half = self.stft.n_fft // 2
+
+        # New interior frames and the right edge frames come from one STFT over the tail of the window
+        lo = max(self.left_edge, self.frames - self.right_edge - shift)
+        tail = self._log_mel(self._pad(window[lo * self.hop - half:], 0, half))
+        self._push(first + lo, tail)
+        for j, frame_max in enumerate(tail[:, :tail.shape[-1] - self.right_edge].max(0).values.tolist()):
+            self._push_max(first + lo + j, frame_max)
+
+        while self._maxima[0][0] < first + self.left_edge:
+            self._maxima.popleft()
+
+        left = self._log_mel(self._pad(window[:(self.left_edge - 1) * self.hop + half], half, 0))
+        view = self._view()
+        view[:, :self.left_edge] = left
+
+        spec_max = max(self._maxima[0][1], left.max().item(), tail[:, -self.right_edge:].max().item())
+        return view, spec_max
+
+    def _full(self, window):
+        spec = torch.log(self.spectrogrammer(torch.from_numpy(window).float()) + 1e-8)
+
+        self._end = self.frames
+        self._push(0, spec)
+        self._maxima.clear()
+        for j, frame_max in enumerate(spec[:, self.left_edge:self.frames - self.right_edge].max(0).values.tolist()):
+            self._push_max(self.left_edge + j, frame_max)
+
+        return self._view(), spec.max().item()
+
+    def _view(self):
+        start = (self._end - self.frames) % self.frames
+        return self._buffer[:, start:start + self.frames]
+
+    def _push(self, first, spec):
+        # Writes frames starting from absolute index first, the window never wraps more than once
+        start = first % self.frames
+        n = spec.shape[-1]
+        head = min(n, self.frames - start)
+        self._buffer[:, start:start + head] = spec[:, :head]
+        self._buffer[:, start + self.frames:start + self.frames + head] = spec[:, :head]
+        if head < n:
+            self._buffer[:, :n - head] = spec[:, head:]
+            self._buffer[:, self.frames:self.frames + n - head] = spec[:, head:]
+
+    def _push_max(self, index, frame_max):
+        while self._maxima and self._maxima[-1][1] <= frame_max:
+            self._maxima.pop()
+        self._maxima.append((index, frame_max))
+
+    def _pad(self, segment, left, right):
+        # Same reflect padding as center=True applies to the whole window
+        segment = torch.from_numpy(segment).float()
+        if not left and not right:
+            return segment
+        return torch.nn.functional.pad(segment.view(1, 1, -1), (left, right), mode=self.stft.pad_mode).view(-1)
+
+    def _log_mel(self, segment):
+        spec = torchaudio.functional.spectrogram(
+            segment,
+            pad=self.stft.pad,
+            window=self.stft.window,
+            n_fft=self.stft.n_fft,
+            hop_length=self.hop,
+            win_length=self.stft.win_length,
+            power=self.stft.power,
+            normalized=self.stft.normalized,
+            center=False,
+            onesided=True,
+        )
+        return torch.log(self.mel_scale(spec) + 1e-8)
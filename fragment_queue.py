@@ -0,0 +1,140 @@
+import threading
+import logging
+
+from collections import deque
+
+from config import Config
+from metrics import registry
+
+POLICIES = ("reject", "drop_oldest", "vad_only")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class BadgeOverShare(QueueFull):
+    pass
+
+
+class FragmentQueue:
+    """
+    Fragments waiting for processing, in a queue per badge. The worker takes the next fragment of a badge
+    once its handler is idle and moves every running badge by one chunk per tick, so each badge with queued
+    audio gets the same share of the worker, however much it sends.
+
+    Queued audio is capped at `max_seconds`, a fragment that doesn't fit is handled by `policy`:
+    "reject" refuses it, with BadgeOverShare if its badge holds more than an even share of the cap, and
+    QueueFull otherwise. "drop_oldest" drops the oldest fragments of the badge with the most queued audio.
+    "vad_only" refuses like "reject" and also runs fragments through VAD only, without the wake-word model,
+    while the queue is above `vad_only_fraction` of the cap, so the backlog drains faster.
+    """
+
+    def __init__(self, max_seconds: float, policy: str = "reject", sample_rate: int = 16000,
+                 vad_only_fraction: float = 0.5, shared=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overload policy: {policy}, expected one of {POLICIES}")
+        self.sample_rate = sample_rate
+        self.max_samples = int(max_seconds * sample_rate)
+        self.policy = policy
+        self.vad_only_samples = int(vad_only_fraction * self.max_samples)
+        # multiprocessing.Value the queued audio seconds are published to, for the process that feeds the queue
+        self.shared = shared
+
+        self._condition = threading.Condition()
+        self._queues = {}
+        self._samples = {}
+        self._total = 0
+
+    @classmethod
+    def from_config(cls, config: Config, max_seconds: float = None, shared=None):
+        return cls(config.queue_max_seconds if max_seconds is None else max_seconds, config.queue_policy,
+                   config.sample_rate, config.queue_vad_only_fraction, shared)
+
+    def put(self, item):
+        badge_id, fragment, filename, received = item
+        size = fragment.shape[-1]
+        with self._condition:
+            if self._total + size > self.max_samples:
+                self._make_room(badge_id, size, filename)
+            self._queues.setdefault(badge_id, deque()).append((fragment, filename, received))
+            self._samples[badge_id] = self._samples.get(badge_id, 0) + size
+            self._total += size
+            self._publish()
+            self._condition.notify()
+
+    def pop(self, badge_id: str):
+        # Next fragment of the badge as (fragment, filename, received, vad_only), None if it has nothing queued
+        with self._condition:
+            queue = self._queues.get(badge_id)
+            if not queue:
+                return None
+            fragment, filename, received = queue.popleft()
+            vad_only = self.policy == "vad_only" and self._total > self.vad_only_samples
+            self._remove(badge_id, fragment.shape[-1])
+        if vad_only:
+            registry.inc("vad_scanner_shed_fragments_total", "vad_only")
+            logging.warning(f"Queue is over {self.vad_only_samples / self.sample_rate} s of audio, "
+                            f"running fragment {filename} of badge {badge_id} through VAD only")
+        return fragment, filename, received, vad_only
+
+    def discard(self, badge_id: str) -> list:
+        # Removes the queued fragments of the badge and returns them as (fragment, filename, received)
+        with self._condition:
+            queue = self._queues.get(badge_id)
+            if not queue:
+                return []
+            items = list(queue)
+            queue.clear()
+            self._remove(badge_id, sum(fragment.shape[-1] for fragment, _, _ in items))
+            return items
+
+    def badges(self) -> list:
+        with self._condition:
+            return list(self._queues)
+
+    def wait(self, timeout: float = None) -> bool:
+        # Blocks until any fragment is queued
+        with self._condition:
+            return self._condition.wait_for(lambda: bool(self._queues), timeout)
+
+    @property
+    def queued_seconds(self) -> float:
+        return self._total / self.sample_rate
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _make_room(self, badge_id, size, filename):
+        if self.policy == "drop_oldest" and size <= self.max_samples:
+            while self._total + size > self.max_samples:
+                largest = max(self._samples, key=self._samples.get)
+                fragment, dropped, _ = self._queues[largest][0]
+                self._remove(largest, fragment.shape[-1], popleft=True)
+                registry.inc("vad_scanner_shed_fragments_total", "dropped")
+                logging.warning(f"Queue is full, dropped fragment {dropped} of badge {largest}")
+            return
+
+        registry.inc("vad_scanner_shed_fragments_total", "rejected")
+        share = self.max_samples / (len(self._queues) + (badge_id not in self._queues))
+        if self._samples.get(badge_id, 0) + size > share:
+            raise BadgeOverShare(f"Badge {badge_id} has {self._samples.get(badge_id, 0) / self.sample_rate} s "
+                                 f"of audio queued, over its share of {share / self.sample_rate} s")
+        raise QueueFull(f"Queue is full with {self.queued_seconds} s of audio, can't take {filename}")
+
+    def _remove(self, badge_id, size, popleft=False):
+        if popleft:
+            self._queues[badge_id].popleft()
+        self._samples[badge_id] -= size
+        self._total -= size
+        if not self._queues[badge_id]:
+            del self._queues[badge_id]
+            del self._samples[badge_id]
+        self._publish()
+
+    def _publish(self):
+        seconds = self.queued_seconds
+        registry.set("vad_scanner_queued_audio_seconds", seconds)
+        if self.shared is not None:
+            self.shared.value = seconds
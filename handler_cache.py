@@ -0,0 +1,157 @@
+import threading
+import logging
+
+from collections import OrderedDict
+
+from config import Config
+from metrics import registry
+
+
+class HandlerCache:
+    """
+    BadgeAudioHandlers of the enabled badges, used in place of a dict of them. A handler is created by
+    `factory` on the first fragment of its badge, so enabling a badge costs nothing until it sends audio.
+    Handlers are kept in LRU order, when their buffers take more than `memory_budget` bytes the least
+    recently used idle ones are evicted and only the state needed to resume them is kept (BadgeAudioHandler.park).
+
+    States restored from a snapshot resume the handler of their badge once it is enabled here and sends audio.
+    Handlers of removed badges are retired and their pending recordings finished by `flush_retired`, which
+    runs on the fragment worker thread, like the processing of the handlers.
+    """
+
+    def __init__(self, factory=None, memory_budget: int = 0):
+        self.factory = factory
+        self.memory_budget = memory_budget
+
+        self._lock = threading.RLock()
+        self._enabled = set()
+        self._handlers = OrderedDict()
+        self._parked = {}
+        self._restored = {}
+        self._retired = []
+
+    @classmethod
+    def from_config(cls, config: Config, factory=None, workers: int = 1):
+        return cls(factory, int(config.handler_memory_mb * 2 ** 20 / workers))
+
+    def enable(self, badge_id: str):
+        with self._lock:
+            self._enabled.add(badge_id)
+
+    def __getitem__(self, badge_id: str):
+        with self._lock:
+            handler = self._handlers.get(badge_id)
+            if handler is not None:
+                self._handlers.move_to_end(badge_id)
+                return handler
+            if badge_id not in self._enabled:
+                raise KeyError(badge_id)
+            handler = self.factory(badge_id)
+            state = self._parked.pop(badge_id, None) or self._restored.pop(badge_id, None)
+            if state is not None:
+                handler.resume(state)
+            self._handlers[badge_id] = handler
+            self._evict()
+            return handler
+
+    def __setitem__(self, badge_id: str, handler):
+        with self._lock:
+            self._enabled.add(badge_id)
+            self._parked.pop(badge_id, None)
+            self._restored.pop(badge_id, None)
+            self._handlers[badge_id] = handler
+            self._evict()
+
+    def __delitem__(self, badge_id: str):
+        with self._lock:
+            if badge_id not in self._enabled:
+                raise KeyError(badge_id)
+            self._enabled.discard(badge_id)
+            handler = self._handlers.pop(badge_id, None)
+            state = self._parked.pop(badge_id, None) or self._restored.pop(badge_id, None)
+            if state is not None and state["recording"]:
+                handler = self.factory(badge_id)
+                handler.resume(state)
+            if handler is not None:
+                self._retired.append(handler)
+            self._publish()
+
+    def __contains__(self, badge_id: str) -> bool:
+        with self._lock:
+            return badge_id in self._enabled
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._enabled))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._enabled)
+
+    def keys(self) -> list:
+        return list(self)
+
+    def release(self, badge_id: str):
+        # Removes the badge without finishing its recording, returns the state to resume it from in another
+        # process, None if it had none
+        with self._lock:
+            self._enabled.discard(badge_id)
+            handler = self._handlers.pop(badge_id, None)
+            state = self._parked.pop(badge_id, None) or self._restored.pop(badge_id, None)
+            if handler is not None:
+                state = handler.park()
+            self._publish()
+            return state
+
+    def restore(self, states: dict):
+        with self._lock:
+            self._restored.update(states)
+
+    def snapshot(self) -> dict:
+        # States of the enabled badges, with the analysis window of the live handlers
+        with self._lock:
+            states = {badge_id: state for badge_id, state in self._restored.items() if badge_id in self._enabled}
+            states.update(self._parked)
+            for badge_id, handler in self._handlers.items():
+                states[badge_id] = handler.snapshot()
+            return states
+
+    def flush_retired(self):
+        with self._lock:
+            retired, self._retired = self._retired, []
+        for handler in retired:
+            handler.flush_recording()
+
+    def drain(self):
+        # Finishes the pending recordings of every badge, on shutdown without a snapshot to resume them from
+        with self._lock:
+            for badge_id in self._enabled:
+                state = self._parked.get(badge_id) or self._restored.get(badge_id)
+                if state is not None and state["recording"] and badge_id not in self._handlers:
+                    self._parked.pop(badge_id, None)
+                    self._restored.pop(badge_id, None)
+                    self._handlers[badge_id] = self.factory(badge_id)
+                    self._handlers[badge_id].resume(state)
+            handlers = list(self._handlers.values())
+        self.flush_retired()
+        for handler in handlers:
+            handler.flush_recording()
+
+    def _evict(self):
+        if self.memory_budget:
+            total = sum(handler.nbytes() for handler in self._handlers.values())
+            # The most recently used handler is the one being handed out
+            for badge_id, handler in list(self._handlers.items())[:-1]:
+                if total <= self.memory_budget:
+                    break
+                if handler.fragment_in_progress():
+                    continue
+                total -= handler.nbytes()
+                self._parked[badge_id] = handler.park()
+                del self._handlers[badge_id]
+                logging.debug(f"Evicted the idle handler of badge {badge_id}")
+        self._publish()
+
+    def _publish(self):
+        registry.set("vad_scanner_badge_handlers", len(self._handlers), "live")
+        registry.set("vad_scanner_badge_handlers", len(self._parked), "parked")
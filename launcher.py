@@ -1,9 +1,11 @@
 import threading
-import queue
 import logging
 
 import fast_api
+import snapshots
 import worker
+from fragment_queue import FragmentQueue
+from handler_cache import HandlerCache
 from utils import init_logging
 
 
@@ -14,12 +16,20 @@ if __name__ == "__main__":
 
     init_logging()
 
-    fragments_queue = queue.Queue()
-    active_badges = {}
+    config = fast_api.init_config()
 
-    fragments_consumer = threading.Thread(target=worker.process_badge_fragment,args=(fragments_queue,active_badges))
+    fragments_queue = FragmentQueue.from_config(config)
+    active_badges = HandlerCache.from_config(config)
 
-    fragments_consumer.start()
+    if config.workers == 0:
+        fragments_consumer = threading.Thread(target=worker.process_badge_fragment,
+                                              args=(fragments_queue, active_badges, config,
+                                                    snapshots.snapshot_path(config)))
 
-    fast_api.main(fragments_queue,active_badges)
+        fragments_consumer.start()
+
+    fast_api.main(config,fragments_queue,active_badges)
+
+    if config.workers == 0:
+        fragments_consumer.join()
 
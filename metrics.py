@@ -0,0 +1,177 @@
+import threading
+import bisect
+import time
+
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# name: (type, help, label names, histogram buckets)
+METRICS = {
+    "vad_scanner_fragment_queue_depth": (
+        "gauge", "Fragments waiting for processing or in progress, of the busiest fragment worker", (), None),
+    "vad_scanner_queued_audio_seconds": (
+        "gauge", "Audio of the fragments waiting for processing, of the busiest fragment worker", (), None),
+    "vad_scanner_shed_fragments_total": (
+        "counter", "Fragments rejected, dropped or run through VAD only because the queue was over its cap",
+        ("action",), None),
+    "vad_scanner_chunks_total": (
+        "counter", "Chunks run through the VAD model or skipped as silent by the energy gate, when it is on",
+        ("result",), None),
+    "vad_scanner_stage_seconds": (
+        "histogram", "Time spent in a pipeline stage per call, VAD and model calls are batched over badges",
+        ("stage",), STAGE_BUCKETS),
+    "vad_scanner_fragment_latency_seconds": (
+        "histogram", "Time from the upload of a fragment to the decision on its last chunk", (), LATENCY_BUCKETS),
+    "vad_scanner_ingestion_lag_seconds": (
+        "histogram", "Time from the end of a recorded fragment, by its file name, to its upload", (), LATENCY_BUCKETS),
+    "vad_scanner_badge_ingestion_lag_seconds": (
+        "gauge", "Ingestion lag of the last uploaded fragment of a badge", ("badge_id",), None),
+    "vad_scanner_badge_handlers": (
+        "gauge", "Badge handlers in memory (live) and evicted ones kept as compact state (parked), of the fragment "
+                 "worker with the most of them", ("state",), None),
+    "vad_scanner_streams": (
+        "gauge", "Badge audio streams with a connection open", (), None),
+    "vad_scanner_badge_rtf": (
+        "gauge", "Real-time factor of the last processed fragment of a badge, processing time over audio duration",
+        ("badge_id",), None),
+    "vad_scanner_fragments_total": (
+        "counter", "Processed fragments", (), None),
+    "vad_scanner_audio_seconds_total": (
+        "counter", "Processed audio", (), None),
+    "vad_scanner_badge_codec": (
+        "gauge", "Codec of the last uploaded fragment of a badge", ("badge_id", "codec"), None),
+    "vad_scanner_upload_bytes_total": (
+        "counter", "Uploaded fragment bytes by codec", ("codec",), None),
+    "vad_scanner_upload_audio_seconds_total": (
+        "counter", "Uploaded fragment audio by codec", ("codec",), None),
+    "vad_scanner_model_swap_seconds": (
+        "gauge", "Duration of the stages of the last model swap: load, warmup and validate", ("stage",), None),
+    "vad_scanner_detections_total": (
+        "counter", "Windows the model scored above the certainty threshold", ("badge_id", "wakeword"), None),
+    "vad_scanner_activations_total": (
+        "counter", "Finished recordings registered as activations", ("badge_id", "wakeword"), None),
+}
+
+
+class _Timer:
+    __slots__ = ("registry", "name", "labels", "started")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    """
+    Process-local metrics of METRICS, keyed by name and label values. An update is a dict lookup and
+    an addition under a lock, so instrumentation stays on in the per-chunk loop. Snapshots are plain
+    dicts, fragment workers send theirs to the API process, which merges and renders them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+
+    def inc(self, name: str, *labels, amount: float = 1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, *labels):
+        with self._lock:
+            self._values[(name, labels)] = value
+
+    def observe(self, name: str, value: float, *labels):
+        key = (name, labels)
+        buckets = METRICS[name][3]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+    def time(self, name: str, *labels) -> _Timer:
+        return _Timer(self, name, labels)
+
+    def discard(self, name: str, *labels):
+        with self._lock:
+            self._values.pop((name, labels), None)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"values": dict(self._values),
+                    "histograms": {key: (list(counts), total) for key, (counts, total) in self._histograms.items()}}
+
+
+def merge(snapshots: list) -> dict:
+    # Counters and histograms are summed over processes. A per-badge gauge is set by the one process handling
+    # the badge, the other gauges are set by every process and the largest value is kept
+    values = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for key, value in snapshot["values"].items():
+            kind, _, label_names, _ = METRICS[key[0]]
+            if key not in values:
+                values[key] = value
+            elif kind == "gauge" and "badge_id" not in label_names:
+                values[key] = max(values[key], value)
+            else:
+                values[key] += value
+        for key, (counts, total) in snapshot["histograms"].items():
+            if key in histograms:
+                merged, merged_total = histograms[key]
+                histograms[key] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+            else:
+                histograms[key] = (counts, total)
+    return {"values": values, "histograms": histograms}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(snapshot: dict) -> str:
+    # Prometheus text exposition format
+    lines = []
+    for name, (kind, help_text, label_names, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for (key_name, labels), (counts, total) in sorted(snapshot["histograms"].items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, counts):
+                    cumulative += count
+                    bucket = _labels(label_names, labels, f'le="{bound}"')
+                    lines.append(f"{name}_bucket{bucket} {cumulative}")
+                cumulative += counts[-1]
+                bucket = _labels(label_names, labels, 'le="+Inf"')
+                lines.append(f"{name}_bucket{bucket} {cumulative}")
+                lines.append(f"{name}_sum{_labels(label_names, labels)} {total}")
+                lines.append(f"{name}_count{_labels(label_names, labels)} {cumulative}")
+        else:
+            for (key_name, labels), value in sorted(snapshot["values"].items()):
+                if key_name == name:
+                    lines.append(f"{name}{_labels(label_names, labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -1,3 +1,5 @@
+import copy
+
 import torch
 from torch import Tensor
 import torch.nn as nn
@@ -124,6 +126,93 @@ class TransitionBlock(nn.Module):
         return out
 
 
+def _fold_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Conv2d:
+    # Conv followed by BN in eval mode as one conv with bias
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+class SubSpectralAffine(nn.Module):
+    """
+    SubSpectralNorm in eval mode as a per channel and sub-band scale and shift. The scale differs between
+    sub-bands of a channel, so unlike BatchNorm it can't be folded into the depthwise conv before it.
+    """
+
+    def __init__(self, ssn: SubSpectralNorm):
+        super(SubSpectralAffine, self).__init__()
+        self.S = ssn.S
+        bn = ssn.bn
+        with torch.no_grad():
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            shift = bn.bias - bn.running_mean * scale
+        C = bn.num_features // self.S
+        self.register_buffer("scale", scale.view(1, C, self.S, 1, 1).clone())
+        self.register_buffer("shift", shift.view(1, C, self.S, 1, 1).clone())
+
+    def forward(self, x):
+        N, C, F, T = x.size()
+        x = x.view(N, C, self.S, F // self.S, T)
+        return torch.addcmul(self.shift, x, self.scale).view(N, C, F, T)
+
+
+class FusedBroadcastedBlock(BroadcastedBlock):
+    """
+    BroadcastedBlock for inference: BN folded into temp_dw_conv, SubSpectralNorm as an affine,
+    no dropout and no copies of intermediate tensors. The removed layers are kept as Identity,
+    so the block can be used wherever a BroadcastedBlock is expected.
+    """
+
+    def __init__(self, block: BroadcastedBlock):
+        nn.Module.__init__(self)
+        self.freq_dw_conv = block.freq_dw_conv
+        self.ssn1 = SubSpectralAffine(block.ssn1)
+        self.temp_dw_conv = _fold_bn(block.temp_dw_conv, block.bn)
+        self.bn = nn.Identity()
+        self.relu = block.relu
+        self.channel_drop = nn.Identity()
+        self.swish = block.swish
+        self.conv1x1 = block.conv1x1
+
+    def forward(self, x: Tensor) -> Tensor:
+        auxilary = self.ssn1(self.freq_dw_conv(x))
+        out = auxilary.mean(2, keepdim=True)
+        out = self.conv1x1(self.swish(self.temp_dw_conv(out)))
+        return self.relu(out + x + auxilary)
+
+
+class FusedTransitionBlock(TransitionBlock):
+    """
+    TransitionBlock for inference: bn1 and bn2 folded into conv1x1_1 and temp_dw_conv,
+    SubSpectralNorm as an affine, no dropout and no copies of intermediate tensors.
+    """
+
+    def __init__(self, block: TransitionBlock):
+        nn.Module.__init__(self)
+        self.conv1x1_1 = _fold_bn(block.conv1x1_1, block.bn1)
+        self.bn1 = nn.Identity()
+        self.freq_dw_conv = block.freq_dw_conv
+        self.ssn = SubSpectralAffine(block.ssn)
+        self.temp_dw_conv = _fold_bn(block.temp_dw_conv, block.bn2)
+        self.bn2 = nn.Identity()
+        self.relu = block.relu
+        self.channel_drop = nn.Identity()
+        self.swish = block.swish
+        self.conv1x1_2 = block.conv1x1_2
+
+    def forward(self, x: Tensor) -> Tensor:
+        out = self.relu(self.conv1x1_1(x))
+        auxilary = self.ssn(self.freq_dw_conv(out))
+        out = auxilary.mean(2, keepdim=True)
+        out = self.conv1x1_2(self.swish(self.temp_dw_conv(out)))
+        return self.relu(auxilary + out)
+
+
 class BCResNet(torch.nn.Module):
     def __init__(self, num_labels = 12):
         super(BCResNet, self).__init__()
@@ -193,6 +282,239 @@ class BCResNet(torch.nn.Module):
         #print('OUTPUT SHAPE:', out.shape)
         return out
 
+    def fuse_for_inference(self) -> "BCResNet":
+        # Returns an eval-only copy of the model with BN and SubSpectralNorm folded into the blocks
+        fused = copy.deepcopy(self).eval()
+        for name, module in fused.named_children():
+            if isinstance(module, TransitionBlock):
+                setattr(fused, name, FusedTransitionBlock(module))
+            elif isinstance(module, BroadcastedBlock):
+                setattr(fused, name, FusedBroadcastedBlock(module))
+        return fused.requires_grad_(False)
+
+
+def _time_pad(x: Tensor, left: int, right: int) -> Tensor:
+    if left or right:
+        return F.pad(x, (left, right))
+    return x
+
+
+def _temporal_conv(conv: nn.Conv2d, x: Tensor, lo: int, hi: int, elo: int, ehi: int) -> Tensor:
+    # x holds positions [elo, ehi) of the conv input, positions outside of the window are zero padded
+    k = conv.padding[1]
+    x = _time_pad(x, k - (lo - elo), k - (ehi - hi))
+    return F.conv2d(x, conv.weight, conv.bias, conv.stride, (conv.padding[0], 0), conv.dilation, conv.groups)
+
+
+class StreamingBCResNet:
+    """
+    Incremental inference of BCResNet over a sliding window.
+
+    The only ops of BCResNet that mix the time axis are conv1, conv2 and temp_dw_conv of the blocks,
+    so after the window slides by `shift` frames an output frame of a layer stays the same unless its
+    receptive field touches the new frames or the zero padding at the window edges. Outputs of every
+    layer are cached and only the frames at the edges are recomputed. Input is the log-mel window before
+    max normalisation, the normalisation offset goes through conv1 linearly and is applied after it,
+    so a changed window max only invalidates the layers after conv1.
+    """
+
+    BLOCKS = ["block1_1", "block1_2", "block2_1", "block2_2", "block3_1", "block3_2", "block3_3", "block3_4",
+              "block4_1", "block4_2", "block4_3", "block4_4"]
+
+    def __init__(self, model: BCResNet):
+        self.model = model
+        self.reset()
+
+    @property
+    def nbytes(self) -> int:
+        tensors = list(self._cache.values()) + [self._input, self._ones_response]
+        return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, Tensor))
+
+    def reset(self):
+        self._input = None
+        self._max = None
+        self._cache = {}
+        self._ones_response = None
+        self.computed_frames = {}
+
+    def __call__(self, x: Tensor, shift=None) -> Tensor:
+        # x: log-mel window without max normalisation with shape {1, 1, F, T}
+        # shift: number of frames the window moved since the previous call, None if unknown
+        with torch.no_grad():
+            return self._step(x, shift)
+
+    def _step(self, x, shift):
+        T = x.shape[-1]
+        m = x.max()
+
+        lo, hi = self._dirty_input(x, shift)
+        self._input = x
+        self.computed_frames = {}
+
+        out = self._layer("conv1_raw", x, lo, hi, 2, shift, self._conv1_span)
+        lo, hi = lo + 2, hi - 2
+        if self._ones_response is None or self._ones_response.shape[-1] != T:
+            conv1 = self.model.conv1
+            ones = torch.ones_like(x)
+            self._ones_response = F.conv2d(ones, conv1.weight, None, conv1.stride, conv1.padding)
+        out = out + self.model.conv1.bias.view(1, -1, 1, 1) - m * self._ones_response
+        if self._max is None or not torch.equal(m, self._max):
+            lo, hi = T, 0
+        self._max = m
+
+        for name in self.BLOCKS:
+            block = getattr(self.model, name)
+            span = self._transition_span if isinstance(block, TransitionBlock) else self._broadcasted_span
+            out = self._layer(name, out, lo, hi, block.temp_dw_conv.dilation[1], shift,
+                              lambda x, lo_, hi_, block=block, span=span: span(block, x, lo_, hi_))
+            lo, hi = lo + block.temp_dw_conv.dilation[1], hi - block.temp_dw_conv.dilation[1]
+
+        out = self._layer("conv2", out, lo, hi, 2, shift, self._conv2_span)
+        lo, hi = lo + 2, hi - 2
+        out = self._layer("conv3", out, lo, hi, 0, shift, lambda x, lo_, hi_: self.model.conv3(x[..., lo_:hi_]))
+
+        out = out.mean(-1, keepdim=True)
+        out = self.model.conv4(out)
+        out = out.squeeze(-1)
+        out = out.mean(-1)
+
+        if self.model.num_labels == 1:
+            out = torch.sigmoid(out)
+        return out
+
+    def _dirty_input(self, x, shift):
+        # Returns [lo, hi) range of input frames that are the same as in the previous window
+        T = x.shape[-1]
+        prev = self._input
+        if prev is None or shift is None or shift < 0 or shift >= T or prev.shape != x.shape:
+            return T, 0
+        same = (x[..., :T - shift] == prev[..., shift:]).flatten(0, 2).all(0)
+        same_idx = torch.nonzero(same).flatten()
+        if same_idx.numel() == 0:
+            return T, 0
+        lo, hi = same_idx[0].item(), same_idx[-1].item() + 1
+        if not bool(same[lo:hi].all()):
+            return T, 0
+        return lo, hi
+
+    def _layer(self, name, x, lo, hi, k, shift, span):
+        # Layer with temporal radius k, frames [lo, hi) of its input are reused from the previous window
+        T = x.shape[-1]
+        lo, hi = lo + k, hi - k
+        cached = self._cache.get(name)
+        if cached is None or lo >= hi:
+            out = span(x, 0, T)
+            self.computed_frames[name] = T
+        else:
+            parts = []
+            if lo > 0:
+                parts.append(span(x, 0, lo))
+            parts.append(cached[..., lo + shift:hi + shift])
+            if hi < T:
+                parts.append(span(x, hi, T))
+            out = torch.cat(parts, -1)
+            self.computed_frames[name] = T - (hi - lo)
+        self._cache[name] = out
+        return out
+
+    def _conv1_span(self, x, lo, hi):
+        conv = self.model.conv1
+        elo, ehi = max(lo - 2, 0), min(hi + 2, x.shape[-1])
+        x = _time_pad(x[..., elo:ehi], 2 - (lo - elo), 2 - (ehi - hi))
+        return F.conv2d(x, conv.weight, None, conv.stride, (conv.padding[0], 0))
+
+    def _conv2_span(self, x, lo, hi):
+        conv = self.model.conv2
+        elo, ehi = max(lo - 2, 0), min(hi + 2, x.shape[-1])
+        return _temporal_conv(conv, x[..., elo:ehi], lo, hi, elo, ehi)
+
+    @staticmethod
+    def _transition_span(block: TransitionBlock, x, lo, hi):
+        d = block.temp_dw_conv.dilation[1]
+        elo, ehi = max(lo - d, 0), min(hi + d, x.shape[-1])
+
+        out = block.conv1x1_1(x[..., elo:ehi])
+        out = block.bn1(out)
+        out = block.relu(out)
+        out = block.freq_dw_conv(out)
+        out = block.ssn(out)
+
+        auxilary = out[..., lo - elo:hi - elo]
+        out = out.mean(2, keepdim=True)
+
+        out = _temporal_conv(block.temp_dw_conv, out, lo, hi, elo, ehi)
+        out = block.bn2(out)
+        out = block.swish(out)
+        out = block.conv1x1_2(out)
+
+        out = auxilary + out
+        return block.relu(out)
+
+    @staticmethod
+    def _broadcasted_span(block: BroadcastedBlock, x, lo, hi):
+        d = block.temp_dw_conv.dilation[1]
+        elo, ehi = max(lo - d, 0), min(hi + d, x.shape[-1])
+
+        identity = x[..., lo:hi]
+
+        out = block.freq_dw_conv(x[..., elo:ehi])
+        out = block.ssn1(out)
+
+        auxilary = out[..., lo - elo:hi - elo]
+        out = out.mean(2, keepdim=True)
+
+        out = _temporal_conv(block.temp_dw_conv, out, lo, hi, elo, ehi)
+        out = block.bn(out)
+        out = block.swish(out)
+        out = block.conv1x1(out)
+
+        out = out + identity + auxilary
+        return block.relu(out)
+
+
+class WakewordHeads:
+    """
+    Models of several wake-words over the same log-mel windows. The batch stacked by the scheduler goes
+    through every head, the output has one column per head: the first output column of its model.
+    """
+
+    def __init__(self, heads: list):
+        self.heads = heads
+
+    def __len__(self):
+        return len(self.heads)
+
+    def __call__(self, x: Tensor) -> Tensor:
+        return torch.stack([head(x)[:, 0] for head in self.heads], 1)
+
+    def streaming(self) -> "StreamingWakewordHeads":
+        return StreamingWakewordHeads([StreamingBCResNet(head) for head in self.heads])
+
+
+class StreamingWakewordHeads:
+    # StreamingBCResNet of every head of WakewordHeads, fed with the same window
+
+    def __init__(self, streams: list):
+        self.streams = streams
+
+    @property
+    def nbytes(self) -> int:
+        return sum(stream.nbytes for stream in self.streams)
+
+    def reset(self):
+        for stream in self.streams:
+            stream.reset()
+
+    def __call__(self, x: Tensor, shift=None) -> Tensor:
+        return torch.stack([stream(x, shift)[:, 0] for stream in self.streams], 1)
+
+
+def make_stream(model) -> StreamingBCResNet:
+    # Incremental inference state of a model for one badge
+    if isinstance(model, WakewordHeads):
+        return model.streaming()
+    return StreamingBCResNet(model)
+
 
 class MHAttKWS(nn.Module):
     def __init__(
@@ -0,0 +1,276 @@
+import threading
+import traceback
+import logging
+import copy
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+
+import database
+from audio_handler import BadgeAudioHandler
+from config import Config
+from decoding import load_audio
+from features import shared_spectrogrammer, window_features
+from metrics import registry
+from model import BCResNet, WakewordHeads, make_stream
+from onnx_backend import OnnxBCResNet
+from scheduler import InferenceScheduler
+from vad import OnnxVADRuntime
+
+
+def _load_head(config: Config, model_path: str, model_int8_path: str, device: torch.device) -> BCResNet:
+    model = BCResNet(2).to(device)
+    model.eval()
+    state_dict = torch.load(model_path, map_location=device)
+    model.load_state_dict(state_dict)
+    if config.model_fuse:
+        model = model.fuse_for_inference()
+    if config.model_backend == "onnx":
+        model = OnnxBCResNet.from_torch(model, config.n_mels, window_frames(config),
+                                        intra_threads=config.onnx_intra_threads,
+                                        inter_threads=config.onnx_inter_threads)
+        logging.info(f"Exported {model_path} to ONNX, inferring with ONNX Runtime")
+    elif config.model_backend == "onnx_int8":
+        if not model_int8_path:
+            raise ValueError(f"No int8 model for {model_path}")
+        with open(model_int8_path, "rb") as f:
+            model = OnnxBCResNet(f.read(), intra_threads=config.onnx_intra_threads,
+                                 inter_threads=config.onnx_inter_threads)
+        logging.info(f"Inferring with int8 model {model_int8_path}")
+    elif config.model_backend != "torch":
+        raise ValueError(f"Unknown model backend: {config.model_backend}")
+    return model
+
+
+def _wakeword_head(config: Config, settings: dict, device: torch.device) -> BCResNet:
+    if settings["name"] not in database.Wakeword.__members__:
+        raise ValueError(f"Unknown wakeword: {settings['name']}")
+    return _load_head(config, settings["model_path"], settings["model_int8_path"], device)
+
+
+def init_model(config: Config) -> (BCResNet, torch.device):
+    # A single wake-word gets its model, several get WakewordHeads scoring the same windows
+    # device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    device = torch.device("cpu")
+    if config.model_backend != "torch" and config.model_streaming:
+        raise ValueError("Streaming inference is only supported by the torch model backend")
+    heads = [_wakeword_head(config, wakeword, device) for wakeword in config.wakeword_settings()]
+    if len(heads) == 1:
+        return heads[0], device
+    logging.info(f"Detecting {len(heads)} wakewords on shared VAD and features")
+    return WakewordHeads(heads), device
+
+
+def window_frames(config: Config) -> int:
+    return int(config.window_duration * config.sample_rate) // config.hop_length + 1
+
+
+def _scores(model, spec: torch.Tensor) -> torch.Tensor:
+    # {N, wake-words} probabilities of a batch of windows
+    with torch.inference_mode():
+        out = torch.sigmoid(model(spec))
+    return out if isinstance(model, WakewordHeads) else out[:, :1]
+
+
+def _windows(audio: np.ndarray, size: int, step: int) -> list:
+    # Analysis windows over a clip, a clip shorter than a window is padded with silence in front
+    if len(audio) < size:
+        audio = np.pad(audio, (size - len(audio), 0))
+    return [audio[start:start + size] for start in range(0, len(audio) - size + 1, step)]
+
+
+def check_swap(config: Config, model_path: str = None, model_int8_path: str = None, vad_model_path: str = None,
+               wakeword: str = None):
+    # Swap requests no models can be loaded from, refused before any consumer starts loading
+    if model_path is None and vad_model_path is None:
+        raise ValueError("Nothing to swap, set model_path or vad_model_path")
+    names = [settings["name"] for settings in config.wakeword_settings()]
+    if wakeword is not None and wakeword not in names:
+        raise ValueError(f"No wakeword {wakeword} in the config")
+    if model_path is not None and model_int8_path is None and config.model_backend == "onnx_int8":
+        raise ValueError("The onnx_int8 model backend needs model_int8_path with model_path")
+
+
+class ModelRegistry:
+    """
+    Models of a fragment consumer: the wake-word model of its InferenceScheduler and the VAD session of
+    OnnxVADRuntime. A new checkpoint is loaded on a background thread, warmed up with batches of the production
+    shapes and checked against the golden set before it is swapped in. The scheduler takes the new model on its
+    next batch and the VAD the new session on its next call, so the fragment worker never waits for a swap.
+
+    The golden set is a directory with wake-word clips in <model_golden_dir>/<wakeword name> and clips without
+    one in <model_golden_dir>/negative. A model has to tell model_golden_min_accuracy of the clips apart and
+    the VAD has to find voice in as many of the wake-word clips.
+    """
+
+    SWAPPING = ("loading", "warming_up", "validating", "swapping")
+
+    def __init__(self, config: Config, scheduler: InferenceScheduler, vad: OnnxVADRuntime):
+        self.config = config
+        self.scheduler = scheduler
+        self.vad = vad
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._state = "ready"
+        self._error = None
+        self._timings = {}
+        self._golden = None
+
+    @classmethod
+    def from_config(cls, config: Config, scheduler: InferenceScheduler):
+        # The VAD runtime is a singleton, this is the one the badge handlers of the process use
+        return cls(config, scheduler, OnnxVADRuntime.from_config(config))
+
+    def status(self) -> dict:
+        with self._lock:
+            return {"state": self._state, "error": self._error, "timings": dict(self._timings),
+                    "golden": self._golden, "vad_model_path": self.vad.model_path,
+                    "models": {wakeword["name"]: wakeword["model_path"]
+                               for wakeword in self.config.wakeword_settings()}}
+
+    def warm_up(self, model=None, session=None) -> float:
+        # Batches of the production shapes through the model and the VAD, so that the first fragments
+        # don't pay for lazy allocations and kernel selection. Returns the time it took
+        config = self.config
+        model = model if model is not None else self.scheduler.model
+        rng = np.random.default_rng(0)
+        chunk = BadgeAudioHandler.chunk_samples(config)
+        state = np.zeros((2, 1, 64), dtype=np.float32)
+        started = time.perf_counter()
+        for _ in range(config.model_warmup_batches):
+            for size in sorted({1, config.infer_max_batch}):
+                spec = torch.from_numpy(rng.standard_normal((size, 1, config.n_mels, window_frames(config)),
+                                                            dtype=np.float32))
+                _scores(model, spec)
+            if config.model_streaming:
+                stream = make_stream(model)
+                stream(spec[:1])
+                stream(spec[:1], chunk // config.hop_length)
+            for size in sorted({1, config.vad_max_batch}):
+                chunks = list(rng.uniform(-1000, 1000, (size, chunk)).astype(np.float32))
+                if None in self.vad.run_batch(chunks, [state] * size, [state] * size, session)[0]:
+                    raise ValueError(f"VAD failed on a batch of {size} chunks")
+        return time.perf_counter() - started
+
+    def validate(self, config: Config, model, session=None) -> dict:
+        # Clips of the golden set the model and the VAD got right
+        wakewords = config.wakeword_settings()
+        spectrogrammer = shared_spectrogrammer(config)
+        size = int(config.window_duration * config.sample_rate)
+        step = BadgeAudioHandler.chunk_samples(config)
+        clips = correct = spoken = voiced = 0
+        for label in [wakeword["name"] for wakeword in wakewords] + ["negative"]:
+            for path in sorted(glob.glob(os.path.join(config.model_golden_dir, label, "*.[wW][aA][vV]"))):
+                audio = load_audio(path, config.sample_rate)
+                spec = torch.stack([window_features(spectrogrammer, window)
+                                    for window in _windows(audio, size, step)]).unsqueeze(1)
+                scores = _scores(model, spec).max(0).values.tolist()
+                detected = {wakeword["name"] for wakeword, score in zip(wakewords, scores)
+                            if score > wakeword["certainty_thresh"]}
+                clips += 1
+                correct += detected == (set() if label == "negative" else {label})
+                if label != "negative":
+                    spoken += 1
+                    voiced += self._voiced(config, audio, step, session)
+        return {"clips": clips, "accuracy": correct / clips if clips else None,
+                "vad_recall": voiced / spoken if spoken else None}
+
+    def _voiced(self, config: Config, audio: np.ndarray, step: int, session) -> bool:
+        h = c = np.zeros((2, 1, 64), dtype=np.float32)
+        for start in range(0, len(audio) - step + 1, step):
+            (out,), (h,), (c,) = self.vad.run_batch([audio[start:start + step].astype(np.float32)], [h], [c], session)
+            if out is None:
+                raise ValueError("VAD failed on a golden set clip")
+            if out > config.vad_threshold:
+                return True
+        return False
+
+    def swap(self, model_path: str = None, model_int8_path: str = None, vad_model_path: str = None,
+             wakeword: str = None) -> bool:
+        # Starts loading the new models in the background, False if another swap is still running
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._state, self._error, self._timings, self._golden = "loading", None, {}, None
+            self._thread = threading.Thread(target=self._swap, name="model-swap", daemon=True,
+                                            args=(model_path, model_int8_path, vad_model_path, wakeword))
+            self._thread.start()
+            return True
+
+    def _swap(self, model_path, model_int8_path, vad_model_path, wakeword):
+        try:
+            check_swap(self.config, model_path, model_int8_path, vad_model_path, wakeword)
+            candidate = self._candidate(model_path, model_int8_path, wakeword)
+            started = time.perf_counter()
+            model = self._candidate_model(candidate, wakeword) if model_path else self.scheduler.model
+            session = self.vad.load_session(vad_model_path) if vad_model_path else None
+            self._stage("load", time.perf_counter() - started, "warming_up")
+
+            self._stage("warmup", self.warm_up(model, session), "validating")
+
+            if self.config.model_golden_dir:
+                started = time.perf_counter()
+                golden = self.validate(candidate, model, session)
+                with self._lock:
+                    self._golden = golden
+                self._stage("validate", time.perf_counter() - started, "swapping")
+                for key in ("accuracy", "vad_recall"):
+                    if golden[key] is not None and golden[key] < self.config.model_golden_min_accuracy:
+                        raise ValueError(f"Golden set {key} {golden[key]:.3f} is below "
+                                         f"{self.config.model_golden_min_accuracy}")
+
+            if model_path:
+                self.scheduler.model = model
+                self.config.model_path, self.config.model_int8_path = candidate.model_path, candidate.model_int8_path
+                self.config.wakewords = candidate.wakewords
+            if vad_model_path:
+                # Handlers created later ask the VAD singleton for the configured model
+                with self.vad.lock:
+                    self.config.vad_model_path = vad_model_path
+                    self.vad.swap(vad_model_path, session)
+            with self._lock:
+                self._state = "ready"
+            logging.info(f"Swapped in models {self.status()['models']}, VAD {self.vad.model_path}, "
+                         f"timings: {self._timings}")
+        except Exception as e:
+            logging.error("Can't swap models, keeping the current ones, exception:")
+            logging.error(traceback.format_exc())
+            with self._lock:
+                self._state, self._error = "failed", str(e)
+
+    def _candidate_model(self, candidate: Config, wakeword: str):
+        # Only the head of the swapped wake-word is loaded, the other heads are the ones in use
+        current = self.scheduler.model
+        if not isinstance(current, WakewordHeads):
+            return init_model(candidate)[0]
+        settings = candidate.wakeword_settings()
+        index = [entry["name"] for entry in settings].index(wakeword or settings[0]["name"])
+        heads = list(current.heads)
+        heads[index] = _wakeword_head(candidate, settings[index], self.scheduler.device)
+        return WakewordHeads(heads)
+
+    def _stage(self, stage: str, seconds: float, next_state: str):
+        registry.set("vad_scanner_model_swap_seconds", seconds, stage)
+        with self._lock:
+            self._timings[f"{stage}_ms"] = round(1000 * seconds, 1)
+            self._state = next_state
+
+    def _candidate(self, model_path, model_int8_path, wakeword) -> Config:
+        # Copy of the config with the new model of the wake-word, the first one by default, and its int8 model
+        candidate = copy.copy(self.config)
+        if model_path is None:
+            return candidate
+        if not self.config.wakewords:
+            candidate.model_path, candidate.model_int8_path = model_path, model_int8_path
+            return candidate
+        name = wakeword or self.config.wakewords[0]["name"]
+        candidate.wakewords = []
+        for settings in self.config.wakewords:
+            if settings["name"] == name:
+                settings = dict(settings, model_path=model_path, model_int8_path=model_int8_path)
+            candidate.wakewords.append(settings)
+        return candidate
@@ -0,0 +1,85 @@
+import argparse
+import inspect
+import logging
+import io
+import os
+
+import numpy as np
+import torch
+import onnxruntime
+
+from model import BCResNet
+from resources import session_options
+
+
+def export_bcresnet(model: BCResNet, n_mels: int, frames: int, f=None, opset: int = 13):
+    # Exports the model with dynamic batch and time axes, writes to f or returns the serialized graph.
+    # Opset 13 is the newest torch 1.10 exports, torch >= 2.5 is kept on the TorchScript exporter
+    buffer = io.BytesIO() if f is None else f
+    dummy = torch.zeros(1, 1, n_mels, frames)
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(model, dummy, buffer, input_names=["input"], output_names=["output"],
+                          dynamic_axes={"input": {0: "batch", 3: "time"}, "output": {0: "batch"}},
+                          opset_version=opset, **kwargs)
+    if f is None:
+        return buffer.getvalue()
+
+
+class OnnxBCResNet:
+    """
+    BCResNet inferred with ONNX Runtime, called like the torch model: {N, 1, F, T} tensor in, {N, labels} out.
+
+    The session is created lazily in the process that uses it, ORT thread pools don't survive a fork,
+    so fragment worker processes get their own session from the same serialized graph.
+    """
+
+    def __init__(self, model_bytes: bytes, intra_threads: int = 1, inter_threads: int = 1):
+        self.model_bytes = model_bytes
+        self.intra_threads = intra_threads
+        self.inter_threads = inter_threads
+        self._session = None
+        self._pid = None
+
+    @classmethod
+    def from_torch(cls, model: BCResNet, n_mels: int, frames: int, **kwargs):
+        return cls(export_bcresnet(model, n_mels, frames), **kwargs)
+
+    @property
+    def session(self) -> onnxruntime.InferenceSession:
+        if self._session is None or self._pid != os.getpid():
+            self._session = onnxruntime.InferenceSession(self.model_bytes,
+                                                         session_options(self.intra_threads, self.inter_threads),
+                                                         providers=["CPUExecutionProvider"])
+            self._pid = os.getpid()
+            logging.debug(f"Created ONNX Runtime session for BCResNet in process {self._pid}")
+        return self._session
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        x = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        out, = self.session.run(None, {"input": x})
+        return torch.from_numpy(out)
+
+    def eval(self):
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export BCResNet checkpoint to ONNX")
+    parser.add_argument("checkpoint")
+    parser.add_argument("output")
+    parser.add_argument("--n_mels", type=int, default=40)
+    parser.add_argument("--frames", type=int, default=171)
+    parser.add_argument("--opset", type=int, default=13)
+    args = parser.parse_args()
+
+    model = BCResNet(2)
+    model.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+    model.eval()
+    with open(args.output, "wb") as f:
+        export_bcresnet(model, args.n_mels, args.frames, f, args.opset)
+    print(f"Exported {args.checkpoint} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
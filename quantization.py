@@ -0,0 +1,119 @@
+import argparse
+import logging
+import tempfile
+import os
+
+import numpy as np
+import onnx
+import torch
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                      quantize_static)
+
+from audio_handler import BadgeAudioHandler
+from config import Config
+from decoding import load_audio
+from features import make_spectrogrammer, window_features
+from model import BCResNet
+from onnx_backend import export_bcresnet
+
+
+def audio_paths(paths: list) -> list:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(".wav")))
+        else:
+            files.append(path)
+    return files
+
+
+def sliding_windows(config: Config, audio: np.ndarray):
+    # Analysis windows over the audio, moved by the chunk size of BadgeAudioHandler
+    size = int(config.window_duration * config.sample_rate)
+    step = BadgeAudioHandler.chunk_samples(config)
+    for start in range(0, len(audio) - size + 1, step):
+        yield audio[start:start + size]
+
+
+def calibration_windows(config: Config, audios: list, max_windows: int = 2000, seed: int = 0) -> np.ndarray:
+    # Model inputs with shape {N, 1, F, T} from the same front-end as BadgeAudioHandler
+    spectrogrammer = make_spectrogrammer(config)
+    windows = [window for audio in audios for window in sliding_windows(config, audio)]
+    if not windows:
+        raise ValueError("Calibration audio is shorter than one analysis window")
+    if len(windows) > max_windows:
+        rng = np.random.default_rng(seed)
+        windows = [windows[i] for i in sorted(rng.choice(len(windows), max_windows, replace=False))]
+    with torch.no_grad():
+        features = [window_features(spectrogrammer, window) for window in windows]
+    return torch.stack(features).unsqueeze(1).numpy()
+
+
+class _WindowsReader(CalibrationDataReader):
+    def __init__(self, windows: np.ndarray, batch_size: int = 64):
+        self.windows = windows
+        self.batch_size = batch_size
+        self._pos = 0
+
+    def get_next(self):
+        if self._pos >= len(self.windows):
+            return None
+        batch = self.windows[self._pos:self._pos + self.batch_size]
+        self._pos += self.batch_size
+        return {"input": batch}
+
+    def rewind(self):
+        self._pos = 0
+
+
+def quantize_bcresnet(model: BCResNet, windows: np.ndarray) -> bytes:
+    # Static int8 quantization of the exported graph, activation ranges are calibrated on windows.
+    # Weights are quantized per channel, most convs of BCResNet are depthwise and their filters differ a lot in scale
+    n_mels, frames = windows.shape[2], windows.shape[3]
+    float_model = onnx.load_from_string(export_bcresnet(model, n_mels, frames))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model_int8.onnx")
+        quantize_static(float_model, path, _WindowsReader(windows),
+                        quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the wake-word model to int8 with calibration audio")
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--audio", nargs="+", required=True, help="WAV files or directories with them")
+    parser.add_argument("--wakeword", help="Wake-word whose model is quantized, the first one of the config by default")
+    parser.add_argument("--output", help="Defaults to model_int8_path of the wake-word")
+    parser.add_argument("--max_windows", type=int, default=2000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    config = Config(args.config)
+    settings = {entry["name"]: entry for entry in config.wakeword_settings()}
+    if args.wakeword is not None and args.wakeword not in settings:
+        parser.error(f"No wakeword {args.wakeword} in the config, choose from {list(settings)}")
+    wakeword = settings[args.wakeword or next(iter(settings))]
+    output = args.output or wakeword["model_int8_path"]
+    if not output:
+        parser.error(f"No model_int8_path for wakeword {wakeword['name']} in the config, set --output")
+
+    model = BCResNet(2)
+    model.load_state_dict(torch.load(wakeword["model_path"], map_location="cpu"))
+    model.eval()
+    if config.model_fuse:
+        model = model.fuse_for_inference()
+
+    files = audio_paths(args.audio)
+    windows = calibration_windows(config, [load_audio(path, config.sample_rate) for path in files], args.max_windows)
+    logging.info(f"Calibrating on {len(windows)} windows from {len(files)} files")
+
+    with open(output, "wb") as f:
+        f.write(quantize_bcresnet(model, windows))
+    logging.info(f"Quantized {wakeword['model_path']} to {output}")
+
+
+if __name__ == "__main__":
+    main()
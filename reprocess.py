@@ -0,0 +1,211 @@
+import multiprocessing
+import argparse
+import datetime
+import logging
+import time
+import csv
+import os
+
+from collections import deque
+
+import yaml
+from dotenv import load_dotenv
+
+import database
+import decoding
+import fast_api
+import resources
+import worker
+from audio_handler import BadgeAudioHandler
+from config import Config
+from decoding import load_audio
+from scheduler import InferenceScheduler
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ("BadgeID", "DateTimeActivated", "Wakeword", "Duration")
+
+_process_state = {}
+
+
+class ActivationLog:
+    """
+    Stands in for the database of offline handlers, keeps activations with the recording time
+    they were found at instead of the time of processing.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.rows = []
+
+    def register_activation(self, badge_id: str, wakeword: database.Wakeword, duration: float):
+        activated = datetime.datetime.fromtimestamp(self.handlers[badge_id].fragment_time())
+        self.rows.append((badge_id, activated, wakeword.name, duration))
+
+
+def archive_files(archive: str, badges: list = None, since: int = None, until: int = None) -> dict:
+    # {badge_id: [paths]} of <archive>/<badge_id>/YYYYmmddHHMMSS.WAV files in recording order
+    files = {}
+    for badge_id in sorted(badges or os.listdir(archive)):
+        directory = os.path.join(archive, badge_id)
+        if not os.path.isdir(directory):
+            continue
+        recordings = []
+        for filename in os.listdir(directory):
+            start = BadgeAudioHandler.recording_start(filename)
+            if start is None:
+                logging.warning(f"Skipping {os.path.join(directory, filename)}, the name isn't a recording time")
+                continue
+            if (since is None or start >= since) and (until is None or start < until):
+                recordings.append((start, os.path.join(directory, filename)))
+        if recordings:
+            files[badge_id] = [path for _, path in sorted(recordings)]
+    return files
+
+
+def split_badges(files: dict, processes: int) -> list:
+    # Badges go to processes largest first, each to the process with the least audio so far
+    groups = [[] for _ in range(processes)]
+    sizes = [0] * processes
+    for badge_id, paths in sorted(files.items(), key=lambda item: -sum(os.path.getsize(p) for p in item[1])):
+        index = sizes.index(min(sizes))
+        groups[index].append((badge_id, paths))
+        sizes[index] += sum(os.path.getsize(p) for p in paths)
+    return [(index, group) for index, group in enumerate(groups) if group]
+
+
+def _init_process(config: Config, model, device):
+    _process_state.update(config=config, model=model, device=device)
+
+
+def process_badges(task) -> tuple:
+    # Runs the badges of one process side by side, one file per badge at a time,
+    # so VAD and model calls are batched over the badges like in the fragment worker
+    index, badges = task
+    config, model, device = _process_state["config"], _process_state["model"], _process_state["device"]
+    resources.configure_worker(config, index)
+    scheduler = InferenceScheduler(model, device, config.infer_max_batch, config.infer_max_wait_ms / 1000)
+
+    log = ActivationLog()
+    pending = {badge_id: deque(paths) for badge_id, paths in badges}
+    handlers = {badge_id: BadgeAudioHandler(log, badge_id, config, scheduler) for badge_id, _ in badges}
+    log.handlers = dict(handlers)
+    processed = 0
+    audio_seconds = 0.0
+
+    while handlers:
+        running = []
+        for badge_id, handler in list(handlers.items()):
+            while not handler.fragment_in_progress() and pending[badge_id]:
+                path = pending[badge_id].popleft()
+                try:
+                    audio = load_audio(path, config.sample_rate)
+                except (OSError, ValueError, decoding.DecodingError) as e:
+                    logging.error(f"Can't load {path}: {e}")
+                    continue
+                if audio.size == 0:
+                    continue
+                handler.start_fragment(audio.reshape(1, -1), os.path.basename(path))
+                processed += 1
+                audio_seconds += audio.size / config.sample_rate
+            if handler.fragment_in_progress():
+                running.append(handler)
+            else:
+                handler.flush_recording()
+                del handlers[badge_id]
+        if running:
+            worker.advance(running)
+
+    return log.rows, processed, audio_seconds
+
+
+def write_csv(path: str, rows: list):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for badge_id, activated, wakeword, duration in rows:
+            writer.writerow((badge_id, activated.isoformat(), wakeword, duration))
+
+
+def write_parquet(path: str, rows: list):
+    table = pyarrow.table({name: [row[i] for row in rows] for i, name in enumerate(COLUMNS)})
+    pyarrow.parquet.write_table(table, path)
+
+
+def write_db(config: Config, rows: list):
+    db = database.init_db(config)
+    for badge_id, activated, wakeword, duration in rows:
+        db.register_activation(badge_id, database.Wakeword[wakeword], duration, activated)
+    if not db.activations.flush(timeout=600):
+        raise SystemExit("Timed out writing activations to the database")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess archived badge recordings offline")
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--archive", required=True, help="Directory with a directory of YYYYmmddHHMMSS.WAV files per badge")
+    parser.add_argument("--badges", nargs="+", help="Only these badges")
+    parser.add_argument("--since", help="First recording time, YYYYmmddHHMMSS")
+    parser.add_argument("--until", help="End of recording times, YYYYmmddHHMMSS")
+    parser.add_argument("--output", help="Activations .csv or .parquet file")
+    parser.add_argument("--db", action="store_true", help="Write activations to the database from the config")
+    parser.add_argument("--processes", type=int, default=len(os.sched_getaffinity(0)))
+    parser.add_argument("--set", nargs="*", default=[], help="Config overrides, key=value")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s | %(levelname)s | %(module)s.py: %(message)s")
+    if not args.output and not args.db:
+        parser.error("Give --output, --db or both")
+    if args.output and args.output.endswith(".parquet") and pyarrow is None:
+        parser.error("Parquet output needs pyarrow, install it or write to a .csv file")
+
+    config = Config(args.config)
+    for item in args.set:
+        key, value = item.split("=", 1)
+        setattr(config, key, yaml.safe_load(value))
+    config.sr_url = "debug"
+    config.workers = args.processes
+
+    since = BadgeAudioHandler.recording_start(args.since) if args.since else None
+    until = BadgeAudioHandler.recording_start(args.until) if args.until else None
+    files = archive_files(args.archive, args.badges, since, until)
+    if not files:
+        raise SystemExit(f"No recordings in {args.archive}")
+    tasks = split_badges(files, args.processes)
+    print(f"{sum(len(paths) for paths in files.values())} files of {len(files)} badges, {len(tasks)} processes")
+
+    resources.configure_process(config)
+    model, device = fast_api.init_model(config)
+    started = time.perf_counter()
+    rows = []
+    processed = 0
+    audio_seconds = 0.0
+    # Processes are forked after the model is loaded and share its weights
+    context = multiprocessing.get_context("fork")
+    with context.Pool(len(tasks), initializer=_init_process, initargs=(config, model, device)) as pool:
+        for task_rows, task_processed, task_seconds in pool.imap_unordered(process_badges, tasks):
+            rows += task_rows
+            processed += task_processed
+            audio_seconds += task_seconds
+    elapsed = time.perf_counter() - started
+    rows.sort(key=lambda row: (row[1], row[0]))
+
+    print(f"Processed {processed} files, {audio_seconds / 3600:.2f} h of audio in {elapsed:.1f} s, "
+          f"{audio_seconds / elapsed:.1f}x real time, {len(rows)} activations")
+    if args.output:
+        if args.output.endswith(".parquet"):
+            write_parquet(args.output, rows)
+        else:
+            write_csv(args.output, rows)
+    if args.db:
+        load_dotenv()
+        write_db(config, rows)
+
+
+if __name__ == "__main__":
+    main()
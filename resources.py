@@ -0,0 +1,76 @@
+import logging
+import os
+
+import onnxruntime
+import torch
+
+from config import Config
+
+
+def session_options(intra_threads: int, inter_threads: int) -> onnxruntime.SessionOptions:
+    # Thread counts only take effect through SessionOptions passed to the InferenceSession constructor
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = intra_threads
+    options.inter_op_num_threads = inter_threads
+    # Spinning threads burn the cores other badges' workers need
+    options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+    return options
+
+
+def available_cores(config: Config) -> list:
+    cores = sorted(os.sched_getaffinity(0))
+    if config.cpu_cores:
+        cores = [core for core in config.cpu_cores if core in cores]
+    return cores
+
+
+def worker_cores(config: Config, index: int) -> list:
+    # Cores are split between fragment workers in contiguous slices, with more workers than cores they are shared
+    cores = available_cores(config)
+    if config.workers <= len(cores):
+        size, extra = divmod(len(cores), config.workers)
+        start = index * size + min(index, extra)
+        return cores[start:start + size + (index < extra)]
+    return [cores[index % len(cores)]]
+
+
+def configure_torch(config: Config):
+    torch.set_num_threads(config.torch_intra_threads)
+    try:
+        torch.set_num_interop_threads(config.torch_inter_threads)
+    except RuntimeError:
+        # Can be set once per process only, forked workers inherit the pool of the parent
+        pass
+
+
+def configure_process(config: Config):
+    # Main process: restricted to the configured cores, torch thread pools sized before any work runs on them
+    if config.cpu_cores:
+        os.sched_setaffinity(0, available_cores(config))
+    configure_torch(config)
+
+
+def configure_worker(config: Config, index: int):
+    if config.pin_workers:
+        os.sched_setaffinity(0, worker_cores(config, index))
+    configure_torch(config)
+
+
+def log_layout(config: Config):
+    cores = available_cores(config)
+    logging.info(f"CPU layout: {len(cores)} cores available {cores}")
+    logging.info(f"torch: {config.torch_intra_threads} intra-op / {config.torch_inter_threads} inter-op threads, "
+                 f"model backend: {config.model_backend}")
+    if config.model_backend != "torch":
+        logging.info(f"Model ORT session: {config.onnx_intra_threads} intra-op / "
+                     f"{config.onnx_inter_threads} inter-op threads")
+    logging.info(f"VAD ORT session: {config.vad_intra_threads} intra-op / {config.vad_inter_threads} inter-op threads")
+    if config.workers > 0:
+        for index in range(config.workers):
+            pinned = worker_cores(config, index) if config.pin_workers else "not pinned"
+            logging.info(f"Fragment worker {index}: cores {pinned}")
+    else:
+        logging.info("Fragments are processed in the API process")
+    logging.info(f"Decode threads: {config.decode_workers}, ASR upload threads: {config.asr_concurrency}")
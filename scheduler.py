@@ -0,0 +1,169 @@
+import threading
+import logging
+import traceback
+import time
+
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+from metrics import registry
+from model import BCResNet, StreamingBCResNet, WakewordHeads, StreamingWakewordHeads
+
+
+class InferenceScheduler:
+    def __init__(self, model: BCResNet, device: torch.device, max_batch_size: int = 64, max_wait: float = 0.005,
+                 stats_interval: float = 60):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats_interval = stats_interval
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._flush = False
+
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        self._last_stats_log = time.monotonic()
+
+        self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, features: torch.Tensor) -> Future:
+        # features: log-mel window with shape {F, T}
+        # The result is the score of the window, or a list of scores for WakewordHeads
+        return self._enqueue(features, None, None)
+
+    def submit_stream(self, stream: StreamingBCResNet, features: torch.Tensor, shift) -> Future:
+        # Streaming windows can't be stacked, they are inferred one by one on the scheduler thread
+        return self._enqueue(features, stream, shift)
+
+    def _enqueue(self, features, stream, shift):
+        future = Future()
+        with self._cond:
+            self._pending.append((features, future, time.monotonic(), stream, shift))
+            self._cond.notify()
+        return future
+
+    def flush(self):
+        # Producer has submitted everything it has for now, don't wait for max_wait to run out
+        with self._cond:
+            if self._pending:
+                self._flush = True
+                self._cond.notify()
+
+    def infer(self, features: torch.Tensor) -> float:
+        future = self.submit(features)
+        self.flush()
+        return future.result()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            batches = self._batches
+            windows = self._windows
+            return {
+                "batches": batches,
+                "windows": windows,
+                "mean_batch_size": windows / batches if batches else 0.0,
+                "max_batch_size": self._max_batch,
+                "mean_queue_wait_ms": 1000 * self._wait_total / windows if windows else 0.0,
+                "max_queue_wait_ms": 1000 * self._wait_max,
+                "mean_inference_ms": 1000 * self._infer_total / batches if batches else 0.0,
+            }
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._windows = 0
+        self._max_batch = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._infer_total = 0.0
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0][2] + self.max_wait
+            while len(self._pending) < self.max_batch_size and not self._flush:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+            if not self._pending:
+                self._flush = False
+        return batch
+
+    def _run(self):
+        logging.debug(f"Inference scheduler started, max batch size: {self.max_batch_size}, "
+                      f"max wait: {self.max_wait * 1000} ms")
+        while True:
+            batch = self._next_batch()
+            started = time.monotonic()
+            windows = [item for item in batch if item[3] is None]
+            streams = [item for item in batch if item[3] is not None]
+            if windows:
+                self._run_windows(windows)
+            for item in streams:
+                self._run_stream(item)
+            finished = time.monotonic()
+            registry.observe("vad_scanner_stage_seconds", finished - started, "model")
+
+            self._update_stats(batch, started, finished)
+
+    def _run_windows(self, windows):
+        try:
+            scores = self._infer_batch([features for features, _, _, _, _ in windows])
+        except Exception as e:
+            logging.error(f"Can't infer batch of {len(windows)} windows, exception:")
+            logging.error(traceback.format_exc())
+            for _, future, _, _, _ in windows:
+                future.set_exception(e)
+            return
+        for (_, future, _, _, _), score in zip(windows, scores):
+            future.set_result(score)
+
+    def _run_stream(self, item):
+        features, future, _, stream, shift = item
+        try:
+            out = torch.sigmoid(stream(features.reshape(1, 1, *features.shape), shift))[0]
+            future.set_result(out.tolist() if isinstance(stream, StreamingWakewordHeads) else out[0].item())
+        except Exception as e:
+            logging.error("Can't infer streaming window, exception:")
+            logging.error(traceback.format_exc())
+            stream.reset()
+            future.set_exception(e)
+
+    def _infer_batch(self, windows):
+        spec = torch.stack(windows).unsqueeze(1)  # {N, 1, F, T}
+        with torch.inference_mode():
+            out = torch.sigmoid(self.model(spec.to(self.device)))
+        # Several wake-word heads score a window with a list, one per head
+        if isinstance(self.model, WakewordHeads):
+            return out.tolist()
+        return out[:, 0].tolist()
+
+    def _update_stats(self, batch, started, finished):
+        with self._stats_lock:
+            self._batches += 1
+            self._windows += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            for _, _, enqueued, _, _ in batch:
+                wait = started - enqueued
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+            self._infer_total += finished - started
+
+        if finished - self._last_stats_log > self.stats_interval:
+            stats = self.stats()
+            logging.info(f"Inference scheduler: {stats['batches']} batches, {stats['windows']} windows, "
+                         f"batch size mean {round(stats['mean_batch_size'], 2)} / max {stats['max_batch_size']}, "
+                         f"queue wait mean {round(stats['mean_queue_wait_ms'], 2)} ms / "
+                         f"max {round(stats['max_queue_wait_ms'], 2)} ms, "
+                         f"inference mean {round(stats['mean_inference_ms'], 2)} ms per batch")
+            with self._stats_lock:
+                self._reset_stats()
+            self._last_stats_log = finished
@@ -0,0 +1,98 @@
+import logging
+import struct
+import json
+import mmap
+import glob
+import os
+
+import numpy as np
+
+from config import Config
+
+MAGIC = b"VADSNAP1"
+ALIGN = 64
+
+
+def _aligned(size: int) -> int:
+    return -(-size // ALIGN) * ALIGN
+
+
+def save(path: str, states: dict, config: Config):
+    """
+    Writes handler states {badge_id: BadgeAudioHandler.snapshot()} to `path`: MAGIC, the length of a JSON header
+    with the scalar values of every state and the offset, dtype and shape of its arrays, then the arrays
+    aligned to 64 bytes. The file is replaced atomically, a crash while writing leaves the previous one.
+    """
+    badges = {}
+    arrays = []
+    offset = 0
+    for badge_id, state in states.items():
+        values = {}
+        layout = {}
+        for key, value in state.items():
+            if isinstance(value, np.ndarray):
+                layout[key] = (offset, value.dtype.str, value.shape)
+                arrays.append((offset, value))
+                offset += _aligned(value.nbytes)
+            else:
+                values[key] = value
+        badges[badge_id] = {"values": values, "arrays": layout}
+    header = json.dumps({"sample_rate": config.sample_rate, "window_duration": config.window_duration,
+                         "badges": badges}).encode()
+    base = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for position, value in arrays:
+            f.seek(base + position)
+            f.write(np.ascontiguousarray(value).tobytes())
+        f.truncate(base + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load(path: str, config: Config) -> dict:
+    # Handler states of a snapshot file, arrays are read-only views of the memory-mapped file
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a handler snapshot")
+    size, = struct.unpack("<Q", mapped[len(MAGIC):len(MAGIC) + 8])
+    header = json.loads(mapped[len(MAGIC) + 8:len(MAGIC) + 8 + size])
+    if header["sample_rate"] != config.sample_rate or header["window_duration"] != config.window_duration:
+        raise ValueError(f"{path} was written with another sample rate or window duration")
+    base = _aligned(len(MAGIC) + 8 + size)
+
+    states = {}
+    for badge_id, entry in header["badges"].items():
+        state = dict(entry["values"])
+        for key, (offset, dtype, shape) in entry["arrays"].items():
+            count = int(np.prod(shape))
+            state[key] = np.frombuffer(mapped, dtype, count, base + offset).reshape(shape) if count \
+                else np.empty(shape, dtype)
+        states[badge_id] = state
+    return states
+
+
+def snapshot_path(config: Config, index: int = 0):
+    # Snapshot file of a fragment consumer, None when snapshots are off
+    if not config.snapshot_dir:
+        return None
+    os.makedirs(config.snapshot_dir, exist_ok=True)
+    return os.path.join(config.snapshot_dir, f"handlers-{index}.snap")
+
+
+def load_dir(directory: str, config: Config) -> dict:
+    # States of every snapshot in the directory, the newest file wins for a badge found in several
+    states = {}
+    paths = sorted(glob.glob(os.path.join(directory, "*.snap")), key=os.path.getmtime)
+    for path in paths:
+        try:
+            states.update(load(path, config))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping handler snapshot {path}: {e}")
+    if states:
+        logging.info(f"Restoring the state of {len(states)} badges from {len(paths)} snapshots in {directory}")
+    return states
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import math
+import time
+
+from datetime import datetime
+
+import numpy as np
+
+from audio_handler import BadgeAudioHandler
+from config import Config
+from fragment_queue import QueueFull
+from metrics import registry
+
+MAX_BACKOFF = 1.0
+
+
+class StreamOffsetMismatch(Exception):
+    def __init__(self, expected: int):
+        super().__init__(f"Stream continues at sample {expected}")
+        self.expected = expected
+
+
+class StreamTakenOver(Exception):
+    pass
+
+
+class StreamSession:
+    """
+    Raw 16-bit PCM a badge streams, over one connection or several after disconnects. `offset` counts the
+    samples received, a client resumes from it after reconnecting; `committed` counts the samples handed
+    to the fragment queue, the client keeps at most a window of audio beyond it in flight.
+    """
+
+    def __init__(self, badge_id: str, stream_id: str, start: float, segment_samples: int):
+        self.badge_id = badge_id
+        self.stream_id = stream_id
+        self.start = start
+        self.segment_samples = segment_samples
+        self.committed = 0
+        self.connection = 0
+        self.connected = False
+        self.last_seen = time.monotonic()
+        self._pending = bytearray()
+
+    @property
+    def offset(self) -> int:
+        return self.committed + len(self._pending) // 2
+
+    def feed(self, data: bytes):
+        self._pending += data
+        self.last_seen = time.monotonic()
+
+    def segment(self, final: bool = False):
+        # Next full segment as a (1, N) int16 array, None until enough audio is pending.
+        # The final segment of an ended stream takes what is left
+        size = 2 * self.segment_samples
+        if final:
+            size = min(size, len(self._pending) - len(self._pending) % 2)
+        if size == 0 or len(self._pending) < size:
+            return None
+        return np.frombuffer(bytes(self._pending[:size]), dtype="<i2").astype(np.int16).reshape(1, -1)
+
+    def commit(self, segment: np.ndarray):
+        del self._pending[:2 * segment.shape[-1]]
+        self.committed += segment.shape[-1]
+
+    def disconnect(self):
+        # A half sample can't be resumed from a sample offset, the client sends it again
+        if len(self._pending) % 2:
+            del self._pending[-1]
+        self.connected = False
+        self.last_seen = time.monotonic()
+
+
+class StreamIngest:
+    """
+    Cuts badge streams into segments of whole handler chunks and puts them on the fragment queue, so
+    the badge's handler runs the same chunk loop as on uploaded fragments, one segment after the other.
+    A full queue holds the stream back instead of rejecting audio, the client stops sending once its
+    window is in flight. Sessions of disconnected streams are kept for `stream_resume_seconds`.
+    """
+
+    def __init__(self, config: Config, fragments_queue):
+        self.config = config
+        self.fragments_queue = fragments_queue
+        chunk = BadgeAudioHandler.chunk_samples(config)
+        self.segment_samples = chunk * max(1, math.ceil(config.stream_segment_ms * config.sample_rate / 1000 / chunk))
+        self.window_samples = int(config.stream_window_seconds * config.sample_rate)
+        self.sessions = {}
+
+    def open(self, badge_id: str, stream_id: str, start: float = None, offset: int = None) -> StreamSession:
+        # Session of the stream to continue from `offset`, or from where it stopped when offset is None
+        self._expire()
+        session = self.sessions.get((badge_id, stream_id))
+        if session is None:
+            if offset:
+                raise StreamOffsetMismatch(0)
+            session = StreamSession(badge_id, stream_id, time.time() if start is None else start,
+                                    self.segment_samples)
+            self.sessions[(badge_id, stream_id)] = session
+            logging.info(f"Badge {badge_id} started stream {stream_id}")
+        elif offset is not None and offset != session.offset:
+            raise StreamOffsetMismatch(session.offset)
+        elif session.connected:
+            logging.warning(f"Badge {badge_id} reconnected to stream {stream_id}, dropping the old connection")
+        else:
+            logging.info(f"Badge {badge_id} resumed stream {stream_id} at sample {session.offset}")
+        session.connection += 1
+        session.connected = True
+        registry.set("vad_scanner_streams", self.connected())
+        return session
+
+    def close(self, session: StreamSession, connection: int):
+        if session.connection == connection:
+            session.disconnect()
+            registry.set("vad_scanner_streams", self.connected())
+
+    async def push(self, session: StreamSession, data: bytes, connection: int):
+        session.feed(data)
+        await self._flush(session, connection)
+
+    async def end(self, session: StreamSession, connection: int):
+        # The badge ended the stream, audio short of a segment is queued as it is
+        await self._flush(session, connection, final=True)
+        if session.connection == connection:
+            self.sessions.pop((session.badge_id, session.stream_id), None)
+            logging.info(f"Badge {session.badge_id} ended stream {session.stream_id} "
+                         f"after {session.committed / self.config.sample_rate} s")
+
+    def connected(self) -> int:
+        return sum(session.connected for session in self.sessions.values())
+
+    async def _flush(self, session: StreamSession, connection: int, final: bool = False):
+        delay = 0.01
+        while True:
+            segment = session.segment(final)
+            if segment is None:
+                return
+            if session.connection != connection:
+                raise StreamTakenOver(f"Stream {session.stream_id} of badge {session.badge_id} was resumed elsewhere")
+            try:
+                self._put(session, segment)
+            except QueueFull:
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, MAX_BACKOFF)
+                continue
+            session.commit(segment)
+            delay = 0.01
+
+    def _put(self, session: StreamSession, segment: np.ndarray):
+        received = time.time()
+        begin = session.start + session.committed / self.config.sample_rate
+        filename = datetime.fromtimestamp(begin).strftime("%Y%m%d%H%M%S") + ".WAV"
+        self.fragments_queue.put((session.badge_id, segment, filename, received))
+        lag = received - begin - segment.shape[-1] / self.config.sample_rate
+        registry.observe("vad_scanner_ingestion_lag_seconds", lag)
+        registry.set("vad_scanner_badge_ingestion_lag_seconds", lag, session.badge_id)
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, session in list(self.sessions.items()):
+            if not session.connected and now - session.last_seen > self.config.stream_resume_seconds:
+                logging.info(f"Dropping stream {session.stream_id} of badge {session.badge_id}, "
+                             f"not resumed in {self.config.stream_resume_seconds} s")
+                del self.sessions[key]
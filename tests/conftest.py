@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+from config import Config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def config(monkeypatch):
+    # config.yml of the repo, model paths in it are relative to the repo root
+    monkeypatch.chdir(ROOT)
+    config = Config(os.path.join(ROOT, "config.yml"))
+    config.sr_url = "debug"
+    return config
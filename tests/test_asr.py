@@ -0,0 +1,130 @@
+import json
+import os
+import socket
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+import requests
+import uvicorn
+
+from asr import ASRSender, build_wav
+from benchmarks.asr_stub import create_app
+
+
+class Stub:
+    # benchmarks.asr_stub served from a thread of the test process
+
+    def __init__(self, fail_rate):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(create_app(fail_rate=fail_rate), host="127.0.0.1", port=port,
+                                                    log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def stats(self):
+        return requests.get(f"{self.url}/stats").json()
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+@pytest.fixture
+def stubs():
+    healthy, failing = Stub(0), Stub(1)
+    yield healthy, failing
+    healthy.stop()
+    failing.stop()
+
+
+@pytest.fixture
+def make_sender(tmp_path, monkeypatch):
+    senders = []
+
+    def make(url, spool_limit=100):
+        monkeypatch.setattr(ASRSender, "_instance", None)
+        config = types.SimpleNamespace(sr_url=url, asr_timeout=5, asr_spool_dir=str(tmp_path / "spool"),
+                                       asr_spool_limit=spool_limit, asr_concurrency=2)
+        senders.append(ASRSender(config))
+        return senders[-1]
+
+    yield make
+    for sender in senders:
+        sender.close()
+
+
+def pcm():
+    return np.zeros(1600, dtype=np.int16)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def metas(directory):
+    return [json.load(open(os.path.join(directory, f))) for f in sorted(os.listdir(directory)) if f.endswith(".json")]
+
+
+def test_spool_keeps_the_newest_recordings(stubs, make_sender):
+    _, failing = stubs
+    sender = make_sender(f"{failing.url}/asrupload", spool_limit=3)
+    for index in range(5):
+        sender.send(f"badge{index}", index, pcm(), 16000)
+        wait_for(lambda: failing.stats()["failed"] == index + 1)
+    sender.close()
+    assert [meta["badge_id"] for meta in metas(sender.spool_dir)] == ["badge2", "badge3", "badge4"]
+    assert len([f for f in os.listdir(sender.spool_dir) if f.endswith(".wav")]) == 3
+
+
+def test_retries_back_off_and_deliver(stubs, make_sender, monkeypatch):
+    healthy, failing = stubs
+    monkeypatch.setattr(ASRSender, "RETRY_BASE", 0.25)
+    sender = make_sender(f"{failing.url}/asrupload")
+    sender.send("badge", 1, pcm(), 16000)
+    wait_for(lambda: any(meta["attempts"] >= 2 for meta in metas(sender.spool_dir)))
+    name, = sender._spool_entries()
+    meta = json.load(open(os.path.join(sender.spool_dir, f"{name}.json")))
+    written = os.path.getmtime(os.path.join(sender.spool_dir, f"{name}.json"))
+    assert meta["next_attempt"] - written == pytest.approx(0.25 * 2 ** meta["attempts"], abs=0.1)
+    assert failing.stats()["failed"] == 1 + meta["attempts"]
+
+    sender.url = f"{healthy.url}/asrupload"
+    wait_for(lambda: healthy.stats()["received"] == 1)
+    wait_for(lambda: os.listdir(sender.spool_dir) == [ASRSender.REJECTED_DIR])
+
+
+def test_claimed_entries_are_left_to_their_claim(stubs, make_sender):
+    healthy, _ = stubs
+    sender = make_sender(f"{healthy.url}/asrupload")
+    now = int(time.time())
+    meta = {"badge_id": "badge", "time": 1, "attempts": 0, "next_attempt": 0}
+    for name, claimed in (("1-fresh", now), ("2-stale", now - ASRSender.CLAIM_TIMEOUT - 10)):
+        with open(os.path.join(sender.spool_dir, f"{name}.wav"), "wb") as f:
+            f.write(build_wav(pcm(), 16000))
+        with open(os.path.join(sender.spool_dir, f"{name}.{claimed}.claim"), "w") as f:
+            json.dump(dict(meta, badge_id=name), f)
+    wait_for(lambda: healthy.stats()["badges"] == {"2-stale": 1})
+    time.sleep(2)
+    assert healthy.stats()["badges"] == {"2-stale": 1}
+    assert set(os.listdir(sender.spool_dir)) == {"1-fresh.wav", f"1-fresh.{now}.claim", ASRSender.REJECTED_DIR}
+
+
+def test_rejected_recordings_are_kept_aside(stubs, make_sender):
+    healthy, _ = stubs
+    sender = make_sender(f"{healthy.url}/missing")
+    sender.send("badge", 1, pcm(), 16000)
+    wait_for(lambda: metas(sender.rejected_dir))
+    meta, = metas(sender.rejected_dir)
+    assert meta["badge_id"] == "badge" and meta["status"] == 404
+    assert sender._spool_entries() == []
@@ -0,0 +1,105 @@
+import asyncio
+import struct
+
+import numpy as np
+import pytest
+
+import decoding
+from vad import OnnxVADRuntime
+
+
+def fmt_chunk(audio_format=decoding.WAVE_FORMAT_PCM, channels=1, sample_rate=16000, bits=16, sub_format=None):
+    block_align = channels * bits // 8
+    body = struct.pack("<HHIIHH", audio_format, channels, sample_rate, sample_rate * block_align, block_align, bits)
+    if sub_format is not None:
+        # cbSize, valid bits, channel mask, then the sub-format GUID that starts with the format code
+        body += struct.pack("<HHIH", 22, bits, 0x4, sub_format) + b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71"
+    return b"fmt " + struct.pack("<I", len(body)) + body
+
+
+def data_chunk(payload: bytes, size=None):
+    size = len(payload) if size is None else size
+    return b"data" + struct.pack("<I", size) + payload + b"\x00" * (len(payload) & 1)
+
+
+def riff(*chunks):
+    body = b"WAVE" + b"".join(chunks)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def samples(count):
+    return np.arange(count, dtype="<i2").tobytes()
+
+
+def decode(data):
+    return asyncio.run(decoding.DecodePool(workers=1).decode(data))
+
+
+def test_pcm_wav_is_parsed_in_place():
+    wav, sr = decoding.parse_pcm_wav(riff(fmt_chunk(), data_chunk(samples(400))))
+    assert sr == 16000
+    assert wav.shape == (1, 400)
+    np.testing.assert_array_equal(wav[0], np.arange(400))
+
+
+@pytest.mark.parametrize("length", [0, 4, 12, 20, 30])
+def test_truncated_header_is_not_parsed(length):
+    data = riff(fmt_chunk(), data_chunk(samples(400)))[:length]
+    assert decoding.parse_pcm_wav(data) is None
+
+
+def test_truncated_header_is_a_decoding_error():
+    with pytest.raises(decoding.DecodingError):
+        decode(riff(fmt_chunk(), data_chunk(samples(400)))[:30])
+
+
+def test_odd_sized_data_chunk_drops_the_last_byte():
+    wav, _ = decoding.parse_pcm_wav(riff(fmt_chunk(), data_chunk(samples(400) + b"\x01")))
+    assert wav.shape == (1, 400)
+
+
+def test_odd_sized_chunk_is_padded_before_the_next_one():
+    data = riff(b"LIST" + struct.pack("<I", 3) + b"abc\x00", fmt_chunk(), data_chunk(samples(400)))
+    wav, _ = decoding.parse_pcm_wav(data)
+    assert wav.shape == (1, 400)
+
+
+def test_unfinalized_data_size_takes_the_rest_of_the_file():
+    for size in (0, 0xFFFFFFFF):
+        wav, _ = decoding.parse_pcm_wav(riff(fmt_chunk(), data_chunk(samples(400), size=size)))
+        assert wav.shape == (1, 400)
+
+
+def test_extensible_pcm_is_parsed():
+    data = riff(fmt_chunk(decoding.WAVE_FORMAT_EXTENSIBLE, sub_format=decoding.WAVE_FORMAT_PCM),
+                data_chunk(samples(400)))
+    wav, sr = decoding.parse_pcm_wav(data)
+    assert sr == 16000
+    assert wav.shape == (1, 400)
+
+
+def test_extensible_float_is_not_parsed():
+    data = riff(fmt_chunk(decoding.WAVE_FORMAT_EXTENSIBLE, bits=32, sub_format=3), data_chunk(samples(400)))
+    assert decoding.parse_pcm_wav(data) is None
+
+
+def test_stereo_is_not_parsed():
+    assert decoding.parse_pcm_wav(riff(fmt_chunk(channels=2), data_chunk(samples(400)))) is None
+
+
+@pytest.mark.parametrize("count", [0, OnnxVADRuntime.MIN_CHUNK_SAMPLES - 1])
+def test_empty_or_short_fragment_is_rejected(count):
+    wav, sr, _ = decode(riff(fmt_chunk(), data_chunk(samples(count))))
+    with pytest.raises(decoding.InvalidFragment):
+        decoding.check_fragment(wav, sr, 16000, OnnxVADRuntime.MIN_CHUNK_SAMPLES)
+
+
+def test_sample_rate_mismatch_is_rejected():
+    wav, sr, _ = decode(riff(fmt_chunk(sample_rate=8000), data_chunk(samples(400))))
+    with pytest.raises(decoding.InvalidFragment, match="8000"):
+        decoding.check_fragment(wav, sr, 16000, OnnxVADRuntime.MIN_CHUNK_SAMPLES)
+
+
+def test_valid_fragment_is_accepted():
+    wav, sr, _ = decode(riff(fmt_chunk(), data_chunk(samples(OnnxVADRuntime.MIN_CHUNK_SAMPLES))))
+    decoding.check_fragment(wav, sr, 16000, OnnxVADRuntime.MIN_CHUNK_SAMPLES)
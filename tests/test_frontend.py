@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import torch
+
+from audio_handler import BadgeAudioHandler
+from features import IncrementalLogMel, make_spectrogrammer
+
+TOLERANCE = 1e-4
+STEPS = 60
+
+
+def compare(config, shifts):
+    # Largest log-mel and window max differences of IncrementalLogMel to the full-window front-end
+    spectrogrammer = make_spectrogrammer(config)[0]
+    window_size = int(config.window_duration * config.sample_rate)
+    rng = np.random.default_rng(0)
+    frontend = IncrementalLogMel(spectrogrammer, window_size)
+    window = np.zeros(window_size, dtype=np.int16)
+    max_diff = max_max_diff = 0.0
+    for step, shift in enumerate(shifts):
+        gain = rng.uniform(0.01, 2)
+        new = min(shift, window_size)
+        window = np.roll(window, -new)
+        window[-new:] = (rng.standard_normal(new) * 3000 * gain).astype(np.int16)
+        spec = torch.log(spectrogrammer(torch.from_numpy(window).float()) + 1e-8)
+        view, view_max = frontend(window, shift if step else None)
+        max_diff = max(max_diff, (spec - view).abs().max().item())
+        max_max_diff = max(max_max_diff, abs(spec.max().item() - view_max))
+    return max_diff, max_max_diff
+
+
+def test_incremental_frontend_matches_full_window(config):
+    config.frontend_incremental = True
+    chunk = BadgeAudioHandler.chunk_samples(config)
+    assert chunk % config.hop_length == 0
+    assert max(compare(config, [chunk] * STEPS)) < TOLERANCE
+
+
+@pytest.mark.parametrize("shift", [100, 3885, 30000])
+def test_misaligned_and_oversized_shifts_fall_back_to_full_window(config, shift):
+    assert max(compare(config, [shift] * 10)) < TOLERANCE
@@ -0,0 +1,40 @@
+import numpy as np
+
+from buffers import PCMArena, RingWindow
+from handler_cache import HandlerCache
+
+
+class IdleHandler:
+    # Buffers of a BadgeAudioHandler that hasn't recorded anything yet
+
+    def __init__(self):
+        self.window = RingWindow(16000)
+        self.recording_buffer = PCMArena(139200)
+
+    def nbytes(self) -> int:
+        return self.window.nbytes + self.recording_buffer.nbytes
+
+    def fragment_in_progress(self) -> bool:
+        return False
+
+    def park(self) -> dict:
+        return {"recording": False}
+
+
+def test_empty_arena_counts_its_capacity():
+    arena = PCMArena(1000)
+    assert arena.nbytes == 1000 * np.dtype(np.int16).itemsize
+    arena.append(np.zeros(10, dtype=np.int16))
+    assert arena.nbytes == 1000 * np.dtype(np.int16).itemsize
+
+
+def test_budget_counts_idle_arenas_at_full_capacity():
+    size = IdleHandler().nbytes()
+    assert size > IdleHandler().window.nbytes
+    # Room for two handlers only if the empty recording arenas are counted
+    cache = HandlerCache(lambda badge_id: IdleHandler(), memory_budget=2 * size)
+    for index in range(4):
+        cache.enable(f"badge{index}")
+        cache[f"badge{index}"]
+    assert len(cache._handlers) == 2
+    assert set(cache._parked) == {"badge0", "badge1"}
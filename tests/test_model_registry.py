@@ -0,0 +1,51 @@
+import pytest
+
+from model_registry import ModelRegistry, check_swap
+from vad import OnnxVADRuntime
+
+HEADS = [{"name": "Здравствуйте", "model_path": "old.pt", "model_int8_path": "old_int8.onnx"},
+         {"name": "Happy", "model_path": "happy.pt", "model_int8_path": "happy_int8.onnx"}]
+
+
+def registry(config):
+    return ModelRegistry(config, None, OnnxVADRuntime.from_config(config))
+
+
+def test_nothing_to_swap(config):
+    with pytest.raises(ValueError, match="Nothing to swap"):
+        check_swap(config)
+
+
+def test_unknown_wakeword(config):
+    with pytest.raises(ValueError, match="No wakeword"):
+        check_swap(config, model_path="new.pt", wakeword="Unknown")
+
+
+def test_int8_backend_needs_the_int8_model(config):
+    config.model_backend = "onnx_int8"
+    with pytest.raises(ValueError, match="model_int8_path"):
+        check_swap(config, model_path="new.pt")
+    check_swap(config, model_path="new.pt", model_int8_path="new_int8.onnx")
+    check_swap(config, vad_model_path="vad.onnx")
+
+
+def test_int8_swap_without_the_int8_model_fails(config):
+    config.model_backend = "onnx_int8"
+    models = registry(config)
+    assert models.swap(model_path="new.pt")
+    models._thread.join(10)
+    status = models.status()
+    assert status["state"] == "failed"
+    assert "model_int8_path" in status["error"]
+
+
+def test_candidate_drops_the_int8_model_of_the_old_checkpoint(config):
+    candidate = registry(config)._candidate("new.pt", None, None)
+    assert (candidate.model_path, candidate.model_int8_path) == ("new.pt", None)
+
+
+def test_candidate_replaces_only_the_swapped_head(config):
+    config.wakewords = HEADS
+    candidate = registry(config)._candidate("new.pt", "new_int8.onnx", "Happy")
+    assert candidate.wakewords == [HEADS[0], dict(HEADS[1], model_path="new.pt", model_int8_path="new_int8.onnx")]
+    assert config.wakewords == HEADS
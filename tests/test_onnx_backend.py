@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from benchmarks.onnx_backend import load_model, make_inputs
+from onnx_backend import OnnxBCResNet
+
+TOLERANCE = 1e-4
+CHECKPOINTS = ["weights/model_greeting100/model.pt", "weights/happy98/model.pt"]
+
+
+@pytest.fixture(scope="module")
+def inputs():
+    return make_inputs(64)
+
+
+@pytest.mark.parametrize("path", CHECKPOINTS)
+@pytest.mark.parametrize("fuse", [False, True])
+def test_onnx_scores_match_torch(config, inputs, path, fuse):
+    model = load_model(path)
+    if fuse:
+        model = model.fuse_for_inference()
+    onnx_model = OnnxBCResNet.from_torch(model, inputs.shape[2], inputs.shape[3])
+    for batch_size in (1, 8, 64):
+        x = inputs[:batch_size]
+        with torch.inference_mode():
+            expected = torch.sigmoid(model(x))
+        assert (expected - torch.sigmoid(onnx_model(x))).abs().max().item() < TOLERANCE
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+import torch
+
+from audio_handler import BadgeAudioHandler
+from benchmarks.streaming_model import synthetic_audio
+from features import shared_spectrogrammer
+from model import WakewordHeads, make_stream
+from model_registry import init_model
+from scheduler import InferenceScheduler
+
+TOLERANCE = 1e-4
+STEPS = 40
+
+
+def raw_windows(config):
+    # Log-mel windows before max normalisation, moved by the hop-aligned chunk of the streaming mode
+    spectrogrammer = shared_spectrogrammer(config)
+    window = int(config.window_duration * config.sample_rate)
+    chunk = BadgeAudioHandler.chunk_samples(config)
+    audio = synthetic_audio(int((window + chunk * STEPS) / config.sample_rate) + 1, config.sample_rate)
+    for step in range(STEPS):
+        raw = torch.log(spectrogrammer(audio[step * chunk:step * chunk + window]) + 1e-8)
+        yield raw.reshape(1, 1, *raw.shape), chunk // config.hop_length
+
+
+def max_difference(model, windows):
+    stream = make_stream(model)
+    difference = 0.0
+    with torch.inference_mode():
+        for step, (raw, shift) in enumerate(windows):
+            full = model(raw - raw.max())
+            out = stream(raw, shift if step else None)
+            difference = max(difference, (full - out).abs().max().item())
+    return difference
+
+
+@pytest.mark.parametrize("fuse", [False, True])
+def test_streaming_matches_full_forward(config, fuse):
+    config.model_streaming = True
+    config.model_fuse = fuse
+    model, _ = init_model(config)
+    assert max_difference(model, raw_windows(config)) < TOLERANCE
+
+
+def test_streaming_heads_match_full_forward(config):
+    config.model_streaming = True
+    config.wakewords = [{"name": "Здравствуйте", "model_path": config.model_path},
+                        {"name": "Happy", "model_path": "weights/happy98/model.pt"}]
+    model, _ = init_model(config)
+    assert isinstance(model, WakewordHeads)
+    assert max_difference(model, raw_windows(config)) < TOLERANCE
+
+
+def handler_scores(config, model, audio):
+    # Scores of every inferred window of a fragment, in order
+    scheduler = InferenceScheduler(model, torch.device("cpu"), max_wait=0)
+    handler = BadgeAudioHandler(None, "badge", config, scheduler)
+    scores = []
+    handler.start_fragment(audio.reshape(1, -1), "20220301090000.WAV")
+    while handler.fragment_in_progress():
+        features = handler.advance_chunk()
+        if features is not None:
+            future = handler.submit_features(features)
+            scheduler.flush()
+            scores.append(future.result())
+            handler.apply_score(scores[-1])
+    return scores
+
+
+def test_streaming_mode_scores_like_the_default_mode(config):
+    # The incremental front-end rounds the chunk to whole hops too, so both modes see the same windows
+    config.frontend_incremental = True
+    config.vad_threshold = -1
+    model, _ = init_model(config)
+    audio = np.clip(synthetic_audio(6, config.sample_rate).numpy(), -32768, 32767).astype(np.int16)
+    default = handler_scores(config, model, audio)
+    config.model_streaming = True
+    streaming = handler_scores(config, model, audio)
+    assert len(default) == len(streaming) > 0
+    assert np.allclose(default, streaming, atol=TOLERANCE)
@@ -0,0 +1,76 @@
+from concurrent.futures import Future
+
+import numpy as np
+
+import worker
+from audio_handler import BadgeAudioHandler
+from vad import OnnxVADRuntime
+
+
+class SilentScheduler:
+    # Scores every window as no wake-word
+    model = None
+
+    def submit(self, features):
+        future = Future()
+        future.set_result(0.0)
+        return future
+
+    def flush(self):
+        pass
+
+
+class FailingSession:
+    # Session that fails the calls on chunks of one length
+
+    def __init__(self, session, length):
+        self.session = session
+        self.length = length
+
+    def run(self, names, inputs):
+        if inputs["input"].shape[1] == self.length:
+            raise RuntimeError("session failed")
+        return self.session.run(names, inputs)
+
+
+def speech(samples, seed=0):
+    return (np.random.default_rng(seed).standard_normal((1, samples)) * 1000).astype(np.int16)
+
+
+def test_short_tail_does_not_abort_other_badges(config, monkeypatch):
+    aborted = []
+    abort_fragment = BadgeAudioHandler.abort_fragment
+    monkeypatch.setattr(BadgeAudioHandler, "abort_fragment",
+                        lambda self: aborted.append(self.id) or abort_fragment(self))
+    scheduler = SilentScheduler()
+    tail = BadgeAudioHandler(None, "tail", config, scheduler)
+    full = BadgeAudioHandler(None, "full", config, scheduler)
+    tail.start_fragment(speech(50), "20220301090000.WAV")
+    full.start_fragment(speech(10 * config.sample_rate), "20220301090000.WAV")
+
+    ticks = 0
+    while tail.fragment_in_progress() or full.fragment_in_progress():
+        worker.advance([handler for handler in (tail, full) if handler.fragment_in_progress()])
+        ticks += 1
+
+    assert aborted == []
+    assert ticks == -(-10 * config.sample_rate // full.chunk_size)
+
+
+def test_short_chunks_are_unvoiced_without_a_session_call(config):
+    vad = OnnxVADRuntime.from_config(config)
+    state = np.zeros((2, 1, 64), dtype=np.float32)
+    for samples in (0, 1, OnnxVADRuntime.MIN_CHUNK_SAMPLES - 1):
+        outs, hs, cs = vad.run_batch([np.ones(samples, dtype=np.float32)], [state], [state])
+        assert outs == [0.0]
+        assert hs[0] is state and cs[0] is state
+
+
+def test_failed_length_group_keeps_the_others(config):
+    vad = OnnxVADRuntime.from_config(config)
+    state = np.zeros((2, 1, 64), dtype=np.float32)
+    chunks = [np.ones(512, dtype=np.float32), np.ones(3885, dtype=np.float32), np.ones(512, dtype=np.float32)]
+    outs, hs, cs = vad.run_batch(chunks, [state] * 3, [state] * 3, FailingSession(vad.session, 3885))
+    assert outs[1] is None and hs[1] is None and cs[1] is None
+    assert outs[0] is not None and outs[2] is not None
+    assert hs[0].shape == (2, 1, 64)
@@ -0,0 +1,24 @@
+import reprocess
+from benchmarks.vad_gate import synthetic_archive
+from benchmarks.warm_restart import SYNTHETIC_THRESH, replay
+from model import WakewordHeads
+from model_registry import init_model
+from scheduler import InferenceScheduler
+
+
+def detections(config, model, device, files):
+    scheduler = InferenceScheduler(model, device, config.infer_max_batch, config.infer_max_wait_ms / 1000)
+    found, _ = replay(config, scheduler, files, 0)
+    return found
+
+
+def test_single_head_detects_like_the_single_model(config, tmp_path):
+    config.certainty_thresh = SYNTHETIC_THRESH
+    synthetic_archive(str(tmp_path), 2, 4)
+    files = reprocess.archive_files(str(tmp_path))
+    model, device = init_model(config)
+
+    single = detections(config, model, device, files)
+    heads = detections(config, WakewordHeads([model]), device, files)
+    assert single
+    assert heads == single
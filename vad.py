@@ -1,17 +1,63 @@
+import threading
+import logging
+import traceback
+
 import numpy as np
 import torch
 import torchaudio
+import onnx
 import onnxruntime
 
+from resources import session_options
 from singleton import Singleton
 
+
+def _make_batch_dynamic(model: onnx.ModelProto):
+    # Exported Silero graph has batch axis fixed to 1 on its inputs and outputs,
+    # although the network itself has no cross-sample ops
+    for value_info in list(model.graph.input) + list(model.graph.output):
+        batch_axis = 1 if value_info.name in ("h0", "c0", "hn", "cn") else 0
+        dim = value_info.type.tensor_type.shape.dim[batch_axis]
+        dim.ClearField("dim_value")
+        dim.dim_param = "batch"
+    del model.graph.value_info[:]
+    return model
+
+
 class OnnxVADRuntime(Singleton):
     _instance = None
+    # Shorter chunks fail the reflect padding of the Silero graph, they are taken as unvoiced without a call
+    MIN_CHUNK_SAMPLES = 129
+    # Held while the configured model and the session change together, see from_config
+    lock = threading.RLock()
+
+    def __init__(self, model_path = "weights/vad_onnx/silero_vad.onnx", max_batch_size = 64,
+                 intra_threads = 1, inter_threads = 1):
+        with self.lock:
+            if getattr(self, "model_path", None) == model_path:
+                return
+            self.model_path = model_path
+            self.max_batch_size = max_batch_size
+            self.intra_threads = intra_threads
+            self.inter_threads = inter_threads
+            self.session = self.load_session(model_path)
 
-    def __init__(self, model_path = "weights/vad_onnx/silero_vad.onnx"):
-        self.session = onnxruntime.InferenceSession(model_path)
-        self.session.intra_op_num_threads = 1
-        self.session.inter_op_num_threads = 2
+    @classmethod
+    def from_config(cls, config):
+        # vad_model_path is read under the lock, a model swap can't happen between reading it and the check
+        with cls.lock:
+            return cls(config.vad_model_path, config.vad_max_batch, config.vad_intra_threads,
+                       config.vad_inter_threads)
+
+    def load_session(self, model_path: str) -> onnxruntime.InferenceSession:
+        model = _make_batch_dynamic(onnx.load(model_path))
+        return onnxruntime.InferenceSession(model.SerializeToString(),
+                                            session_options(self.intra_threads, self.inter_threads),
+                                            providers=["CPUExecutionProvider"])
+
+    def swap(self, model_path: str, session: onnxruntime.InferenceSession):
+        # Calls already running finish with the previous session
+        self.session, self.model_path = session, model_path
 
     def __call__(self, x, h, c):
         if x.ndim == 1:
@@ -20,7 +66,7 @@ class OnnxVADRuntime(Singleton):
             raise ValueError(f"Too many dimensions for input audio chunk {x.dim()}")
 
         if x.shape[0] > 1:
-            raise ValueError("Onnx model does not support batching")
+            raise ValueError("Use run_batch to infer several chunks at once")
 
         if h.shape != (2, 1, 64):
             raise ValueError("Wrong shape for H state array")
@@ -28,6 +74,9 @@ class OnnxVADRuntime(Singleton):
         if c.shape != (2, 1, 64):
             raise ValueError("Wrong shape for C state array")
 
+        if x.shape[1] < self.MIN_CHUNK_SAMPLES:
+            return 0.0, h, c
+
         ort_inputs = {'input': x, 'h0': h, 'c0': c}
         ort_outs = self.session.run(None, ort_inputs)
         out, h, c = ort_outs
@@ -35,3 +84,102 @@ class OnnxVADRuntime(Singleton):
         out = torch.tensor(out).squeeze(2)[:, 1].item()  # make output type match JIT analog
 
         return out, h, c
+
+    def run_batch(self, chunks: list, hs: list, cs: list, session: onnxruntime.InferenceSession = None):
+        # chunks: 1D float32 chunks of different streams, hs/cs: their (2, 1, 64) states
+        # Chunks of equal length are stacked along batch axis together with their states
+        # and inferred in one session call, results are returned in the input order.
+        # A chunk that can't be inferred, or shares a failed session call, gets None for all three results,
+        # the other chunks are not affected.
+        # session: another session of the model to run instead of the current one
+        session = session or self.session
+        outs = [None] * len(chunks)
+        new_hs = [None] * len(chunks)
+        new_cs = [None] * len(chunks)
+
+        by_length = {}
+        for idx, chunk in enumerate(chunks):
+            if chunk.ndim != 1 or hs[idx].shape != (2, 1, 64) or cs[idx].shape != (2, 1, 64):
+                logging.error(f"Can't run VAD on chunk of shape {chunk.shape} with states of shapes "
+                              f"{hs[idx].shape} and {cs[idx].shape}")
+            elif chunk.size < self.MIN_CHUNK_SAMPLES:
+                outs[idx], new_hs[idx], new_cs[idx] = 0.0, hs[idx], cs[idx]
+            else:
+                by_length.setdefault(chunk.size, []).append(idx)
+
+        for indices in by_length.values():
+            for start in range(0, len(indices), self.max_batch_size):
+                batch = indices[start:start + self.max_batch_size]
+                ort_inputs = {
+                    'input': np.stack([chunks[idx] for idx in batch]),
+                    'h0': np.concatenate([hs[idx] for idx in batch], axis=1),
+                    'c0': np.concatenate([cs[idx] for idx in batch], axis=1),
+                }
+                try:
+                    out, h, c = session.run(None, ort_inputs)
+                except Exception:
+                    logging.error(f"Can't run VAD on {len(batch)} chunks of {len(chunks[batch[0]])} samples, "
+                                  f"exception:")
+                    logging.error(traceback.format_exc())
+                    continue
+                for pos, idx in enumerate(batch):
+                    outs[idx] = float(out[pos, 1, 0])
+                    new_hs[idx] = h[:, pos:pos + 1].copy()
+                    new_cs[idx] = c[:, pos:pos + 1].copy()
+
+        return outs, new_hs, new_cs
+
+
+class EnergyGate:
+    """
+    Cheap silence test ahead of the VAD model, one per badge. A chunk is silent when none of its 20 ms frames
+    is louder than the noise floor of the badge by `margin_db`, frames up to twice the margin with a zero-crossing
+    rate above `max_zcr` count as broadband noise. The floor follows the quietest frame of each chunk down at once
+    and rises by `rise_db` per chunk, nothing is gated during the first `warmup` chunks while it settles, nor during
+    `hangover` chunks after a loud one, when the VAD still reports the tail of speech.
+    """
+
+    def __init__(self, sample_rate: int = 16000, margin_db: float = 6, max_zcr: float = 0.4,
+                 rise_db: float = 0.05, warmup: int = 8, hangover: int = 2, frame_ms: int = 20):
+        self.frame = sample_rate * frame_ms // 1000
+        self.margin_db = margin_db
+        self.max_zcr = max_zcr
+        self.rise_db = rise_db
+        self.warmup = warmup
+        self.hangover = hangover
+        self.floor = None
+        self._chunks = 0
+        self._since_loud = hangover
+
+    def state(self) -> list:
+        return [None if self.floor is None else float(self.floor), self._chunks, self._since_loud]
+
+    def restore(self, state: list):
+        self.floor, self._chunks, self._since_loud = state
+
+    def is_silent(self, chunk: np.ndarray) -> bool:
+        # chunk: 1D float32 samples in int16 scale, as fed to the VAD
+        if chunk.size < self.frame:
+            return False
+        starts = np.arange(0, chunk.size - self.frame + 1, self.frame)
+        if starts[-1] + self.frame < chunk.size:
+            starts = np.append(starts, chunk.size - self.frame)
+        frames = np.lib.stride_tricks.sliding_window_view(chunk, self.frame)[starts]
+
+        db = 10 * np.log10(np.einsum("ij,ij->i", frames, frames) / self.frame + 1)
+        quietest = db.min()
+        if self.floor is None or quietest < self.floor:
+            self.floor = quietest
+        else:
+            self.floor += self.rise_db
+        self._chunks += 1
+
+        loud = db > self.floor + self.margin_db
+        if loud.any():
+            zcr = np.count_nonzero(np.diff(np.signbit(frames[loud]), axis=1), axis=1) / self.frame
+            noise = (db[loud] <= self.floor + 2 * self.margin_db) & (zcr > self.max_zcr)
+            if not noise.all():
+                self._since_loud = 0
+                return False
+        self._since_loud += 1
+        return self._chunks > self.warmup and self._since_loud > self.hangover
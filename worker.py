@@ -1,20 +1,230 @@
 import logging
-from multiprocessing import Queue
+import threading
 import queue
 from utils import init_logging
+from fragment_queue import FragmentQueue
+from handler_cache import HandlerCache
+from metrics import registry
+from collections import deque
+import snapshots
 import time
 
-def process_badge_fragment(fragments_queue: Queue, active_badges: dict):
-    time.sleep(1)
-    logging.debug("Fragments consumer started!")
-    logging.debug(f"Active badges: {active_badges.keys()}")
-    while True:
-        try:
-            badge_id, fragment, filename = fragments_queue.get()
-        except queue.Empty:
-            continue
+import numpy as np
+
+
+class FragmentStats:
+    """
+    Progress of the fragment consumer: processed fragments and audio, backlog of fragments waiting
+    for processing and fragment-to-decision latency, from the upload of a fragment to its last chunk.
+    """
+
+    def __init__(self, samples: int = 10000):
+        self._lock = threading.Lock()
+        self._running = {}
+        self._latencies = deque(maxlen=samples)
+        self.fragments = 0
+        self.audio_seconds = 0.0
+        self.backlog = 0
+
+    def started(self, badge_id: str, received: float, seconds: float):
+        with self._lock:
+            self._running[badge_id] = (received, time.perf_counter(), seconds)
+
+    def finished(self, badge_id: str):
+        with self._lock:
+            running = self._running.pop(badge_id, None)
+            if running is None:
+                return
+            received, started, seconds = running
+            latency = time.time() - received
+            self.fragments += 1
+            self.audio_seconds += seconds
+            self._latencies.append(latency)
+        registry.inc("vad_scanner_fragments_total")
+        registry.inc("vad_scanner_audio_seconds_total", amount=seconds)
+        registry.observe("vad_scanner_fragment_latency_seconds", latency)
+        if seconds > 0:
+            registry.set("vad_scanner_badge_rtf", (time.perf_counter() - started) / seconds, badge_id)
+
+    def set_backlog(self, backlog: int):
+        self.backlog = backlog
+        registry.set("vad_scanner_fragment_queue_depth", backlog)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"fragments": self.fragments, "audio_seconds": self.audio_seconds, "backlog": self.backlog,
+                    "latencies": list(self._latencies)}
+
+
+def summarize(snapshots: list) -> dict:
+    # Totals of one or several consumers, latency percentiles over their recent fragments
+    latencies = np.array([latency for snapshot in snapshots for latency in snapshot["latencies"]])
+    summary = {
+        "fragments": sum(snapshot["fragments"] for snapshot in snapshots),
+        "audio_seconds": sum(snapshot["audio_seconds"] for snapshot in snapshots),
+        "backlog": sum(snapshot["backlog"] for snapshot in snapshots),
+    }
+    for name, q in (("p50", 50), ("p99", 99)):
+        summary[f"latency_{name}_ms"] = 1000 * float(np.percentile(latencies, q)) if len(latencies) else None
+    return summary
+
+
+stats = FragmentStats()
+stopping = threading.Event()
+stopped = threading.Event()
+handovers = queue.Queue()
+
+
+def _running_handlers(fragments_queue: FragmentQueue, running: set, active_badges: dict):
+    handlers = []
+    for badge_id in running.union(fragments_queue.badges()):
         try:
             badge_handler = active_badges[badge_id]
-            badge_handler.process_audiofragment(fragment,filename)
         except KeyError:
             logging.error(f"No active badge with ID: {badge_id}")
+            fragments_queue.discard(badge_id)
+            running.discard(badge_id)
+            continue
+        if not badge_handler.fragment_in_progress():
+            stats.finished(badge_id)
+            item = fragments_queue.pop(badge_id)
+            if item is None:
+                running.discard(badge_id)
+                continue
+            fragment, filename, received, vad_only = item
+            badge_handler.start_fragment(fragment, filename, vad_only)
+            stats.started(badge_id, received, fragment.size / badge_handler.config.sample_rate)
+            running.add(badge_id)
+        handlers.append(badge_handler)
+    return handlers
+
+
+def _run_vad(handlers: list):
+    # Next chunk of every running badge goes through VAD in one batched call
+    chunked = []
+    for badge_handler in handlers:
+        chunk = badge_handler.next_chunk()
+        if chunk is not None:
+            chunked.append((badge_handler, chunk))
+    if not chunked:
+        return []
+
+    vad = chunked[0][0].vad
+    states = [badge_handler.vad_state() for badge_handler, _ in chunked]
+    with registry.time("vad_scanner_stage_seconds", "vad"):
+        outs, hs, cs = vad.run_batch([chunk for _, chunk in chunked],
+                                     [h for h, _ in states], [c for _, c in states])
+
+    voiced = []
+    for (badge_handler, _), vad_res, h, c in zip(chunked, outs, hs, cs):
+        if vad_res is None:
+            # Only the badges of a failed VAD call lose their fragment
+            badge_handler.abort_fragment()
+            continue
+        features = badge_handler.apply_vad(vad_res, h, c)
+        if features is not None:
+            voiced.append((badge_handler, features))
+    return voiced
+
+
+def advance(handlers: list):
+    # Moves every running handler by one chunk, VAD and model calls of all of them are batched
+    voiced = _run_vad(handlers)
+
+    submitted = []
+    schedulers = set()
+    for badge_handler, features in voiced:
+        submitted.append((badge_handler, badge_handler.submit_features(features)))
+        schedulers.add(badge_handler.scheduler)
+    for scheduler in schedulers:
+        scheduler.flush()
+
+    for badge_handler, future in submitted:
+        try:
+            result = future.result()
+        except Exception:
+            badge_handler.abort_fragment()
+            continue
+        badge_handler.apply_score(result)
+
+
+def hand_over(badge_id: str, callback):
+    # Asks the fragment consumer to give up the badge once its fragment in progress is finished,
+    # its queued fragments and handler state go to callback(state, fragments) on the consumer thread
+    handovers.put((badge_id, callback))
+
+
+def _run_handovers(fragments_queue: FragmentQueue, running: set, active_badges: HandlerCache, pending: list):
+    while True:
+        try:
+            pending.append(handovers.get_nowait())
+        except queue.Empty:
+            break
+    for item in list(pending):
+        badge_id, callback = item
+        if badge_id in running:
+            if badge_id in active_badges and active_badges[badge_id].fragment_in_progress():
+                continue
+            stats.finished(badge_id)
+            running.discard(badge_id)
+        fragments = fragments_queue.discard(badge_id)
+        callback(active_badges.release(badge_id), fragments)
+        pending.remove(item)
+
+
+def stop(timeout: float = None) -> bool:
+    # Asks the fragment consumer of this process to drain and waits until it has stopped
+    stopping.set()
+    return stopped.wait(timeout)
+
+
+def save_snapshot(active_badges: HandlerCache, path: str, config):
+    with registry.time("vad_scanner_stage_seconds", "snapshot"):
+        states = active_badges.snapshot()
+        try:
+            snapshots.save(path, states, config)
+        except OSError as e:
+            logging.error(f"Can't write handler snapshot {path}: {e}")
+            return
+    logging.debug(f"Saved the state of {len(states)} badges to {path}")
+
+
+def process_badge_fragment(fragments_queue: FragmentQueue, active_badges: HandlerCache, config,
+                           snapshot_path: str = None):
+    time.sleep(1)
+    logging.debug("Fragments consumer started!")
+    logging.debug(f"Active badges: {active_badges.keys()}")
+
+    # Fragments of all badges are advanced one chunk per tick, so that
+    # VAD and model calls of different badges are batched together
+    running = set()
+    pending = []
+    deadline = None
+    next_snapshot = time.monotonic() + (config.snapshot_interval if snapshot_path else 0)
+    while True:
+        if stopping.is_set() and deadline is None:
+            deadline = time.monotonic() + config.drain_timeout
+            logging.info(f"Draining {len(fragments_queue)} queued fragments for up to {config.drain_timeout} s")
+        if deadline is not None and ((not running and not len(fragments_queue)) or time.monotonic() > deadline):
+            break
+        if not running:
+            fragments_queue.wait(1)
+
+        _run_handovers(fragments_queue, running, active_badges, pending)
+        handlers = _running_handlers(fragments_queue, running, active_badges)
+        stats.set_backlog(len(handlers) + len(fragments_queue))
+        advance(handlers)
+        active_badges.flush_retired()
+        if snapshot_path and time.monotonic() >= next_snapshot:
+            save_snapshot(active_badges, snapshot_path, config)
+            next_snapshot = time.monotonic() + config.snapshot_interval
+
+    if running or len(fragments_queue):
+        logging.warning(f"Stopped with {len(running)} fragments in progress and {fragments_queue.queued_seconds} s "
+                        f"of audio queued, not drained in {config.drain_timeout} s")
+    if snapshot_path:
+        save_snapshot(active_badges, snapshot_path, config)
+    else:
+        active_badges.drain()
+    logging.info("Fragments consumer stopped")
+    stopped.set()
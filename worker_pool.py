@@ -0,0 +1,368 @@
+import multiprocessing
+import threading
+import signal
+import logging
+import queue
+import time
+import zlib
+import math
+import mmap
+import uuid
+import glob
+import os
+
+import numpy as np
+import torch
+
+import database
+import metrics
+import resources
+import snapshots
+import worker
+from audio_handler import BadgeAudioHandler
+from fragment_queue import FragmentQueue, QueueFull
+from handler_cache import HandlerCache
+from model import BCResNet
+from model_registry import ModelRegistry
+from scheduler import InferenceScheduler
+
+SHM_DIR = "/dev/shm"
+# Fragment files of this server and its workers, the ones left over by workers that died are removed on close
+SHM_PREFIX = f"vad-fragment-{os.getpid()}-"
+
+
+def _share_fragment(fragment: np.ndarray) -> str:
+    # Audio goes to worker processes through a shared memory file instead of the pickled array,
+    # the worker unlinks it once mapped
+    name = f"{SHM_PREFIX}{uuid.uuid4().hex}"
+    fd = os.open(os.path.join(SHM_DIR, name), os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        os.ftruncate(fd, max(fragment.nbytes, 1))
+        shared = mmap.mmap(fd, max(fragment.nbytes, 1))
+    finally:
+        os.close(fd)
+    target = np.frombuffer(shared, dtype=fragment.dtype, count=fragment.size)
+    target[:] = fragment.reshape(-1)
+    del target
+    shared.close()
+    return name
+
+
+def _attach_fragment(name: str, shape: tuple, dtype: str) -> np.ndarray:
+    path = os.path.join(SHM_DIR, name)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        shared = mmap.mmap(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    # The array keeps the mapping alive, it is unmapped together with the fragment
+    return np.frombuffer(shared, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _drop_fragments(fragments: list):
+    for name, *_ in fragments:
+        try:
+            os.unlink(os.path.join(SHM_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def _queue_fragment(fragments_queue: FragmentQueue, badge_id, name, shape, dtype, filename, uploaded):
+    try:
+        fragment = _attach_fragment(name, shape, dtype)
+        fragments_queue.put((badge_id, fragment, filename, uploaded))
+    except OSError as e:
+        logging.error(f"Can't attach fragment {filename} of badge {badge_id}: {e}")
+    except QueueFull as e:
+        logging.warning(f"Dropped fragment {filename} of badge {badge_id}: {e}")
+
+
+def _forward(peer, badge_id: str, state, fragments: list):
+    # Queued fragments and handler state of a badge moved to the worker of `peer` command queue
+    shared = [(_share_fragment(fragment), fragment.shape, fragment.dtype.str, filename, uploaded)
+              for fragment, filename, uploaded in fragments]
+    peer.put(("adopted", badge_id, state, shared))
+    metrics.registry.discard("vad_scanner_badge_rtf", badge_id)
+    logging.info(f"Handed badge {badge_id} over with {len(shared)} queued fragments")
+
+
+def _control_loop(commands, results, received, fragments_queue: FragmentQueue, active_badges: HandlerCache,
+                  models: ModelRegistry, peers: list):
+    # Fragments of badges moving here wait for the state and fragments of their previous worker
+    adopting = {}
+    while True:
+        command, badge_id, *args = commands.get()
+        if command == "enable":
+            active_badges.enable(badge_id)
+        elif command == "disable":
+            _drop_fragments(adopting.pop(badge_id, []))
+            if badge_id in active_badges:
+                del active_badges[badge_id]
+            metrics.registry.discard("vad_scanner_badge_rtf", badge_id)
+        elif command == "fragment":
+            try:
+                if badge_id in adopting:
+                    adopting[badge_id].append(args)
+                else:
+                    _queue_fragment(fragments_queue, badge_id, *args)
+            finally:
+                received.value += args[1][-1] / fragments_queue.sample_rate
+        elif command == "handover":
+            peer = peers[args[0]]
+            worker.hand_over(badge_id, lambda state, fragments, peer=peer, badge_id=badge_id:
+                             _forward(peer, badge_id, state, fragments))
+        elif command == "adopt":
+            adopting[badge_id] = []
+        elif command == "adopted":
+            state, forwarded = args
+            active_badges.enable(badge_id)
+            if state is not None:
+                active_badges.restore({badge_id: state})
+            if badge_id in adopting:
+                for fragment in forwarded + adopting.pop(badge_id):
+                    _queue_fragment(fragments_queue, badge_id, *fragment)
+            else:
+                # Disabled while it was moving, the recording it brought is finished here
+                _drop_fragments(forwarded)
+                del active_badges[badge_id]
+        elif command == "stats":
+            results.put((command, worker.stats.snapshot()))
+        elif command == "metrics":
+            results.put((command, metrics.registry.snapshot()))
+        elif command == "swap":
+            if not models.swap(**args[0]):
+                logging.warning("Another model swap is still running, ignoring the new one")
+        elif command == "models":
+            results.put((command, models.status()))
+        elif command == "stop":
+            worker.stopping.set()
+
+
+def _worker_main(index: int, peers: list, results, queued, received, config, model: BCResNet,
+                 device: torch.device):
+    commands = peers[index]
+    logging.info(f"Fragment worker {index} started, pid: {os.getpid()}")
+    # Ctrl+C reaches the whole process group, the API process stops the workers with a drain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    resources.configure_worker(config, index)
+    # Forked before the parent connected, so the database singleton is not inherited
+    db = database.init_db(config)
+    scheduler = InferenceScheduler(model, device, config.infer_max_batch, config.infer_max_wait_ms / 1000)
+    models = ModelRegistry.from_config(config, scheduler)
+    logging.info(f"Fragment worker {index} warmed up the models in {round(models.warm_up(), 2)} s")
+
+    active_badges = HandlerCache.from_config(
+        config, lambda badge_id: BadgeAudioHandler(db, badge_id, config, scheduler), config.workers)
+    if config.snapshot_dir:
+        # Every worker maps all snapshots, badges may have moved between workers since they were written
+        active_badges.restore(snapshots.load_dir(config.snapshot_dir, config))
+    fragments_queue = FragmentQueue.from_config(config, config.queue_max_seconds / config.workers, queued)
+
+    control = threading.Thread(target=_control_loop, daemon=True,
+                               args=(commands, results, received, fragments_queue, active_badges, models, peers))
+    control.start()
+    worker.process_badge_fragment(fragments_queue, active_badges, config, snapshots.snapshot_path(config, index))
+    db.activations.flush(config.drain_timeout)
+
+
+class FragmentWorkerPool:
+    """
+    Pool of fragment worker processes, every badge is pinned to one worker, so its BadgeAudioHandler
+    state stays local to that process. Badges are placed with rendezvous hashing under a load bound:
+    a badge goes to the first worker of its hash order that has less than `balance` times the mean load.
+    Workers are forked after the model is loaded and share its weights copy-on-write, the pool has to be
+    created before the process connects to the database or starts any threads.
+
+    Every worker queues up to an even part of `queue_max_seconds` of audio. Workers publish their queued audio
+    and the audio they took from their command queue to shared values, so fragments that wouldn't fit
+    with the ones still in flight are refused here, before they are handed over.
+    """
+
+    def __init__(self, config, model: BCResNet, device: torch.device, balance: float = 1.25):
+        self.config = config
+        self.workers = config.workers
+        self.balance = balance
+
+        self._lock = threading.Lock()
+        self._assignment = {}
+        self._load = [0] * self.workers
+
+        context = multiprocessing.get_context("fork")
+        self._commands = [context.Queue() for _ in range(self.workers)]
+        self._results = context.Queue()
+        self._queued = [context.Value("d", 0.0, lock=False) for _ in range(self.workers)]
+        self._received = [context.Value("d", 0.0, lock=False) for _ in range(self.workers)]
+        self._sent = [0.0] * self.workers
+        self._dead = set()
+        self._max_seconds = config.queue_max_seconds / self.workers
+        self._stats_lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+        self._processes = []
+        for index in range(self.workers):
+            process = context.Process(target=_worker_main, name=f"fragment-worker-{index}", daemon=True,
+                                      args=(index, self._commands, self._results, self._queued[index],
+                                            self._received[index], config, model, device))
+            process.start()
+            self._processes.append(process)
+
+    def put(self, item):
+        badge_id, fragment, filename, received = item
+        seconds = fragment.shape[-1] / self.config.sample_rate
+        with self._lock:
+            index = self._assignment.get(badge_id)
+            if index is not None and not self._processes[index].is_alive():
+                self._lost(index)
+                index = self._assignment.get(badge_id)
+            if index is None:
+                logging.error(f"No active badge with ID: {badge_id}")
+                return
+            queued = self._queued[index].value + self._sent[index] - self._received[index].value
+            if self.config.queue_policy != "drop_oldest" and queued + seconds > self._max_seconds:
+                metrics.registry.inc("vad_scanner_shed_fragments_total", "rejected")
+                raise QueueFull(f"Fragment worker {index} of badge {badge_id} is full with "
+                                f"{queued} s of audio, can't take {filename}")
+            name = _share_fragment(fragment)
+            self._sent[index] += seconds
+            # Under the lock, so that a fragment reaches the worker of the badge before a handover moving it
+            self._commands[index].put(("fragment", badge_id, name, fragment.shape, fragment.dtype.str, filename,
+                                       received))
+
+    def enable(self, badge_id: str):
+        with self._lock:
+            if badge_id in self._assignment:
+                return
+            if len(self._dead) == self.workers:
+                logging.error(f"No fragment worker alive, can't enable badge {badge_id}")
+                return
+            index = self._assign(badge_id)
+        self._commands[index].put(("enable", badge_id))
+
+    def disable(self, badge_id: str):
+        with self._lock:
+            index = self._assignment.pop(badge_id, None)
+            if index is None:
+                return
+            self._load[index] -= 1
+            self._commands[index].put(("disable", badge_id))
+            for moved, old, new in self._rebalance():
+                # The new worker holds the fragments of the badge until the old one hands over its queued
+                # fragments and the parked recording
+                logging.info(f"Moving badge {moved} from fragment worker {old} to {new}")
+                self._commands[new].put(("adopt", moved))
+                self._commands[old].put(("handover", moved, new))
+
+    def stats(self, timeout: float = 1) -> list:
+        # FragmentStats snapshots of the workers that answered within the timeout
+        return self._gather("stats", timeout)
+
+    def metrics(self, timeout: float = 1) -> list:
+        # Metrics registry snapshots of the workers that answered within the timeout
+        return self._gather("metrics", timeout)
+
+    def swap_models(self, request: dict, timeout: float = 1) -> bool:
+        # Every worker loads the new models itself, they don't share memory with the ones forked from here.
+        # False if a worker is still swapping, a worker takes the swap before it answers the next status query
+        with self._swap_lock:
+            if any(status["state"] in ModelRegistry.SWAPPING for status in self.models(timeout)):
+                return False
+            for commands in self._commands:
+                commands.put(("swap", None, request))
+            return True
+
+    def models(self, timeout: float = 1) -> list:
+        # ModelRegistry status of the workers that answered within the timeout
+        return self._gather("models", timeout)
+
+    def _gather(self, command: str, timeout: float) -> list:
+        with self._stats_lock:
+            try:
+                while True:
+                    self._results.get_nowait()  # late answers to a previous call
+            except queue.Empty:
+                pass
+            with self._lock:
+                alive = [index for index in range(self.workers) if index not in self._dead]
+            for index in alive:
+                self._commands[index].put((command, None))
+            snapshots = []
+            deadline = time.monotonic() + timeout
+            try:
+                while len(snapshots) < len(alive):
+                    answer, snapshot = self._results.get(timeout=max(deadline - time.monotonic(), 0))
+                    if answer == command:
+                        snapshots.append(snapshot)
+            except queue.Empty:
+                logging.warning(f"Only {len(snapshots)} of {len(alive)} fragment workers reported {command}")
+            return snapshots
+
+    def close(self, timeout: float):
+        # Workers process their queued fragments for up to `timeout` seconds, save their state and exit
+        for commands in self._commands:
+            commands.put(("stop", None))
+        deadline = time.monotonic() + timeout + 10
+        for index, process in enumerate(self._processes):
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logging.error(f"Fragment worker {index} didn't stop in time, terminating it")
+                process.terminate()
+                process.join()
+        for path in glob.glob(os.path.join(SHM_DIR, f"{SHM_PREFIX}*")):
+            os.unlink(path)
+
+    def __contains__(self, badge_id):
+        with self._lock:
+            return badge_id in self._assignment
+
+    def _order(self, badge_id):
+        return sorted((w for w in range(self.workers) if w not in self._dead),
+                      key=lambda w: zlib.crc32(f"{badge_id}:{w}".encode()), reverse=True)
+
+    def _limit(self):
+        return max(1, math.ceil(self.balance * (len(self._assignment) + 1) / (self.workers - len(self._dead))))
+
+    def _lost(self, index):
+        # A worker that died takes the state of its badges with it, they start over on the other workers
+        process = self._processes[index]
+        self._dead.add(index)
+        badges = [badge_id for badge_id, w in self._assignment.items() if w == index]
+        for badge_id in badges:
+            del self._assignment[badge_id]
+        self._load[index] = 0
+        logging.error(f"Fragment worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                      f"moving its {len(badges)} badges to the other workers")
+        try:
+            while True:
+                command, _, *args = self._commands[index].get_nowait()
+                if command == "fragment":
+                    _drop_fragments([args])
+        except queue.Empty:
+            pass
+        if len(self._dead) == self.workers:
+            logging.error("No fragment worker alive")
+            return
+        for badge_id in badges:
+            self._commands[self._assign(badge_id)].put(("enable", badge_id))
+
+    def _assign(self, badge_id):
+        limit = self._limit()
+        index = next(w for w in self._order(badge_id) if self._load[w] < limit)
+        self._assignment[badge_id] = index
+        self._load[index] += 1
+        return index
+
+    def _rebalance(self):
+        # Badges pushed away from their preferred worker move back once it has room again
+        moves = []
+        limit = self._limit()
+        for badge_id, index in list(self._assignment.items()):
+            for w in self._order(badge_id):
+                if w == index:
+                    break
+                if self._load[w] < limit:
+                    self._assignment[badge_id] = w
+                    self._load[index] -= 1
+                    self._load[w] += 1
+                    moves.append((badge_id, index, w))
+                    break
+        return moves